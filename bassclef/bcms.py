@@ -18,17 +18,31 @@
 
 """bcms.py - Bassclef CMS"""
 
+import time
 import argparse
+import contextlib
+import importlib
+import os
 
-from bassclef.test import test
-from bassclef.init import init
-from bassclef.make import make
-from bassclef.preprocess import preprocess
-from bassclef.postprocess import postprocess
-from bassclef.compose import compose
-from bassclef.feed import feed
-from bassclef.serve import serve
-from bassclef.util import write
+# The start time, for tracing
+START = time.time()
+
+from bassclef.util import write  # pylint: disable=wrong-import-position
+
+# Each command is a function with the same name as its module.  Only the
+# selected command's module is imported; some of the modules import slow
+# dependencies, and 'render' and 'postprocess' are run for every page.
+
+
+def tracing(args):
+    """Returns a context manager that records the command in the trace, if
+    the build is being traced (see trace.py)."""
+    if not os.environ.get('BCMS_TRACE'):
+        return contextlib.nullcontext()
+    # pylint: disable=import-outside-toplevel
+    from bassclef.trace import span
+    path = getattr(args, 'output', None) or getattr(args, 'path', None)
+    return span('bcms ' + args.command, START, file=path or '')
 
 
 def main():
@@ -38,55 +52,135 @@ def main():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
 
+    # The --jobs option is shared by the commands that can work in parallel.
+    # A bare --jobs uses all of the cores.
+    jobs = argparse.ArgumentParser(add_help=False)
+    jobs.add_argument('--jobs', '-j', type=int, nargs='?',
+                      const=os.cpu_count())
+
     # 'test'
     subparser = subparsers.add_parser('test')
-    subparser.set_defaults(func=test)
+    subparser.set_defaults(command='test')
 
     # 'init'
     subparser = subparsers.add_parser('init')
     subparser.add_argument('--force', '-f', action='store_true')
     subparser.add_argument('--extras', '-e', action='store_true')
-    subparser.set_defaults(func=init)
+    subparser.set_defaults(command='init')
 
     # 'make'
-    subparser = subparsers.add_parser('make')
+    subparser = subparsers.add_parser('make', parents=[jobs])
     subparser.add_argument('target', nargs='*', default='')
-    subparser.set_defaults(func=make)
+    subparser.add_argument('--trace', action='store_true')
+    subparser.set_defaults(command='make')
+
+    # 'build'
+    subparser = subparsers.add_parser('build', parents=[jobs])
+    subparser.add_argument('--force', '-B', action='store_true')
+    subparser.add_argument('--batch', action='store_true')
+    subparser.add_argument('--compress', action='store_true')
+    subparser.set_defaults(command='build')
+
+    # 'images'
+    subparser = subparsers.add_parser('images', parents=[jobs])
+    subparser.add_argument('--force', '-B', action='store_true')
+    subparser.set_defaults(command='images')
+
+    # 'compress'
+    subparser = subparsers.add_parser('compress', parents=[jobs])
+    subparser.add_argument('--force', '-B', action='store_true')
+    subparser.set_defaults(command='compress')
+
+    # 'makevars'
+    subparser = subparsers.add_parser('makevars')
+    subparser.set_defaults(command='makevars')
+
+    # 'cache'
+    subparser = subparsers.add_parser('cache')
+    subparser.add_argument('action', choices=['info', 'evict', 'clean'],
+                           nargs='?', default='info')
+    subparser.set_defaults(command='cache')
 
     # 'preprocess'
     subparser = subparsers.add_parser('preprocess')
     subparser.add_argument('path')
-    subparser.set_defaults(func=preprocess)
+    subparser.set_defaults(command='preprocess')
+
+    # 'render'
+    subparser = subparsers.add_parser('render')
+    subparser.add_argument('path')
+    subparser.add_argument('--template')
+    subparser.add_argument('--metadata', '-M', action='append',
+                           metavar='KEY=VAL')
+    subparser.set_defaults(command='render')
 
     # 'postprocess'
     subparser = subparsers.add_parser('postprocess')
-    subparser.set_defaults(func=postprocess)
+    subparser.add_argument('--batch', nargs='+', metavar='PATH')
+    subparser.add_argument('--output', '-o')
+    subparser.set_defaults(command='postprocess')
 
     # 'compose'
-    subparser = subparsers.add_parser('compose')
+    subparser = subparsers.add_parser('compose', parents=[jobs])
     subparser.add_argument('path')
-    subparser.set_defaults(func=compose)
+    subparser.add_argument('--batch', action='store_true')
+    subparser.add_argument('--page', type=int, default=1)
+    subparser.set_defaults(command='compose')
 
     # 'feed'
     subparser = subparsers.add_parser('feed')
     subparser.add_argument('path')
-    subparser.set_defaults(func=feed)
+    subparser.add_argument('--atom')
+    subparser.add_argument('--json')
+    subparser.set_defaults(command='feed')
 
     # 'serve'
-    subparser = subparsers.add_parser('serve')
-    subparser.set_defaults(func=serve)
+    subparser = subparsers.add_parser('serve', parents=[jobs])
+    subparser.add_argument('--host', default='')
+    subparser.add_argument('--port', '-p', type=int, default=8000)
+    subparser.add_argument('--watch', '-w', action='store_true')
+    subparser.set_defaults(command='serve')
+
+    # 'trace'
+    subparser = subparsers.add_parser('trace')
+    subparser.add_argument('--chrome', metavar='PATH')
+    subparser.add_argument('--top', type=int, default=10)
+    subparser.set_defaults(command='trace')
+
+    # 'bench'
+    subparser = subparsers.add_parser('bench', parents=[jobs])
+    subparser.add_argument('suite',
+                           choices=['startup', 'encode', 'links', 'site'])
+    subparser.add_argument('--repeat', '-r', type=int, default=5)
+    subparser.add_argument('--max-ms', type=float)
+    subparser.add_argument('--posts', type=int, default=200)
+    subparser.add_argument('--indexes', type=int, default=4)
+    subparser.add_argument('--fanout', type=int, default=2)
+    subparser.add_argument('--images', type=int, default=10)
+    subparser.add_argument('--seed', type=int, default=0)
+    subparser.add_argument('--dir')
+    subparser.add_argument('--engine', choices=['make', 'build'],
+                           default='make')
+    subparser.add_argument('--renderer', choices=['pandoc', 'python', 'auto'])
+    subparser.add_argument('--output', '-o')
+    subparser.add_argument('--compare', metavar='PATH')
+    subparser.add_argument('--max-regression', type=float, metavar='PCT')
+    subparser.set_defaults(command='bench')
 
     # Parse the args and call whatever function was selected
     args, other_args = parser.parse_known_args()
-    if hasattr(args, 'func'):
-        if args.func.__name__ in ['make']:
-            args.func(args, other_args)
-        elif other_args:
-            write('Unknown options: ' + ' '.join(other_args) + '\n')
-        elif args.func.__name__ in ['test', 'postprocess', 'serve']:
-            args.func()
-        else:
-            args.func(args)
+    if hasattr(args, 'command'):
+        module = importlib.import_module('bassclef.' + args.command)
+        func = getattr(module, args.command)
+        with tracing(args):
+            if args.command in ['make']:
+                func(args, other_args)
+            elif other_args:
+                write('Unknown options: ' + ' '.join(other_args) + '\n')
+            elif args.command in ['test']:
+                func()
+            else:
+                func(args)
     else:
         parser.print_help()
 
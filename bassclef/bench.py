@@ -0,0 +1,447 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""bench.py - bassclef benchmarks.
+
+The benchmark suites are:
+
+  startup - measures the import time of the commands that are run for
+            every page using 'python -X importtime', and fails if any of
+            them import a module known to be slow.
+
+  encode - times the feed's html entity encoder on large descriptions,
+           and checks its output against the original encoder.
+
+  links - times the link namespacing done by compose.process() on a
+          corpus of link-dense markdown, and checks its output against
+          the original implementation.
+
+  site - generates a synthetic site (see synth.py) and times cold builds,
+         no-op rebuilds and rebuilds after editing a post, and 'bcms
+         compose', 'bcms feed' and 'bcms postprocess' on their own.  The
+         results can be written as JSON, and compared with those from
+         another version.
+"""
+
+import datetime
+import importlib.metadata
+import json
+import os
+import os.path
+import platform
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+from html.entities import codepoint2name
+
+from bassclef.util import write, error, cachedir, cachepath, readjson, \
+     which
+from bassclef.feed import encode
+from bassclef.compose import process
+from bassclef.cache import pandocversion
+from bassclef.makevars import sources, pagevars
+from bassclef.render import renderflags
+from bassclef.synth import generate, readparams, setconfig
+
+
+# The commands that are run for every page
+HOT = ['render', 'postprocess']
+
+# Modules that are slow to import, and the hot commands that may use them
+SLOW = {'pkg_resources': [],
+        'pandoc_tpp': [],
+        'markdown': [],
+        'http.server': [],
+        'yaml': ['render']}
+
+
+def importtime(command):
+    """Returns the (total time in ms, imported module names) for starting
+    the given command."""
+    code = 'import bassclef.bcms, bassclef.%s' % command
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            stderr=subprocess.PIPE, check=True).stderr
+    total, modules = 0, set()
+    for line in output.decode('utf-8').splitlines():
+        # Lines look like 'import time:   self [us] | cumulative | name'
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        selftime, _, name = line[12:].split('|')
+        total += int(selftime)
+        modules.add(name.strip())
+    return total/1000, modules
+
+
+def startup(args):
+    """Benchmarks the startup time of the hot commands."""
+
+    failures = []
+    for command in HOT:
+        times = []
+        for _ in range(args.repeat):
+            ms, modules = importtime(command)
+            times.append(ms)
+        ms = min(times)
+        write('%-12s %7.1f ms\n' % (command, ms))
+        for name, users in SLOW.items():
+            if name in modules and command not in users:
+                failures.append('%s imports %s' % (command, name))
+        if args.max_ms and ms > args.max_ms:
+            failures.append('%s takes %.1f ms to start' % (command, ms))
+
+    if failures:
+        error('Startup regressions: %s.' % '; '.join(failures))
+
+
+# Paragraphs for the feed descriptions; typical prose, and prose that is
+# dense with characters that need encoding
+PARAGRAPHS = {
+    'prose': '<p>' + 'The quick brown fox jumps over the lazy dog. ' * 20 +
+             '<a href="/posts/caf\u00e9.html">Caf\u00e9</a>.</p>\n',
+    'accented': '<p>Caf\u00e9 \u2014 \u201cna\u00efve\u201d '
+                'r\u00e9sum\u00e9s cost \u00a35 &amp; \u00bd of '
+                '<a href="/x.html">that</a>.</p>\n'}
+
+
+def encode_reference(txt):
+    """The original html entity encoder."""
+    skip = ['<', '>', '"', '&']
+    ret = ''
+    for c in txt:
+        if c not in skip and ord(c) in codepoint2name:
+            ret += "&" + codepoint2name.get(ord(c)) + ";"
+        else:
+            ret += c
+    return ret
+
+
+def timeof(func, arg, repeat):
+    """Returns the best time in ms for func(arg) over repeat calls."""
+    return min(timeit.repeat(lambda: func(arg), number=1, repeat=repeat))*1000
+
+
+def encodebench(args):
+    """Benchmarks the feed's html entity encoder."""
+
+    for name, paragraph in PARAGRAPHS.items():
+        for kb in [100, 500]:
+            txt = paragraph * (kb*1000 // len(paragraph) + 1)
+            if encode(txt) != encode_reference(txt):
+                error('encode() output differs from the original encoder.')
+            write('encode %-8s %4d KB %8.2f ms (original %.2f ms)\n' %
+                  (name, kb, timeof(encode, txt, args.repeat),
+                   timeof(encode_reference, txt, args.repeat)))
+
+
+# Lines for the links corpus that exercise the corners of the reference
+# syntax
+TRICKY = ['[a][b][c] chained references\n',
+          '[^1][a][b][^1] references among footnotes\n',
+          '[a [nested] label][id] and [b][] and []][x] and ][ stray\n',
+          '[x [a][b] [a][b] repeated references\n',
+          '[a][3:b] and [a][12:b] already namespaced\n',
+          '[a\\_b]: http://example.com/escaped\n',
+          '[^note]: A footnote\n',
+          '\n',
+          '    that continues.\n',
+          '\n',
+          'Text after the footnote.\n']
+
+
+def corpus(size):
+    """Returns the lines of a weekly roundup with size reference links.
+    There are ten stories to a paragraph, each on a single line."""
+    lines = ['This week\'s roundup.\n', '\n']
+    for i in range(0, size, 10):
+        lines.append(' '.join('[Story %d][s%d] from [the source][src%d], via '
+                              '[a friend](http://example.com/f%d)[^%d].' %
+                              (j, j, j % 7, j, j)
+                              for j in range(i, min(i+10, size))) + '\n')
+        lines.append('\n')
+        if i == size // 20 * 10:
+            lines += ['<!-- cut -->\n', '\n']
+    lines.append('\n')
+    lines += TRICKY
+    for i in range(size):
+        lines.append('[s%d]: http://example.com/story/%d\n' % (i, i))
+    for i in range(7):
+        lines.append('[src%d]: http://example.com/source/%d\n' % (i, i))
+    for i in range(size):
+        lines.append('[^%d]: Note %d.\n' % (i, i))
+    return lines
+
+
+# pylint: disable=too-many-locals
+def process_reference(lines, meta, n):
+    """The original implementation of compose.process()."""
+
+    # Link reference and definition patterns
+    p1 = re.compile(r'(\[(.*?)\]\[(?!%d:)(.*?)\])'%n)  # Reference
+    p2 = re.compile(r'^\[(?!\^)(.*?)\]:')              # Definition
+
+    # Footnote reference and definition patterns
+    p3 = re.compile(r'(?!^)(\[\^(.*?)\])')             # Reference
+    p4 = re.compile(r'^(\[\^(.*?)\]:)')                # Definition
+
+    cutpoint = False  # Flags that a cut point was found
+    lastline = None   # Track the last line
+    innote = False    # Flags we are in a footnote definition
+    out = []          # The list of processed lines
+
+    # Read, process, and store each line
+    for line in lines:
+
+        # Use the number n to give links a namespace
+        while p1.search(line):
+            old, a, b = p1.search(line).groups()
+            new = '[%s][%d:%s]'%(a, n, b)
+            line = line.replace(old, new)
+        if p2.search(line):
+            a = p2.search(line).groups()[0]
+            line = p2.sub('[%d:%s]:'%(n, a), line)
+
+        # Strip footnote references
+        if p3.search(line):
+            a = p3.search(line).groups()[0]
+            line = p3.sub('', line)
+
+        # Check for a cut point
+        if line.strip() == '<!-- cut -->':
+            cutpoint = True
+            line = '\n'
+
+        # Check if we are in a footnote definition
+        if innote:
+            if lastline.strip() == '' and line and not line.startswith('    '):
+                innote = False
+        elif p4.search(line):
+            innote = True
+
+        # Store the line.  Ignore all footnotes, and ignore markdown after
+        # <!-- cut --> except for link references.
+        if (not innote and not cutpoint) or p2.search(line):
+            out.append(line)
+
+        # Remember the last line
+        lastline = line
+
+    # Add a 'Read more...' link if <!-- cut --> was found.
+    if cutpoint:
+        out.append('\n[Read more...](%s)\n'%meta['permalink'])
+
+    # Return the processed lines
+    return out
+
+
+def linksbench(args):
+    """Benchmarks the link namespacing in compose.process()."""
+
+    meta = {'permalink': 'http://example.com/roundup.html'}
+    for size in [200, 1000]:
+        lines = corpus(size)
+        for n in [0, 3, 12]:
+            if list(process(lines, meta, n)) != \
+              process_reference(lines, meta, n):
+                error('process() output differs from the original for '
+                      'entry %d.' % n)
+        write('links %5d refs %8.2f ms (original %.2f ms)\n' %
+              (size, timeof(lambda x: list(process(x, meta, 1)), lines,
+                            args.repeat),
+               timeof(lambda x: process_reference(x, meta, 1), lines,
+                      args.repeat)))
+
+
+def timecommand(command, repeat, setup=None, stdin=None):
+    """Returns the times in seconds for repeat runs of the command.
+
+    setup - a function to call before each run
+    stdin - the path to a file for the command's input
+    """
+    times = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        with open(stdin or os.devnull, 'rb') as f:
+            start = time.perf_counter()
+            proc = subprocess.run(command, stdin=f, stdout=subprocess.DEVNULL,
+                                  check=False)
+            times.append(time.perf_counter() - start)
+        if proc.returncode:
+            error('Command failed: %s' % ' '.join(command), proc.returncode)
+    return times
+
+
+def sitebenches(args):
+    """Generates the (name, command, setup, stdin) tuples for the site
+    benchmarks.  The current directory must be the site."""
+
+    jobs = ['--jobs', str(args.jobs)] if args.jobs else []
+    build = ['bcms', args.engine] + jobs
+    mds, mdins = sources()
+    post = mds[len(mds)//2]
+
+    def clean():
+        """Removes the outputs and the build cache."""
+        shutil.rmtree('www', ignore_errors=True)
+        shutil.rmtree(cachedir(), ignore_errors=True)
+
+    edits = []
+
+    def edit():
+        """Changes the content of a post."""
+        edits.append(len(edits))
+        with open(post, 'a', encoding='utf-8') as f:
+            f.write('\nEdit %d.\n' % edits[-1])
+
+    yield 'cold', build, clean, None
+    yield 'noop', build, None, None
+    yield 'edit', build, edit, None
+    yield 'compose', ['bcms', 'compose'] + jobs + [mdins[0]], None, None
+    yield 'feed', ['bcms', 'feed', mdins[0]], None, None
+
+    # Postprocessing needs fresh renderer output
+    render = ['bcms', 'render'] + \
+      renderflags(pagevars(post, cachepath('tpp', ''))) + [post]
+    yield 'render', render, None, None
+    raw = cachepath('bench', 'raw.html')
+    with open(raw, 'wb') as f:
+        f.write(subprocess.run(render, stdout=subprocess.PIPE,
+                               check=True).stdout)
+    yield 'postprocess', \
+      ['bcms', 'postprocess', '-o', cachepath('bench', 'out.html')], None, raw
+
+
+def version():
+    """Returns the installed bassclef version."""
+    try:
+        return importlib.metadata.version('Bassclef-CMS')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def compare(results, path, limit):
+    """Compares the results with those in the file at path.  Returns a list
+    of the benchmarks that are more than limit percent slower."""
+    old = readjson(path, None)
+    if not old:
+        error('Could not read %s.' % path)
+    write('\n%-12s %12s %12s %9s\n' %
+          ('benchmark', 'before ms', 'after ms', 'change'))
+    failures = []
+    for name, result in results['benchmarks'].items():
+        if name not in old['benchmarks']:
+            continue
+        before = old['benchmarks'][name]['median']
+        change = (result['median'] - before) / before * 100
+        write('%-12s %12.1f %12.1f %+8.1f%%\n' %
+              (name, before*1000, result['median']*1000, change))
+        if limit is not None and change > limit:
+            failures.append('%s is %.1f%% slower' % (name, change))
+    if old.get('site') != results['site']:
+        write('The sites differ: %s vs %s.\n' %
+              (json.dumps(old.get('site')), json.dumps(results['site'])))
+    return failures
+
+
+def sitebench(args):
+    """Benchmarks builds of a synthetic site."""
+
+    params = {'posts': args.posts, 'indexes': args.indexes,
+              'fanout': args.fanout, 'images': args.images,
+              'seed': args.seed}
+
+    # Generate the site, or reuse the one given by --dir
+    path = args.dir or os.path.join(tempfile.mkdtemp(), 'site')
+    if not os.path.exists(path):
+        write('Generating a site with %d posts in %s...\n' %
+              (args.posts, path))
+        generate(path, params)
+    elif readparams(path) is None:
+        error('%s is not a synthetic site.' % path)
+    elif readparams(path) != params:
+        error('%s was generated with different parameters.' % path)
+
+    results = {'bassclef': version(),
+               'python': platform.python_version(),
+               'pandoc': pandocversion() if which('pandoc') else None,
+               'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'engine': args.engine,
+               'renderer': args.renderer,
+               'jobs': args.jobs,
+               'site': params,
+               'benchmarks': {}}
+
+    cwd = os.getcwd()
+    os.chdir(path)
+
+    # The renderer is set in the site's config.ini for the benchmarks.  The
+    # original is restored afterwards, along with its mtime so that make
+    # doesn't see it as changed.
+    config = None
+    if args.renderer:
+        with open('config.ini', encoding='utf-8') as f:
+            config = f.read(), os.stat('config.ini')
+
+    try:
+        if args.renderer:
+            setconfig('renderer', args.renderer)
+        for name, command, setup, stdin in sitebenches(args):
+            times = timecommand(command, args.repeat, setup, stdin)
+            results['benchmarks'][name] = {'min': min(times),
+                                           'median': statistics.median(times),
+                                           'times': times}
+            write('%-12s %9.1f ms (median %.1f ms)\n' %
+                  (name, min(times)*1000, statistics.median(times)*1000))
+    finally:
+        if config:
+            with open('config.ini', 'w', encoding='utf-8') as f:
+                f.write(config[0])
+            os.utime('config.ini',
+                     ns=(config[1].st_atime_ns, config[1].st_mtime_ns))
+        os.chdir(cwd)
+        if not args.dir:
+            shutil.rmtree(os.path.dirname(path))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        write('Results written to %s.\n' % args.output)
+
+    if args.compare:
+        failures = compare(results, args.compare, args.max_regression)
+        if failures:
+            error('Regressions: %s.' % '; '.join(failures))
+
+
+# The benchmark suites, keyed by name
+SUITES = {'startup': startup,
+          'encode': encodebench,
+          'links': linksbench,
+          'site': sitebench}
+
+
+def bench(args):
+    """Runs the selected benchmark suite."""
+    SUITES[args.suite](args)
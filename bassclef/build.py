@@ -0,0 +1,297 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""build.py - builds the site without GNU make.
+
+Each output is given a key that is a digest of the content of everything
+it depends on:
+
+  * pages depend on their .md file, metadata (which includes config.ini
+    and the posted-in links), the templates, the image renditions and
+    the renderer (see render.py);
+  * composed pages depend on their .md.in file and metadata, the content
+    and metadata of each post listed, the templates and the image
+    renditions;
+  * feeds depend on their .md.in file and metadata and the content
+    bodies of the posts they include; and
+  * css, fonts and javascript depend on their sources; and
+  * stylesheet and script bundles are named for their content.
+
+An output is only rebuilt when its key changes.  Images are made by
+images.py, which keeps its own manifest.  With --compress, precompressed
+siblings are then written by compress.py.  The renditions it records are
+used to make the pages' images responsive.
+"""
+
+import concurrent.futures
+import functools
+import glob
+import json
+import os
+import os.path
+import shutil
+import subprocess
+
+from bassclef.util import getmeta, cachepath, \
+     digest, readjson, writejson, getjobs, write, error
+from bassclef.makevars import sources, outdir, htmlpath, feedpath, listing, \
+     feedentries, feedflags, pagesize, pagecount, pagename, pagepath, \
+     pagevars, maketemplate
+from bassclef.bundle import BUNDLES, BUNDLED
+from bassclef.cache import getbody, locked, evict
+from bassclef.images import makeimages
+from bassclef.compress import makesiblings
+from bassclef.postprocess import transformfile
+from bassclef.trace import traced
+from bassclef.render import renderflags, markdownversion
+
+
+# File content digests, keyed by path
+HASHES = {}
+
+
+def filehash(path):
+    """Returns a digest of the content of the file at path."""
+    if path not in HASHES:
+        with open(path, 'rb') as f:
+            HASHES[path] = digest(f.read())
+    return HASHES[path]
+
+
+def metahash(path):
+    """Returns a digest of the metadata for the file at path."""
+    return digest(json.dumps(getmeta(path), sort_keys=True))
+
+
+def templatehash():
+    """Returns a digest of all of the templates."""
+    paths = sorted(glob.glob('templates/**/*', recursive=True))
+    return digest(*[filehash(p) for p in paths if os.path.isfile(p)])
+
+
+def imageshash():
+    """Returns a digest of the image renditions recorded by images.py."""
+    images = readjson(cachepath('renditions.json'), {})
+    return digest(json.dumps(images, sort_keys=True))
+
+
+def run(commands, dest):
+    """Runs the commands as a pipeline with the output written to dest.
+    The destination is removed if any part of the pipeline fails."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    write(' | '.join(' '.join(command) for command in commands) +
+          ' > %s\n' % dest)
+    with open(dest, 'w') as f:
+        procs = []
+        stdin = None
+        for i, command in enumerate(commands):
+            stdout = f if i == len(commands)-1 else subprocess.PIPE
+            procs.append(subprocess.Popen(traced(command), stdin=stdin,
+                                          stdout=stdout))
+            if stdin is not None:
+                stdin.close()  # Allow SIGPIPE to reach the previous process
+            stdin = procs[-1].stdout
+        codes = [proc.wait() for proc in procs]
+    if any(codes):
+        os.remove(dest)
+        raise subprocess.CalledProcessError(max(codes), commands[-1])
+
+
+def md2html(src, dest, pvars):
+    """Transforms the markdown at src to html at dest.  The html is
+    postprocessed in this process rather than in a pipeline."""
+    run([['bcms', 'render'] + renderflags(pvars) + [src]], dest)
+    write('bcms postprocess --batch %s\n' % dest)
+    transformfile(dest)
+
+
+def compose2html(src, page, dest, pvars, flags):
+    """Composes the given page of the .md.in file at src and transforms it to
+    html at dest.
+
+    flags - extra flags for 'bcms compose'
+    """
+    composed = cachepath('md', pagename(src, page) + '.md')
+    pageflags = ['--page', str(page)] if page > 1 else []
+    run([['bcms', 'compose'] + flags + pageflags + [src]], composed)
+    md2html(composed, dest, pvars)
+
+
+def copyfile(src, dest):
+    """Copies the file at src to dest."""
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    write('cp %s %s\n' % (src, dest))
+    shutil.copyfile(src, dest)
+
+
+def targets(composeflags):
+    """Generates (dest, key, action) tuples for the build outputs that
+    don't depend on other outputs.  Calling action() builds dest.
+
+    composeflags - extra flags for 'bcms compose'
+    """
+
+    # Actions may run in worker threads, so everything that touches the
+    # global config and metadata stores is evaluated here, up front.
+
+    tmp = cachepath('tpp', '')
+    templates = templatehash()
+    images = imageshash()
+    mds, mdins = sources()
+
+    # Process the templates first.  This bundles the stylesheets and scripts
+    # that they link, and the pages depend on the bundles' names.  Pages
+    # that may be rendered in process depend on the Python-Markdown version
+    # too.
+    for src in mds + mdins:
+        maketemplate(getmeta(src, 'template'), tmp)
+    templates = digest(templates, *sorted(BUNDLES), markdownversion())
+
+    # Static files, except for those that are bundled
+    for subdir in ['css', 'fonts', 'javascript']:
+        for src in sorted(glob.glob(subdir + '/**/*', recursive=True)):
+            if os.path.isfile(src) and src not in BUNDLED:
+                dest = outdir() + '/' + src
+                yield dest, filehash(src), \
+                  functools.partial(copyfile, src, dest)
+    for name, src in sorted(BUNDLES.items()):
+        dest = outdir() + '/' + name
+        yield dest, name, functools.partial(copyfile, src, dest)
+
+    # Pages
+    for src in mds:
+        dest = htmlpath(src)
+        key = digest(filehash(src), metahash(src), templates, images)
+        yield dest, key, \
+          functools.partial(md2html, src, dest, pagevars(src, tmp))
+
+    # Composed pages.  Every page of a paginated file depends on the number
+    # of pages for its navigation links, but only on its own entries.
+    for src in mdins:
+        entries = listing(src)
+        size = pagesize(src) or len(entries)
+        pages = pagecount(src)
+        for page in range(1, pages + 1):
+            dest = pagepath(src, page)
+            onpage = entries[(page-1)*size:page*size]
+            key = digest(filehash(src), metahash(src), templates, images,
+                         str(pages),
+                         *[filehash(p) + metahash(p) for p in onpage])
+            yield dest, key, \
+              functools.partial(compose2html, src, page, dest,
+                                pagevars(src, tmp, page), composeflags)
+
+
+def feedtargets():
+    """Generates (dest, key, action) tuples for the feeds.  These depend on
+    the content bodies of the feed's entries only, and so must be generated
+    after the other targets are built.  The RSS feed is the target; any
+    Atom and JSON feeds are written with it."""
+    _, mdins = sources()
+    for src in mdins:
+        dest = feedpath(src)
+        entries = feedentries(src)
+        bodies = [getbody(htmlpath(p)) or '' for p in entries]
+        key = digest(filehash(src), metahash(src),
+                     *[metahash(p) for p in entries], *bodies)
+        yield dest, key, functools.partial(
+            run, [['bcms', 'feed'] + feedflags(src) + [src]], dest)
+
+
+def stat(path):
+    """Returns the (mtime, size) of the file at path, or None."""
+    try:
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_size]
+    except FileNotFoundError:
+        return None
+
+
+def runtargets(targets, state, jobs):
+    """Runs the actions for the stale targets using a pool of jobs workers.
+    The state is updated as each target is built.  Returns the number of
+    targets built."""
+
+    # The actions mostly wait on pandoc and other subprocesses, and so a
+    # thread pool is sufficient to keep all of the cores busy.
+    n = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = {}
+        for dest, key, action in targets:
+            if dest in state and state[dest] == [key, stat(dest)]:
+                continue
+            futures[executor.submit(action)] = dest, key
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+                dest, key = futures[future]
+                HASHES.pop(dest, None)  # Forget the old content digest
+                state[dest] = [key, stat(dest)]
+                n += 1
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+    return n
+
+
+def buildsite(jobs, force=False, batch=False):
+    """Builds the site, rebuilding only the outputs whose inputs changed.
+    Returns the number of outputs built.  A failed command raises
+    subprocess.CalledProcessError.
+
+    force - rebuild everything
+    batch - render composed pages with 'bcms compose --batch'
+    """
+
+    # The state records the key and file stats for each output.  Outputs
+    # that were changed outside of the build get rebuilt.
+    statepath = cachepath('build.json')
+    state = {} if force else readjson(statepath, {})
+
+    # Images are handled by their own engine, with its own manifest
+    n = makeimages(jobs, force)
+
+    try:
+        composeflags = ['--batch'] if batch else []
+        n += runtargets(targets(composeflags), state, jobs)
+        n += runtargets(feedtargets(), state, jobs)
+    finally:
+        writejson(state, statepath)
+
+    return n
+
+
+def build(args):
+    """Builds the site, rebuilding only the outputs whose inputs changed."""
+
+    if not os.path.exists('config.ini'):
+        error('config.ini not found.')
+
+    try:
+        with locked():
+            n = buildsite(getjobs(args.jobs), args.force, args.batch)
+            if args.compress:
+                n += makesiblings(getjobs(args.jobs, os.cpu_count()),
+                                  args.force)
+            evict()
+    except subprocess.CalledProcessError as e:
+        error('Command failed: %s' % ' '.join(e.cmd), e.returncode)
+
+    if not n:
+        write('Nothing to be done.\n')
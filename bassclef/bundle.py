@@ -0,0 +1,221 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""bundle.py - bundles the stylesheets and scripts linked by templates.
+
+When a template is processed, each run of consecutive lines that link
+local stylesheets, e.g.,
+
+  <link rel="stylesheet" href="/css/skeleton/normalize.css">
+  <link rel="stylesheet" href="/css/bassclef.css">
+
+is replaced by a single link to a bundle named for a digest of its
+content, e.g., /css/bundle-0123456789.css.  Runs of local <script src=...>
+lines are bundled in the same way into javascript/.  A bundle can be
+cached forever, because any change gives it a new name.
+
+Stylesheets are minified and their relative url()s are rewritten for the
+bundle's location.  Scripts are not minified, but a .min.js version of a
+script is used if there is one.
+
+If prune-font-awesome is True in config.ini, the font-awesome rules for
+icons whose names don't appear anywhere in the templates or markdown are
+dropped from the stylesheet bundles.  The generated html can only use the
+icons named there, and so this is the same as checking the html, but can
+be done before it is generated.
+
+Bundles are written to the build cache directory, and copied into www/ by
+the css and javascript modules (or 'bcms build').
+"""
+
+import glob
+import os.path
+import posixpath
+import re
+
+from bassclef.util import getconfig, cachepath, digest
+from bassclef.cache import writefile
+
+
+# Links to local files in templates.  The paths are relative to the site.
+STYLESHEET = re.compile(r'^\s*<link rel="stylesheet" href="/(?!/)'
+                        r'([^"]*\.css)"\s*/?>\s*$')
+SCRIPT = re.compile(r'^\s*<script src="/(?!/)([^"]*\.js)"></script>\s*$')
+
+# Stylesheet tokens for minification: strings, license comments,
+# punctuation with its surrounding space, and other space.  Other comments
+# count as space.
+SPACE = r'(?:\s|/\*(?!!).*?\*/)'
+CSSTOKEN = re.compile(r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')'''
+                      r'|(/\*!.*?\*/)'
+                      r'|%s*(;%s*\}|[{};,])%s*|(:)%s+' % ((SPACE,)*4) +
+                      r'|%s+' % SPACE, re.S)
+
+# Stylesheet url()s
+URL = re.compile(r'''url\(\s*(['"]?)([^'")]*)\1\s*\)''')
+
+# Stylesheet rules without nested blocks, and font-awesome icon selectors
+RULE = re.compile(r'([^{}]+)\{[^{}]*\}')
+ICON = re.compile(r'^\.fa-([a-z0-9-]+)::?before$')
+
+# Font-awesome icon names used in templates and markdown
+ICONNAME = re.compile(r'\bfa-([a-z0-9-]+)')
+
+# The bundles made so far, keyed by name, and the sources bundled
+BUNDLES = {}
+BUNDLED = set()
+
+# The icon names found in the templates and markdown
+ICONS = None
+
+
+def usedicons():
+    """Returns the set of font-awesome icon names used in the templates and
+    markdown."""
+    global ICONS  # pylint: disable=global-statement
+    if ICONS is None:
+        ICONS = set()
+        for pattern in ['templates/**/*', 'markdown/**/*']:
+            for path in glob.glob(pattern, recursive=True):
+                if os.path.isfile(path):
+                    with open(path, encoding='utf-8', errors='replace') as f:
+                        ICONS.update(ICONNAME.findall(f.read()))
+    return ICONS
+
+
+def pruneicons(css, icons):
+    """Returns the css without the rules for icons that aren't in icons."""
+    def repl(m):
+        names = [ICON.match(s.strip()) for s in m.group(1).split(',')]
+        if all(names) and not any(n.group(1) in icons for n in names):
+            return ''
+        return m.group(0)
+    return RULE.sub(repl, css)
+
+
+def rebase(css, src, dest):
+    """Returns the css from the file at src with its relative url()s
+    rewritten for the file at dest."""
+    def repl(m):
+        quote, url = m.groups()
+        if url.startswith(('/', '#', 'data:')) or '://' in url:
+            return m.group(0)
+        # Keep any query or fragment
+        i = min([url.index(c) for c in '?#' if c in url] or [len(url)])
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(src),
+                                                 url[:i]))
+        path = posixpath.relpath(path, posixpath.dirname(dest))
+        return 'url(%s%s%s%s)' % (quote, path, url[i:], quote)
+    return URL.sub(repl, css)
+
+
+def minifycss(css):
+    """Returns the minified css.  Comments are removed, except for those
+    starting /*! (licenses), and unneeded space is collapsed."""
+    def repl(m):
+        string, comment, punct, colon = m.groups()
+        if string:
+            return string
+        if comment:
+            return comment + '\n'
+        if punct:
+            return '}' if punct.startswith(';') and len(punct) > 1 else punct
+        return colon or ' '
+    return CSSTOKEN.sub(repl, css).strip()
+
+
+def readsource(path):
+    """Returns the content of the source file at path.  The .min.js version
+    of a script is read if there is one."""
+    if path.endswith('.js') and not path.endswith('.min.js') and \
+      os.path.isfile(path[:-3] + '.min.js'):
+        path = path[:-3] + '.min.js'
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def makebundle(paths, ext):
+    """Makes the bundle for the source files at paths with the given
+    extension ('css' or 'js').  Returns the bundle's name."""
+    subdir = 'css' if ext == 'css' else 'javascript'
+    if ext == 'css':
+        prune = getconfig().get('prune-font-awesome', '') == 'True'
+        parts = []
+        for path in paths:
+            css = rebase(readsource(path), path, subdir + '/bundle.css')
+            css = css.replace('@charset "UTF-8";', '')
+            if prune and 'font-awesome' in path:
+                css = pruneicons(css, usedicons())
+            parts.append(minifycss(css))
+        content = '\n'.join(parts) + '\n'
+    else:
+        # Guard against scripts that don't end with a semicolon
+        content = ';\n'.join(readsource(path).strip() for path in paths)
+        content += ';\n'
+    name = '%s/bundle-%s.%s' % (subdir, digest(content)[:10], ext)
+    if name not in BUNDLES:
+        path = bundlepath(name)
+        if not os.path.exists(path):
+            writefile(path, content)
+        BUNDLES[name] = path
+    BUNDLED.update(paths)
+    return name
+
+
+def bundlepath(name):
+    """Returns the path in the build cache for the bundle with the given
+    name."""
+    return cachepath('bundles', name)
+
+
+def bundlelinks(lines):
+    """Returns the template lines with runs of links to local stylesheets
+    and scripts replaced by links to their bundles."""
+
+    ret = []
+    run, pattern = [], None  # The current run of (line, path)
+
+    def flush():
+        """Adds the current run to ret."""
+        if not run:
+            return
+        indent = run[0][0][:len(run[0][0]) - len(run[0][0].lstrip())]
+        if pattern is STYLESHEET:
+            name = makebundle([path for _, path in run], 'css')
+            ret.append('%s<link rel="stylesheet" href="/%s">\n' %
+                       (indent, name))
+        else:
+            name = makebundle([path for _, path in run], 'js')
+            ret.append('%s<script src="/%s"></script>\n' % (indent, name))
+        run.clear()
+
+    for line in lines:
+        for p in [STYLESHEET, SCRIPT]:
+            m = p.match(line)
+            if m and os.path.isfile(m.group(1)):
+                if p is not pattern:
+                    flush()
+                    pattern = p
+                run.append((line, m.group(1)))
+                break
+        else:
+            flush()
+            ret.append(line)
+    flush()
+
+    return ret
@@ -0,0 +1,228 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""cache.py - caches rendered html fragments between builds.
+
+Fragments are stored in the build cache directory under a key that is a
+digest of everything that went into rendering them.  Stale fragments are
+never looked up again.
+
+The content body of each postprocessed page is also stored, keyed by the
+page's path, so that feeds don't need to scrape it from the page.
+
+The build cache directory (.bcms/ unless cache-dir is set in config.ini)
+also holds the composed markdown, processed templates, image renditions,
+bundles and build manifests.  Commands that update the manifests hold
+the cache lock so that concurrent builds don't undo each other's work.
+When the cache grows past cache-size (in MB) in config.ini, the least
+recently used fragments and image renditions are evicted; these are only
+ever a cache miss.  'bcms cache clean' removes the cache entirely.
+"""
+
+import contextlib
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+
+from bassclef.util import getconfig, cachedir, cachepath, prunemeta, write
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# The pandoc version; output may change between versions
+PANDOC_VERSION = None
+
+# The cache subdirectories that may be evicted from
+EVICTABLE = ['fragments', 'images']
+
+# The default cache size limit, in MB
+CACHESIZE = 1000
+
+
+def pandocversion():
+    """Returns the pandoc version string."""
+    global PANDOC_VERSION  # pylint: disable=global-statement
+    if PANDOC_VERSION is None:
+        output = subprocess.check_output(['pandoc', '--version'])
+        PANDOC_VERSION = output.decode('utf-8').splitlines()[0]
+    return PANDOC_VERSION
+
+
+def fragmentpath(key):
+    """Returns the path for the fragment with the given key."""
+    return cachepath('fragments', key[:2], key + '.html')
+
+
+def getfragment(key):
+    """Returns the html fragment stored under key, or None.  The fragment is
+    marked as used so that it isn't evicted."""
+    path = fragmentpath(key)
+    try:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+        os.utime(path)
+        return html
+    except FileNotFoundError:
+        return None
+
+
+def putfragment(key, html):
+    """Stores the html fragment under key."""
+    writefile(fragmentpath(key), html)
+
+
+def bodypath(path):
+    """Returns the path for the stored content body of the page at path."""
+    return cachepath('bodies', path)
+
+
+def getbody(path):
+    """Returns the stored content body of the page at path, or None if there
+    is none or it is older than the page."""
+    try:
+        if os.stat(bodypath(path)).st_mtime_ns < os.stat(path).st_mtime_ns:
+            return None
+        with open(bodypath(path), encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def putbody(path, body):
+    """Stores the content body of the page at path.  A body of None removes
+    the stored body."""
+    if body is None:
+        try:
+            os.remove(bodypath(path))
+        except FileNotFoundError:
+            pass
+    else:
+        writefile(bodypath(path), body)
+
+
+def writefile(path, text):
+    """Writes text to the file at path.  The file is replaced atomically so
+    that concurrent builds never see a partial write."""
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmppath, path)
+
+
+@contextlib.contextmanager
+def locked():
+    """Holds the cache lock for the duration of the context.  Waits for any
+    other process that holds it."""
+    with open(cachepath('lock'), 'a') as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def entries():
+    """Returns (last use, size, path) tuples for the evictable files in the
+    cache."""
+    ret = []
+    for subdir in EVICTABLE:
+        for root, _, filenames in os.walk(os.path.join(cachedir(), subdir)):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                ret.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+    return ret
+
+
+def cachesize():
+    """Returns the total size of the cache in bytes."""
+    total = 0
+    for root, _, filenames in os.walk(cachedir()):
+        for filename in filenames:
+            try:
+                total += os.stat(os.path.join(root, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def sizelimit():
+    """Returns the cache size limit in bytes."""
+    size = CACHESIZE
+    if os.path.exists('config.ini'):
+        size = getconfig().get('cache-size') or size
+    return int(float(size) * 1e6)
+
+
+def evict(limit=None):
+    """Removes the least recently used fragments and image renditions until
+    the cache is within limit bytes (the configured size limit by default).
+    The metadata of deleted files is forgotten too.  The cache lock must be
+    held.  Returns the number of files removed."""
+    prunemeta()
+    if limit is None:
+        limit = sizelimit()
+    excess = cachesize() - limit
+    n = 0
+    for _, size, path in sorted(entries()):
+        if excess <= 0:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        excess -= size
+        n += 1
+    return n
+
+
+def cache(args):
+    """Manages the build cache."""
+
+    path = cachedir()
+
+    if args.action == 'clean':
+        if os.path.isdir(path):
+            with locked():
+                for name in os.listdir(path):
+                    if name != 'lock':
+                        p = os.path.join(path, name)
+                        if os.path.isdir(p):
+                            shutil.rmtree(p)
+                        else:
+                            os.remove(p)
+        write('Removed the build cache in %s/.\n' % path)
+
+    elif args.action == 'evict':
+        with locked():
+            n = evict()
+        write('Evicted %d file%s.\n' % (n, '' if n == 1 else 's'))
+
+    else:
+        write('%s/: %.1f MB (limit %g MB)\n' %
+              (path, cachesize()/1e6, sizelimit()/1e6))
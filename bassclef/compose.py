@@ -20,27 +20,50 @@
 
 import os, os.path
 import re
+import io
+import json
+import html as htmllib
+import collections
+import concurrent.futures
 import tempfile
 import subprocess
 import urllib.parse
 
-from bassclef.util import getmeta, writemeta, getcontent, \
-     writelines, write, permalink, STDOUT
+from bassclef.util import getmeta, writemeta, itercontent, \
+     writelines, write, permalink, getjobs, digest, error, STDERR
+from bassclef.cache import getfragment, putfragment, pandocversion
+from bassclef.render import PANDOCFORMAT, choose, markdownversion, \
+     renderpython
+from bassclef.preprocess import applyflags
+from bassclef.template import parse as template_parse, \
+     render as template_render
+from bassclef.makevars import pagesize, pagename
+from bassclef.trace import traced
+from bassclef.jobserver import slot
 
 import pandoc_tpp
 
 
+# Batch mode markers in the pandoc html output
+BATCHMARKER = re.compile(r'<!-- bcms-(title|body)-(\d+) -->')
+PARAGRAPH = re.compile(r'^<p>(.*)</p>$', re.DOTALL)
+
+# The maximum number of entries rendered by each pandoc call in batch mode
+BATCHSIZE = 100
+
 # pylint: disable=too-many-locals
 def process(lines, meta, n):
-    """Processes the content lines of a markdown file.
+    """Generates the processed content lines of a markdown file.
 
     Footnotes are eliminated and links are namespaced in order to avoid
     collisions.  The markdown is truncated where <!-- cut --> is found, and
     a "Read more..." line is added.
     """
 
-    # Link reference and definition patterns
-    p1 = re.compile(r'(\[(.*?)\]\[(?!%d:)(.*?)\])'%n)  # Reference
+    # Link reference and definition patterns.  The reference pattern finds
+    # the '][' between the label and id of a reference that isn't already
+    # namespaced.
+    p1 = re.compile(r'\]\[(?!%d:)'%n)                   # Reference
     p2 = re.compile(r'^\[(?!\^)(.*?)\]:')              # Definition
 
     # Footnote reference and definition patterns
@@ -50,23 +73,26 @@ def process(lines, meta, n):
     cutpoint = False  # Flags that a cut point was found
     lastline = None   # Track the last line
     innote = False    # Flags we are in a footnote definition
-    out = []          # The list of processed lines
 
-    # Read, process, and store each line
+    # Read, process, and generate each line
     for line in lines:
 
-        # Use the number n to give links a namespace
-        while p1.search(line):
-            old, a, b = p1.search(line).groups()
-            new = '[%s][%d:%s]'%(a, n, b)
-            line = line.replace(old, new)
-        if p2.search(line):
-            a = p2.search(line).groups()[0]
-            line = p2.sub('[%d:%s]:'%(n, a), line)
+        # Use the number n to give links a namespace.  A reference is
+        # '[label][id]', where the label may itself contain brackets.  Every
+        # '][' with a '[' somewhere before it and a ']' somewhere after it is
+        # namespaced, and so this is done in one pass over the text between
+        # the first '[' and the last ']'.
+        first, last = line.find('['), line.rfind(']')
+        if first != -1 and last > first:
+            line = line[:first+1] + p1.sub('][%d:'%n, line[first+1:last]) + \
+              line[last:]
+        m = p2.search(line) if line.startswith('[') else None
+        if m:
+            # Expand the template as re.sub() would
+            line = m.expand('[%d:%s]:'%(n, m.group(1))) + line[m.end():]
 
         # Strip footnote references
-        if p3.search(line):
-            a = p3.search(line).groups()[0]
+        if '[^' in line:
             line = p3.sub('', line)
 
         # Check for a cut point
@@ -78,141 +104,384 @@ def process(lines, meta, n):
         if innote:
             if lastline.strip() == '' and line and not line.startswith('    '):
                 innote = False
-        elif p4.search(line):
+        elif line.startswith('[^') and p4.search(line):
             innote = True
 
-        # Store the line.  Ignore all footnotes, and ignore markdown after
+        # Generate the line.  Ignore all footnotes, and ignore markdown after
         # <!-- cut --> except for link references.
         if (not innote and not cutpoint) or p2.search(line):
-            out.append(line)
+            yield line
 
         # Remember the last line
         lastline = line
 
     # Add a 'Read more...' link if <!-- cut --> was found.
     if cutpoint:
-        out.append('\n[Read more...](%s)\n'%meta['permalink'])
+        yield '\n[Read more...](%s)\n'%meta['permalink']
+
+
+def pandoc(text, template_path, plink, quoted_plink):
+    """Returns the html that pandoc produces for the markdown text.  Raises
+    subprocess.CalledProcessError if pandoc fails."""
+    return subprocess.run(traced(['pandoc', '-s'] + PANDOCFORMAT +
+                                 ['--template', template_path,
+                                  '-M', 'permalink=' + plink,
+                                  '-M', 'quoted-permalink=' + quoted_plink]),
+                          input=text.encode('utf-8'),
+                          stdout=subprocess.PIPE, check=True) \
+                     .stdout.decode('utf-8')
+
+
+def render(key, text, template_path, plink, quoted_plink):
+    """Renders the markdown text with pandoc and caches the html under key.
+    Returns the html.  Nothing is cached if pandoc fails."""
+    with slot():
+        html = pandoc(text, template_path, plink, quoted_plink)
+    putfragment(key, html)
+    return html
+
+
+def entrykey(path, meta, n, mode, template):
+    """Returns the fragment cache key for the n-th entry at path.
+
+    The html for an entry doesn't depend on its position in a composed
+    page (the link namespace doesn't appear in the output) except for the
+    first entry, and so the same key is used for an entry in every
+    composed page that lists it.
+
+    mode - the compose mode ('entry' or 'batch'), or 'python' for entries
+           rendered in process
+    template - the processed entry template lines
+    """
+    with open(path, 'rb') as f:
+        source = f.read()
+    version = markdownversion() if mode == 'python' else pandocversion()
+    return digest(mode, source, json.dumps(meta, sort_keys=True),
+                  str(n == 0), ''.join(template), version)
+
+
+def renderentry(path, meta, lines, n, template, parsed):
+    """Returns the html for the n-th entry, read from the .md file at path,
+    if it is rendered in process (see render.py).  Returns None if the
+    entry needs pandoc.  The html is taken from the fragment cache where
+    possible.
+
+    lines - the list of processed content lines
+    template - the processed entry template lines
+    parsed - the parsed entry template, or None
+    """
+    text = ''.join(lines)
+    if choose(meta, text, parsed) != 'python':
+        return None
+    key = entrykey(path, meta, n, 'python', template)
+    html = getfragment(key)
+    if html is None:
+        plink = meta['permalink']
+        extra = {'permalink': plink,
+                 'quoted-permalink':
+                   urllib.parse.quote(plink).replace('/', '%2F')}
+        html = renderpython(meta, text, parsed, extra)
+        putfragment(key, html)
+    return html
+
+
+def entry(path, n):
+    """Returns the (meta, lines) for the n-th entry, read from the .md file
+    at path.  The lines are generated as they are read.  The first entry is
+    also preprocessed, in memory."""
+
+    assert path.startswith('markdown/') and path.endswith('.md')
+
+    # Get various types of links
+    relurl = path[8:-3] + '.html'
+    plink = permalink(relurl)
+
+    # Renew the entry's metadata
+    meta = getmeta(path)
+    meta['rel-url'] = relurl
+    meta['permalink'] = plink
+
+    # Flag the first entry in the metadata
+    if n == 0:
+        meta['first-entry'] = 'True'
+    elif 'first-entry' in meta:
+        del meta['first-entry']
+
+    # Process the entry's content
+    lines = process(itercontent(path), meta, n)
 
-    # Return the processed lines
-    return out
+    # Preprocess the first entry
+    if n == 0:
+        lines = applyflags(meta, list(lines))
 
+    return meta, lines
 
-def content_writer():
-    """Writes the processed content of a .md file to stdout.
+
+def content_writer(queue, executor, tmpdir, template, parsed=None):
+    """Queues the processed content of a .md file for output.
 
     Use it this way:
 
-      writer = content_writer()
+      writer = content_writer(queue, executor, tmpdir, template, parsed)
       next(writer)
       writer.send('/path/to/file.md')
 
-    Send as many paths as you want.
-
-    The content is processed internally and by pandoc (via a system call).
-    The output is html.  For any subsequent processing with pandoc, don't
-    forget to turn off its markdown_in_html_blocks extension.
+    Send as many paths as you want.  The queue is a deque that collects
+    strings and futures for the html; see flush().  The entry template is
+    written to tmpdir for pandoc.  The template is the list of processed entry
+    template lines, and parsed is the parsed template (or None if it
+    can't be parsed).
+
+    The content is processed internally, and then rendered in process or
+    by pandoc (via a system call in the executor).  The html is taken from
+    the fragment cache where possible.  For any subsequent processing with
+    pandoc, don't forget to turn off its markdown_in_html_blocks
+    extension.
     """
 
-    # Process the entry template with pandoc-tpp and write it to a
-    # temporary file.  Remove leading spaces so that this can be written into
-    # a markdown file.
-    lines = pandoc_tpp.preprocess('templates/entry.html5')
-    with tempfile.NamedTemporaryFile(mode='w+', suffix='.html5',
-                                     delete=False) as f:
-        template_path = f.name
-        f.writelines(lines)
+    # Write the entry template to a temporary file
+    template_path = os.path.join(tmpdir, 'entry.html5')
+    with open(template_path, 'w') as f:
+        f.writelines(template)
 
     # Keep track of the number of files processed
     n = 0
 
     while True:
 
-        # Get the path to the next entry
+        # Get the next entry
         path = yield
-        assert path.startswith('markdown/')
-
-        # Get various types of links
-        relurl = path[8:-3] + '.html'
-        plink = permalink(relurl)
-        quoted_plink = urllib.parse.quote(plink).replace('/', '%2F')
-
-        # Renew the entry's metadata
-        meta = getmeta(path)
-        meta['rel-url'] = relurl
-        meta['permalink'] = plink
-
-        # Flag the first entry in the metadata
-        if n == 0:
-            meta['first-entry'] = 'True'
-        elif 'first-entry' in meta:
-            del meta['first-entry']
-
-        # Process the entry's content
-        lines = process(getcontent(path), meta, n)
-
-        # Write the markdown to a temporary file
-        with tempfile.NamedTemporaryFile(mode='w+', delete=False) as f:
-            tmppath1 = f.name
-            writemeta(meta, f=f)
-            writelines(lines, f=f)
+        meta, lines = entry(path, n)
+        lines = list(lines)
 
-        # Preprocess the temporary file if this is the first entry
-        if n==0:
-            with tempfile.NamedTemporaryFile(mode='w+', delete=False) as f:
-                tmppath2 = f.name
-                subprocess.call(['bcms', 'preprocess', tmppath1], stdout=f)
-        else:
-            tmppath2 = tmppath1
-        
         # Write a horizontal rule between files
         if n != 0:
-            write('\n<hr />\n')
+            queue.append('\n<hr />\n')
 
         # Start the new entry
-        write('\n')
-        write('<div id="entry-%d">\n'%n)
-
-        # Process the markdown with pandoc, writing the output to stdout
-        STDOUT.flush()
-        assert path.startswith('markdown/') and path.endswith('.md')
-        subprocess.call(['pandoc',  tmppath2,
-                         '-s',
-                         '-f', 'markdown+smart+markdown_attribute',
-                         '-t', 'html5',
-                         '--email-obfuscation', 'none',
-                         '--template', template_path,
-                         '-M', 'permalink=' + plink,
-                         '-M', 'quoted-permalink=' + quoted_plink])
-        STDOUT.flush()
-
-        write('</div> <!-- id="entry-%d" -->\n'%n)
+        queue.append('\n')
+        queue.append('<div id="entry-%d">\n'%n)
+
+        # Render the markdown in process if we can.  Otherwise process it
+        # with pandoc, unless the html is cached.
+        html = renderentry(path, meta, lines, n, template, parsed)
+        if html is None:
+            key = entrykey(path, meta, n, 'entry', template)
+            html = getfragment(key)
+        if html is None:
+            # Assemble the markdown.  Numbered titles are obfuscated for
+            # preprocessed entries only, as was always done.
+            f = io.StringIO()
+            writemeta(meta, f=f, obfuscate=(n == 0))
+            writelines(lines, f=f)
+            plink = meta['permalink']
+            quoted_plink = urllib.parse.quote(plink).replace('/', '%2F')
+            queue.append(executor.submit(render, key, f.getvalue(),
+                                         template_path, plink, quoted_plink))
+        else:
+            queue.append(html)
+
+        queue.append('</div> <!-- id="entry-%d" -->\n'%n)
 
         # Increment the counter
         n += 1
 
 
+def renderbatch(entries, template):
+    """Renders the entries with a single call to pandoc.
+
+    entries - a list of (meta, lines, future, key) tuples; the html for
+              each entry is given to its future and cached under key
+    template - the parsed entry template
+
+    The markdown for all of the entries is joined into one document, with
+    comments marking where each entry's title and body begin.  The link
+    namespacing done by process() keeps the entries from colliding.  The
+    pandoc output is split at the markers and the entry template filled in
+    for each.
+    """
+
+    # Assemble the document.  Periods in numbered titles are escaped so
+    # that pandoc doesn't take them for lists.
+    doc = []
+    for n, (meta, lines, _, _) in enumerate(entries):
+        title = re.sub(r'^(\d+)\. ', r'\1\\. ', meta.get('title', ''))
+        doc.append('\n<!-- bcms-title-%d -->\n\n%s\n' % (n, title))
+        doc.append('\n<!-- bcms-body-%d -->\n\n' % n)
+        doc.extend(lines)
+        doc.append('\n')
+
+    html = subprocess.run(traced(['pandoc'] + PANDOCFORMAT),
+                          input=''.join(doc).encode('utf-8'),
+                          stdout=subprocess.PIPE, check=True) \
+                     .stdout.decode('utf-8')
+
+    # Split the html into the titles and bodies
+    parts = BATCHMARKER.split(html)
+    rendered = {(int(parts[i+1]), parts[i]): parts[i+2].strip()
+                for i in range(1, len(parts), 3)}
+
+    # Fill in the template for each entry
+    for n, (meta, _, future, key) in enumerate(entries):
+        variables = {k: htmllib.escape(v, quote=False)
+                     for k, v in meta.items()}
+        variables['quoted-permalink'] = \
+          urllib.parse.quote(meta['permalink']).replace('/', '%2F')
+        variables['title'] = PARAGRAPH.sub(r'\1', rendered[n, 'title'])
+        variables['body'] = rendered[n, 'body']
+        html = template_render(template, variables) + '\n'
+        putfragment(key, html)
+        future.set_result(html)
+
+
+def batch_writer(queue, entries, template, parsed):
+    """Queues the processed content of a .md file for batch output.
+
+    This works like content_writer(), except the entries that aren't in
+    the fragment cache and need pandoc are collected for renderbatch().
+    Their futures in the queue are resolved once it is called.
+    """
+
+    n = 0
+
+    while True:
+
+        # Get the next entry
+        path = yield
+        meta, lines = entry(path, n)
+        lines = list(lines)
+
+        # Write a horizontal rule between files
+        if n != 0:
+            queue.append('\n<hr />\n')
+
+        # Queue the entry
+        html = renderentry(path, meta, lines, n, template, parsed)
+        if html is None:
+            key = entrykey(path, meta, n, 'batch', template)
+            html = getfragment(key)
+        queue.append('\n')
+        queue.append('<div id="entry-%d">\n'%n)
+        if html is None:
+            future = concurrent.futures.Future()
+            queue.append(future)
+            entries.append((meta, lines, future, key))
+        else:
+            queue.append(html)
+        queue.append('</div> <!-- id="entry-%d" -->\n'%n)
+
+        # Increment the counter
+        n += 1
+
+
+def flush(queue, jobs=0):
+    """Writes the queued strings and rendered html to stdout, in order.
+
+    jobs - the number of renders that may be left pending in the queue
+
+    Writing stops at the first render that is still pending, unless there
+    are more than jobs of them; then we wait.  Use jobs=0 to write
+    everything.
+    """
+    while queue:
+        if isinstance(queue[0], concurrent.futures.Future):
+            pending = sum(1 for item in queue
+                          if isinstance(item, concurrent.futures.Future))
+            if pending <= jobs and not queue[0].done():
+                break
+            write(queue.popleft().result())
+        else:
+            write(queue.popleft())
+
+
+def isentry(line):
+    """Returns True if the .md.in line names an entry."""
+    return line.strip().endswith('.md') and os.path.isfile(line.strip())
+
+
+def pagelinks(path, page, pages):
+    """Returns the html navigation links for the given page of the .md.in
+    file at path."""
+    links = []
+    if page > 1:
+        links.append('<a href="/%s.html">Newer entries</a>' %
+                     pagename(path, page-1))
+    if page < pages:
+        links.append('<a href="/%s.html">Older entries</a>' %
+                     pagename(path, page+1))
+    return '\n<p class="pagination">%s</p>\n' % ' '.join(links)
+
+
 def compose(args):
-    """Composes the .md.in file at path."""
+    """Composes the .md.in file at path.
+
+    The output is streamed.  The .md.in file and its entries are read a line
+    at a time, and each entry is written as soon as it is rendered.  Only a
+    bounded number of entries are held in memory at once.
+    """
 
     path = args.path
+    page = args.page
+    jobs = getjobs(args.jobs)
 
     assert path.startswith('markdown/') and path.endswith('.md.in')
-    
+
+    # Process the entry template with pandoc-tpp.  Batch mode and the
+    # in-process renderer need a template that we can fill in ourselves.
+    template = pandoc_tpp.preprocess('templates/entry.html5')
+    try:
+        parsed = template_parse(template)
+    except ValueError as e:
+        parsed = None
+        if args.batch:
+            write('%s; composing without --batch.\n' % e, STDERR)
+
     meta = getmeta(path)
     meta['no-social'] = 'True'
     meta['rss-url'] = path[8:].replace('.md.in', '.xml')
     writemeta(meta)
 
-    # Read the lines of the .md.in file
-    lines = getcontent(path)
-
-    # Process the lines
-    writer = content_writer()
-    next(writer)
-    for line in lines:
-        # If a filename is given then write the file (subject to some
-        # processing); otherwise, write the line as-is.
-        if line.strip().endswith('.md') and os.path.isfile(line.strip()):
-            writer.send(line.strip())
-        else:
-            write(line)
+    # Paginated files are split into pages of size entries.  Lines before
+    # the first entry are written on every page.  Other lines are written on
+    # the page of the entry before them.
+    size = pagesize(path)
+    first, last = ((page-1)*size, page*size) if size else (0, None)
+
+    # Process the lines.  Entries that need pandoc are rendered by up to
+    # jobs pandoc processes at a time, or BATCHSIZE at a time in batch mode;
+    # the others are rendered in process.  The output order is preserved.
+    queue = collections.deque()
+    entries = []
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir, \
+          concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            if parsed is None or not args.batch:
+                writer = content_writer(queue, executor, tmpdir, template,
+                                        parsed)
+            else:
+                writer = batch_writer(queue, entries, template, parsed)
+                jobs = BATCHSIZE  # Nothing gets rendered until a batch is full
+            next(writer)
+            count = 0    # The number of entries seen
+            keep = True  # Flags that lines are on this page
+            for line in itercontent(path):
+                # If a filename is given then write the file (subject to some
+                # processing); otherwise, write the line as-is.
+                if isentry(line):
+                    keep = first <= count and (last is None or count < last)
+                    count += 1
+                    if keep:
+                        writer.send(line.strip())
+                elif keep:
+                    queue.append(line)
+                if len(entries) == BATCHSIZE:
+                    renderbatch(entries, parsed)
+                    entries.clear()
+                flush(queue, jobs)
+            if entries:
+                renderbatch(entries, parsed)
+            if size and count > size:
+                queue.append(pagelinks(path, page, -(-count // size)))
+            flush(queue)
+    except subprocess.CalledProcessError as e:
+        error('pandoc failed.', e.returncode)
@@ -0,0 +1,219 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""compress.py - writes precompressed siblings for the files in www/.
+
+Each text file (html, css, javascript, feeds, ...) in www/ gets a .gz
+sibling, and a .br sibling if brotli is available (either the brotli
+python module or the brotli command).  Static servers such as nginx
+(gzip_static, brotli_static) and 'bcms serve' send these in place of the
+originals.  Siblings that wouldn't be smaller aren't written.
+
+The manifest in .bcms/compress.json records the stamp and content digest
+of each file along with the siblings made from it.  A file is only
+compressed again when its content changes.  Servers can use the manifest
+to check that a sibling was made from the current file.
+"""
+
+import concurrent.futures
+import glob
+import gzip
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+
+from bassclef.util import cachepath, digest, readjson, writejson, getjobs, \
+     write
+from bassclef.cache import locked
+
+
+# Extensions of the files that are worth compressing
+COMPRESSIBLE = ['.html', '.css', '.js', '.xml', '.json', '.svg', '.txt',
+                '.map', '.ico', '.ttf', '.otf', '.eot']
+
+# Files smaller than this (in bytes) aren't worth compressing
+MINSIZE = 256
+
+# Sibling extensions keyed by content encoding
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+
+def manifestpath():
+    """Returns the path to the manifest."""
+    return cachepath('compress.json')
+
+
+def readmanifest():
+    """Returns the manifest dict, keyed by path.  Each entry is [stamp,
+    digest, encodings], where stamp is the file's [mtime, size] and
+    encodings lists those of the siblings."""
+    return readjson(manifestpath(), {})
+
+
+def brotlicompressor():
+    """Returns a brotli compression function, or None if brotli isn't
+    available."""
+    try:
+        import brotli  # pylint: disable=import-outside-toplevel
+        return brotli.compress
+    except ImportError:
+        pass
+    if shutil.which('brotli'):
+        return lambda data: subprocess.run(['brotli', '-c', '-q', '11'],
+                                           input=data, stdout=subprocess.PIPE,
+                                           check=True).stdout
+    return None
+
+
+def compressors():
+    """Returns the compression functions keyed by content encoding."""
+    ret = {'gzip': lambda data: gzip.compress(data, 9, mtime=0)}
+    br = brotlicompressor()
+    if br:
+        ret['br'] = br
+    return ret
+
+
+def writebytes(path, data):
+    """Writes data to the file at path atomically."""
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmppath, path)
+
+
+def removesiblings(path, keep=()):
+    """Removes the siblings of the file at path, except for the encodings
+    to keep."""
+    for encoding, ext in ENCODINGS.items():
+        if encoding not in keep:
+            try:
+                os.remove(path + ext)
+            except FileNotFoundError:
+                pass
+
+
+def compressfile(path, data, funcs):
+    """Writes the siblings for the file at path with the given data.
+    Returns the encodings of the siblings written."""
+    encodings = []
+    for encoding, func in funcs.items():
+        compressed = func(data)
+        if len(compressed) < len(data):
+            writebytes(path + ENCODINGS[encoding], compressed)
+            encodings.append(encoding)
+    removesiblings(path, encodings)
+    return encodings
+
+
+def isuptodate(path, entry, encodings):
+    """Returns True if the siblings recorded in the manifest entry for the
+    file at path exist and are newer than it."""
+    mtime = entry[0][0]
+    for encoding in encodings:
+        try:
+            if os.stat(path + ENCODINGS[encoding]).st_mtime_ns < mtime:
+                return False
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def touch(path, encodings):
+    """Updates the mtimes of the siblings of the file at path so that they
+    are newer than it again.  Returns False if any are missing."""
+    try:
+        for encoding in encodings:
+            os.utime(path + ENCODINGS[encoding])
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def stamp(path):
+    """Returns the [mtime, size] of the file at path."""
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+def process(path, entry, funcs, force):
+    """Compresses the file at path if it has changed since the manifest
+    entry was made.  Returns (path, entry, written)."""
+    current = stamp(path)
+    if not force and entry and entry[0] == current and \
+      isuptodate(path, entry, entry[2]):
+        return path, entry, False
+    with open(path, 'rb') as f:
+        data = f.read()
+    h = digest(data)
+    if not force and entry and entry[1] == h and touch(path, entry[2]):
+        return path, [current, h, entry[2]], False
+    write('compress %s\n' % path)
+    return path, [current, h, compressfile(path, data, funcs)], True
+
+
+def targets():
+    """Returns the paths of the files in www/ that should be compressed."""
+    paths = []
+    for path in sorted(glob.glob('www/**/*', recursive=True)):
+        if os.path.splitext(path)[1].lower() in COMPRESSIBLE and \
+          os.path.isfile(path) and os.path.getsize(path) >= MINSIZE:
+            paths.append(path)
+    return paths
+
+
+def makesiblings(jobs, force=False):
+    """Writes the siblings for the files in www/ that changed, using a pool
+    of jobs workers.  Returns the number of files compressed."""
+
+    funcs = compressors()
+    manifest = {} if force else readmanifest()
+    paths = targets()
+
+    # Remove the siblings for files that are gone or too small now
+    for path in set(manifest) - set(paths):
+        removesiblings(path)
+        del manifest[path]
+
+    # zlib and brotli release the GIL while they work, and so threads are
+    # enough to keep the cores busy
+    n = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            futures = [executor.submit(process, path, manifest.get(path),
+                                       funcs, force)
+                       for path in paths]
+            for future in concurrent.futures.as_completed(futures):
+                path, entry, written = future.result()
+                manifest[path] = entry
+                n += written
+    finally:
+        writejson(manifest, manifestpath())
+
+    return n
+
+
+def compress(args):
+    """Writes precompressed siblings for the files in www/.  All of the
+    cores are used unless told otherwise."""
+    with locked():
+        n = makesiblings(getjobs(args.jobs, os.cpu_count()), args.force)
+    if not n:
+        write('Compressed files are up to date.\n')
@@ -23,12 +23,19 @@ SOURCE_CSS = $(wildcard css/*.css) $(wildcard css/*/*.css)
 
 # Destination files -----------------------------------------------------------
 
-DEST_CSS = $(patsubst css/%,$(OUT)/css/%,$(SOURCE_CSS))
+# Stylesheets that are bundled by the templates aren't copied; their bundles
+# are.  BUNDLES and BUNDLED are written by 'bcms makevars'.  See bundle.py.
+DEST_CSS = $(patsubst css/%,$(OUT)/css/%,\
+             $(filter-out $(BUNDLED),$(SOURCE_CSS)))
+DEST_CSS_BUNDLES = $(patsubst %,$(OUT)/%,$(filter css/%,$(BUNDLES)))
 
 
 # Build rules -----------------------------------------------------------------
 
-css: $(DEST_CSS)
+css: $(DEST_CSS) $(DEST_CSS_BUNDLES)
+
+$(OUT)/css/bundle-%: $(CACHE)/bundles/css/bundle-%
+	$(call copyfiles,$<,$@)
 
 $(OUT)/css/%: css/%
 	@if [ ! -d $(dir $@) ]; then mkdir -p $(dir $@); fi
@@ -38,4 +45,4 @@ $(OUT)/css/%: css/%
 # Targets ---------------------------------------------------------------------
 
 ALL += css
-CLEAN += $(DEST_CSS)
+CLEAN += $(DEST_CSS) $(DEST_CSS_BUNDLES)
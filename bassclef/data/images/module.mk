@@ -16,35 +16,25 @@
 #  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
 
 
-# Source files ----------------------------------------------------------------
-
-SOURCE_IMG = $(wildcard images/*.*) $(wildcard images/*/*.*)
-
-
-# Destination files -----------------------------------------------------------
-
-DEST_IMG = $(patsubst %,$(OUT)/%,$(SOURCE_IMG))
-DEST_ORIG = $(patsubst images/%,$(OUT)/images/originals/%,$(SOURCE_IMG))
-
-
 # Build rules -----------------------------------------------------------------
 
-GEOM = $(shell $(call getconfig,image-geometry))
-
-images: $(DEST_ORIG) $(DEST_IMG)
-
+# 'bcms images' works out which images are out of date itself, using a
+# manifest kept in the build cache directory.  See images.py.  It is run on
+# every build, but only rewrites the renditions file when the renditions
+# change.  The html pages are made from that file (see markdown/.module.mk),
+# and so they are only remade then.  The '+' shares make's job slots with
+# it; see jobserver.py.
+images: $(CACHE)/renditions.json
 
-$(OUT)/images/originals/%: images/%
-	@if [ ! -d $(dir $@) ]; then mkdir -p $(dir $@); fi
-	$(call copyfiles,$<,$@)
+$(CACHE)/renditions.json: FORCE
+	+@bcms images
 
+FORCE:
 
-$(OUT)/images/%: images/%
-	@if [ ! -d $(dir $@) ]; then mkdir -p $(dir $@); fi
-	$(CONVERT) $< -resize $(GEOM) -unsharp 0x1 $@
+.PHONY: FORCE
 
 
 # Targets ---------------------------------------------------------------------
 
 ALL += images
-CLEAN += $(DEST_IMG) $(DEST_ORIG)
+CLEAN += $(OUT)/images
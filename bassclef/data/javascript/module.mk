@@ -23,12 +23,19 @@ SOURCE_JS = $(wildcard javascript/*.js) $(wildcard javascript/*/*.js)
 
 # Destination files -----------------------------------------------------------
 
-DEST_JS = $(patsubst javascript/%,$(OUT)/javascript/%,$(SOURCE_JS))
+# Scripts that are bundled by the templates aren't copied; their bundles
+# are.  BUNDLES and BUNDLED are written by 'bcms makevars'.  See bundle.py.
+DEST_JS = $(patsubst javascript/%,$(OUT)/javascript/%,\
+            $(filter-out $(BUNDLED),$(SOURCE_JS)))
+DEST_JS_BUNDLES = $(patsubst %,$(OUT)/%,$(filter javascript/%,$(BUNDLES)))
 
 
 # Build rules -----------------------------------------------------------------
 
-javascript: $(DEST_JS)
+javascript: $(DEST_JS) $(DEST_JS_BUNDLES)
+
+$(OUT)/javascript/bundle-%: $(CACHE)/bundles/javascript/bundle-%
+	$(call copyfiles,$<,$@)
 
 $(OUT)/javascript/%: javascript/%
 	$(call copyfiles,$<,$@)
@@ -37,4 +44,4 @@ $(OUT)/javascript/%: javascript/%
 # Targets ---------------------------------------------------------------------
 
 ALL += javascript
-CLEAN += $(DEST_JS)
+CLEAN += $(DEST_JS) $(DEST_JS_BUNDLES)
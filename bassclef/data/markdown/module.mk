@@ -26,6 +26,11 @@ $(space) := $(space)
 comma := ,
 
 
+# Flags for 'bcms compose'.  Use --batch to render all of the entries of a
+# composed page with a single call to pandoc.
+COMPOSEFLAGS =
+
+
 # Source files ----------------------------------------------------------------
 
 SOURCE_MD_IN = $(wildcard markdown/*.md.in) $(wildcard markdown/*/*.md.in)
@@ -34,39 +39,48 @@ SOURCE_MD = $(wildcard markdown/*.md) $(wildcard markdown/*/*.md)
 
 # Destination files -----------------------------------------------------------
 
-DEST_MD = $(patsubst markdown/%.md.in,$(TMP)/%.md,$(SOURCE_MD_IN))
+# The composed markdown is kept in the build cache directory, and so is only
+# remade when its sources change
+COMPOSE_DEPS = $(SOURCE_MD) config.ini $(wildcard templates/*)
+DEST_MD = $(patsubst markdown/%.md.in,$(CACHE)/md/%.md,$(SOURCE_MD_IN)) \
+            $(foreach name,$(PAGED),\
+              $(foreach page,$(PAGES_$(name)),$(CACHE)/md/$(name)-$(page).md))
 DEST_HTML = $(patsubst markdown/%.md,$(OUT)/%.html,$(SOURCE_MD)) \
-              $(patsubst $(TMP)/%.md,$(OUT)/%.html,$(DEST_MD))
+              $(patsubst $(CACHE)/md/%.md,$(OUT)/%.html,$(DEST_MD))
 DEST_XML = $(patsubst markdown/%.md.in,$(OUT)/%.xml,$(SOURCE_MD_IN))
 
 
 # Functions -------------------------------------------------------------------
 
-# $(call makeflags,mdpath,htmlpath): Adds flags to PANDOCFLAGS
+# $(call makeflags,mdpath,htmlpath): Sets the RENDERFLAGS.  The per-page
+# variables are looked up from those written by 'bcms makevars'.
 define makeflags
-TEMPLATE = $(shell pandoc-tpp -t $(shell $(call getmeta,$(1),template)))
-RELLINK = $(patsubst $(WWW)/%,/%,$(2))
-PERMALINK = $$(shell $(PYTHON3) -c "from bassclef.util import permalink;\
-                                    print(permalink('$$(RELLINK)'))")
-QUOTED_PERMALINK = $$(shell $(PYTHON3) -c \
-    "from urllib.parse import quote; \
-     print(quote('$$(PERMALINK)').replace('/', '%2F'))")
-PANDOCFLAGS = -s \
-              -f markdown+smart+markdown_attribute \
-              -t html5 \
-              --email-obfuscation none
+TEMPLATE = $(TEMPLATE_$(2))
+PERMALINK = $(PERMALINK_$(2))
+QUOTED_PERMALINK = $(QUOTED_PERMALINK_$(2))
+RENDERFLAGS =
 ifneq ($$(TEMPLATE),)
-  PANDOCFLAGS += --template $$(TEMPLATE)
+  RENDERFLAGS += --template $$(TEMPLATE)
 endif
-PANDOCFLAGS += -M permalink=$$(PERMALINK)
-PANDOCFLAGS += -M quoted-permalink=$$(QUOTED_PERMALINK)
+RENDERFLAGS += -M permalink=$$(PERMALINK)
+RENDERFLAGS += -M quoted-permalink=$$(QUOTED_PERMALINK)
 endef
 
-# $(call md2html,src.md,dest.html): transforms markdown to html using pandoc
+# $(call pagerule,name,page): the rule for composing the given page of the
+# paginated file markdown/name.md.in.  The '+' here and below shares make's
+# job slots with 'bcms compose'; see jobserver.py.
+define pagerule
+$(CACHE)/md/$(1)-$(2).md: markdown/$(1).md.in $(COMPOSE_DEPS)
+	@if [ ! -d $$(dir $$@) ]; then mkdir -p $$(dir $$@); fi
+	+bcms compose $$(COMPOSEFLAGS) --page $(2) $$< > $$@
+endef
+
+# $(call md2html,src.md,dest.html): transforms markdown to html using the
+# renderer chosen for the page (see render.py)
 define md2html
 @if [ ! -d $(dir $(2)) ]; then mkdir -p $(dir $(2)); fi;
 $(eval $(call makeflags,$<,$@))
-bcms preprocess $(1) | $(PANDOC) $(PANDOCFLAGS) | bcms postprocess > $(2);
+bcms render $(RENDERFLAGS) $(1) | bcms postprocess -o $(2);
 endef
 
 
@@ -74,28 +88,36 @@ endef
 
 markdown: $(DEST_MD)
 
-$(TMP)/%.md: markdown/%.md.in $(SOURCE_MD)
+$(CACHE)/md/%.md: markdown/%.md.in $(COMPOSE_DEPS)
 	@if [ ! -d $(dir $@) ]; then mkdir -p $(dir $@); fi
-	bcms compose $< > $@
+	+bcms compose $(COMPOSEFLAGS) $< > $@
+
+$(foreach name,$(PAGED),\
+  $(foreach page,$(PAGES_$(name)),$(eval $(call pagerule,$(name),$(page)))))
 
 
 html: $(DEST_HTML)
 
-$(OUT)/%.html: $(TMP)/%.md
+# The image markup in the html is made from the image renditions file,
+# which is written by the images module
+$(OUT)/%.html: $(CACHE)/md/%.md $(CACHE)/renditions.json
 	$(call md2html,$<,$@)
 
-$(OUT)/%.html: markdown/%.md
+$(OUT)/%.html: markdown/%.md $(CACHE)/renditions.json
 	$(call md2html,$<,$@)
 
 
 rss: $(DEST_XML)
 
-$(OUT)/%.xml: markdown/%.md.in $(DEST_HTML)
+# Each feed also depends on the html for the entries it includes.  These
+# prerequisites are given in the variables written by 'bcms makevars', along
+# with the flags that write any Atom and JSON feeds in the same pass.
+$(OUT)/%.xml: markdown/%.md.in
 	@if [ ! -d $(dir $@) ]; then mkdir -p $(dir $@); fi
-	bcms feed $< > $@
+	bcms feed $(FEEDFLAGS_$@) $< > $@
 
 
 # Targets ---------------------------------------------------------------------
 
 ALL += markdown html
-CLEAN += $(DEST_MD) $(DEST_HTML) $(DEST_XML)
+CLEAN += $(DEST_HTML) $(DEST_XML) $(FEEDS)
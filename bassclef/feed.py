@@ -16,120 +16,267 @@
 #  You should have received a copy of the GNU General Public License
 #  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
 
-"""feed.py - creates an RSS 2 feed."""
+"""feed.py - creates RSS 2, Atom and JSON feeds.
+
+A feed includes the first entries listed in an .md.in file; there are ten
+unless feed-size is set in the file's metadata.  The entries are read
+lazily, so the rest of the listing is never touched, and each item is
+written out as soon as it is made.  The RSS feed is written to stdout.
+Atom and JSON feeds (see feed-formats in the README) are written from the
+same pass over the items to the files given by --atom and --json.
+"""
 
-import os
 import datetime
+import email.utils
+import json
+import os
+import re
 
-import PyRSS2Gen as rss2
+from xml.sax.saxutils import escape, quoteattr
 
-from bassclef.util import getmeta, getcontent, write, permalink
+from bassclef.util import getmeta, write, permalink, STDOUT
+from bassclef.makevars import htmlpath, iterfeedentries, FEEDEXTS
+from bassclef.cache import getbody
+from bassclef.postprocess import content_body
 
 from html.entities import codepoint2name
 
 
+# Html entities keyed by character.  The html markup characters are left
+# alone, and so only non-ascii characters need encoding.
+ENTITIES = {chr(codepoint): '&%s;' % name
+            for codepoint, name in codepoint2name.items()
+            if chr(codepoint) not in '<>"&'}
+NONASCII = re.compile('[^\x00-\x7f]')
+
+# Date formats tried for the date metadata, after RFC 822
+DATEFORMATS = ['%Y-%m-%d', '%d %B %Y', '%B %d, %Y', '%d %b %Y',
+               '%b %d, %Y']
+
+# The JSON Feed version
+JSONFEED = 'https://jsonfeed.org/version/1.1'
+
+
 def encode(txt):
     """Encodes UTF-8 characters with html entities."""
-    skip = ['<', '>', '"', '&']
-    ret = ''
-    for c in txt:
-        if c not in skip and ord(c) in codepoint2name:
-            ret += "&" + codepoint2name.get(ord(c)) + ";"
-        else:
-            ret += c
-    return ret
-
+    return NONASCII.sub(lambda m: ENTITIES.get(m.group(), m.group()), txt)
 
-def get_content_body(htmlpath):
-    """Returns lines for the content-body of an html file.
 
-    This function searches for the following markers and returns everything
-    in between except for the social widgets:
+def get_content_body(path):
+    """Returns the content-body of the html file at path.
 
-      <div class="content-body">
-      </div> <!-- class="content-body" -->
+    The body stored when the page was postprocessed is used if it is up to
+    date.  Otherwise it is scraped from the page.
     """
-
-    # Read and process each line
-    with open(htmlpath) as f:
-        lines = []
-        inbody = False    # Flags when we are in the content-body
-        insocial = False  # Flags when we are in the social widget html
-        for line in f:
-            if '<div class="content-body">' in line:
-                inbody = True
-            if inbody:
-                if '<div class="social">' in line:
-                    insocial = True
-                if not insocial:
-                    lines.append(line)
-                if '</div> <!-- class="social" -->' in line:
-                    insocial = False
-            if '</div> <!-- class="content-body" -->' in line:
-                return '\n'.join(lines)
-
-    raise RuntimeError('content-body not found')
+    body = getbody(path)
+    if body is None:
+        with open(path) as f:
+            body = content_body(f)
+    if body is None:
+        raise RuntimeError('content-body not found')
+    return body
+
+
+def parsedate(txt):
+    """Returns the date in txt as a timezone-aware datetime, or None if it
+    can't be parsed.  Dates without a timezone are taken to be UTC."""
+    try:
+        date = email.utils.parsedate_to_datetime(txt)
+    except (TypeError, IndexError, ValueError):
+        date = None
+    for fmt in DATEFORMATS:
+        if date:
+            break
+        try:
+            date = datetime.datetime.strptime(txt, fmt)
+        except ValueError:
+            pass
+    if date and date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
 
 
 def make_item(path):
-    """Makes an item from .md file at path and its associated .html file."""
+    """Makes an item dict from .md file at path and its associated .html
+    file."""
 
     assert path.startswith('markdown/') and path.endswith('.md')
 
     # Read and process the .md file
     meta = getmeta(path)
 
-    # Get the permalink and guid
-    plink = permalink(path[8:].replace('.md', '.html'))
-    guid = rss2.Guid(plink)
-
-    # Get the metadata
-    pubdate = meta['date'] if 'date' in meta else None
-    author = meta['author'] if 'author' in meta else None
-    publisher = meta['publisher'] if 'publisher' in meta else None
-    source = meta['source'] if 'source' in meta else None
-
-    # Construct the item source
-    source = rss2.Source(publisher, source) if publisher and source else None
-
-    # Get the html body
-    path = path.replace('.md', '.html')
-    path = path.replace('markdown', 'www')
-    description = encode(get_content_body(path))
-
-    # Style the figure caption
-    description = description.replace('<figcaption>',
-                                      '<figcaption style="font-size: 80%;">')
-
-    return rss2.RSSItem(title=meta['title'], link=plink, pubDate=pubdate,
-                        author=author, source=source, description=description,
-                        guid=guid)
+    # Get the html body, and style the figure caption
+    html = htmlpath(path)
+    body = get_content_body(html)
+    body = body.replace('<figcaption>', '<figcaption style="font-size: 80%;">')
+
+    # Atom requires a date for each entry.  The page's modification time is
+    # used if the date metadata is missing or can't be parsed.
+    pubdate = str(meta['date']) if 'date' in meta else None
+    date = parsedate(pubdate) if pubdate else None
+    updated = date or datetime.datetime.fromtimestamp(
+        os.path.getmtime(html), datetime.timezone.utc)
+
+    return {'title': meta['title'],
+            'link': permalink(path[8:].replace('.md', '.html')),
+            'pubdate': pubdate,
+            'date': date,
+            'updated': updated,
+            'author': meta.get('author'),
+            'publisher': meta.get('publisher'),
+            'source': meta.get('source'),
+            'body': body}
+
+
+def element(name, text, attrs=None):
+    """Returns an xml element with the given text and attributes dict."""
+    attrs = ''.join(' %s=%s' % (k, quoteattr(v))
+                    for k, v in (attrs or {}).items())
+    if text is None:
+        return '<%s%s/>' % (name, attrs)
+    return '<%s%s>%s</%s>' % (name, attrs, escape(text), name)
+
+
+# Feed writers.  Each is a coroutine that writes the start of the feed for
+# the channel dict to f, then an item for each item dict sent to it, and
+# the end of the feed when it is closed.
+
+def rsswriter(f, channel):
+    """Writes an RSS 2 feed.  The xml is the same, byte for byte, as
+    PyRSS2Gen's, which bassclef used before."""
+    write('<?xml version="1.0" encoding="iso-8859-1"?>\n'
+          '<rss version="2.0"><channel>' +
+          element('title', channel['title'] or '') +
+          element('link', channel['link']) +
+          element('description', channel['subtitle']) +
+          element('lastBuildDate', email.utils.format_datetime(
+              channel['updated'], usegmt=True)), f)
+    try:
+        while True:
+            item = yield
+            parts = [element('title', item['title']),
+                     element('link', item['link']),
+                     element('description', encode(item['body']))]
+            if item['author']:
+                parts.append(element('author', item['author']))
+            parts.append(element('guid', item['link'],
+                                 {'isPermaLink': 'true'}))
+            if item['pubdate']:
+                parts.append(element('pubDate', item['pubdate']))
+            if item['publisher'] and item['source']:
+                parts.append(element('source', item['publisher'],
+                                     {'url': item['source']}))
+            write('<item>%s</item>' % ''.join(parts), f)
+    except GeneratorExit:
+        write('</channel></rss>', f)
+
+
+def atomwriter(f, channel):
+    """Writes an Atom feed."""
+    write('<?xml version="1.0" encoding="utf-8"?>\n'
+          '<feed xmlns="http://www.w3.org/2005/Atom">' +
+          element('title', channel['title']) +
+          (element('subtitle', channel['subtitle'])
+           if channel['subtitle'] else '') +
+          element('link', None, {'href': channel['link']}) +
+          element('link', None, {'rel': 'self',
+                                 'href': channel['urls']['atom']}) +
+          element('id', channel['link']) +
+          element('updated', channel['updated'].isoformat()), f)
+    try:
+        while True:
+            item = yield
+            parts = [element('title', item['title']),
+                     element('link', None, {'href': item['link']}),
+                     element('id', item['link']),
+                     element('updated', item['updated'].isoformat())]
+            if item['date']:
+                parts.append(element('published', item['date'].isoformat()))
+            if item['author']:
+                parts.append('<author>%s</author>' %
+                             element('name', item['author']))
+            parts.append(element('content', item['body'], {'type': 'html'}))
+            write('<entry>%s</entry>' % ''.join(parts), f)
+    except GeneratorExit:
+        write('</feed>\n', f)
+
+
+def jsonwriter(f, channel):
+    """Writes a JSON feed."""
+    head = {'version': JSONFEED,
+            'title': channel['title'],
+            'home_page_url': channel['link'],
+            'feed_url': channel['urls']['json']}
+    if channel['subtitle']:
+        head['description'] = channel['subtitle']
+    # Leave the items list open
+    write(json.dumps(head, ensure_ascii=False)[:-1] + ', "items": [', f)
+    sep = ''
+    try:
+        while True:
+            item = yield
+            entry = {'id': item['link'],
+                     'url': item['link'],
+                     'title': item['title'],
+                     'content_html': item['body']}
+            if item['date']:
+                entry['date_published'] = item['date'].isoformat()
+            if item['author']:
+                entry['authors'] = [{'name': item['author']}]
+            write(sep + json.dumps(entry, ensure_ascii=False), f)
+            sep = ', '
+    except GeneratorExit:
+        write(']}\n', f)
+
+
+# Feed writers keyed by format
+WRITERS = {'rss': rsswriter, 'atom': atomwriter, 'json': jsonwriter}
 
 
 def feed(args):
-    """Makes a feed from an .md.in file."""
+    """Makes the feeds for an .md.in file."""
 
     path = args.path
 
+    # The feeds to write, keyed by format
+    outputs = {'rss': '-', 'atom': args.atom, 'json': args.json}
+    outputs = {fmt: dest for fmt, dest in outputs.items() if dest}
+
     # Extract the metadata fields we need
     meta = getmeta(path)
-    title = meta['rsstitle'] if 'rsstitle' in meta else None
-    subtitle = meta['subtitle'] if 'subtitle' in meta else ''
-
-    # Get the first ten RSS items from file listing at path
-    lines = getcontent(path)
-    items = [make_item(line.strip()) for line in lines \
-             if line.strip().endswith('.md') and \
-             os.path.isfile(line.strip())][:10]
-
-    # Create the RSS
-    rss = rss2.RSS2(generator=None,
-                    docs=None,
-                    title=title,
-                    link=permalink(path[8:].replace('.md.in', '.html')),
-                    description=subtitle,
-                    lastBuildDate=datetime.datetime.now(),
-                    items=items)
-
-    # Write it out
-    write(rss.to_xml())
+    name = path[8:-6]
+    channel = {'title': meta['rsstitle'] if 'rsstitle' in meta else None,
+               'subtitle': meta['subtitle'] if 'subtitle' in meta else '',
+               'link': permalink(name + '.html'),
+               'updated': datetime.datetime.now(datetime.timezone.utc),
+               'urls': {fmt: permalink(name + ext)
+                        for fmt, ext in FEEDEXTS.items()}}
+
+    files, writers = [], []
+    try:
+        for fmt, dest in outputs.items():
+            # pylint: disable=consider-using-with
+            f = STDOUT if dest == '-' else open(dest, 'w', encoding='utf-8')
+            files.append((f, dest))
+            writers.append(WRITERS[fmt](f, channel))
+            next(writers[-1])
+
+        # Make each item once, for all of the feeds
+        for entry in iterfeedentries(path):
+            item = make_item(entry)
+            for writer in writers:
+                writer.send(item)
+        for writer in writers:
+            writer.close()
+
+    except BaseException:
+        # Don't leave partial feeds behind
+        for f, dest in files:
+            if dest != '-':
+                f.close()
+                os.remove(dest)
+        raise
+
+    for f, dest in files:
+        if dest != '-':
+            f.close()
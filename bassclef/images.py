@@ -0,0 +1,243 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""images.py - resizes and copies the site's images.
+
+Each image in images/ is copied to www/images/originals/ and resized (as
+set by image-geometry in config.ini) to www/images/.  Optionally, extra
+widths for srcset (image-widths) and extra formats such as webp and avif
+(image-formats) are written alongside, e.g., for images/photo.jpg:
+
+  www/images/photo.jpg           www/images/photo.jpg.webp
+  www/images/photo-480w.jpg      www/images/photo-480w.jpg.webp
+
+Every rendition is made in the build cache directory under a key that is a
+digest of the image content and the conversion, and then copied into www/.
+The cache survives 'bcms make clean', and so a clean build only copies
+files.  The manifest of sources, outputs and image dimensions is kept in
+.bcms/images.json.  The renditions of each image, from which the pages'
+image markup is made (see postprocess.py), are kept apart from it in
+.bcms/renditions.json.  That file is only rewritten when the renditions
+change, and so the Makefile only remakes the pages then.
+"""
+
+import concurrent.futures
+import glob
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+
+from bassclef.util import getconfig, cachepath, digest, readjson, writejson, \
+     getjobs, write, error
+from bassclef.makevars import outdir
+from bassclef.cache import locked, evict
+from bassclef.trace import traced
+from bassclef.jobserver import slot
+
+
+def settings():
+    """Returns the (geometry, widths, formats) image settings from
+    config.ini."""
+    config = getconfig()
+    widths = [int(w) for w in config.get('image-widths', '').split()]
+    formats = config.get('image-formats', '').lower().split()
+    return config['image-geometry'], widths, formats
+
+
+def renditions(src, geometry, widths, formats):
+    """Returns (path, geometry, format) tuples for the renditions of the
+    image at src.  Paths are relative to the output directory.  A geometry
+    of None is a copy; a format of None keeps the original format."""
+    rel = src[7:]  # Strip 'images/'
+    stem, ext = os.path.splitext(rel)
+    ret = [('images/originals/' + rel, None, None)]
+    sized = [('images/' + rel, geometry)]
+    sized += [('images/%s-%dw%s' % (stem, w, ext), '%dx>' % w)
+              for w in widths]
+    for path, geom in sized:
+        ret.append((path, geom, None))
+        ret += [(path + '.' + fmt, geom, fmt) for fmt in formats]
+    return ret
+
+
+def convert(src, dest, geometry):
+    """Converts the image at src to dest (whose extension gives the format)
+    with the given geometry.  The file is replaced atomically."""
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(dest),
+                                   suffix=os.path.splitext(dest)[1])
+    os.close(fd)
+    command = ['convert', src, '-resize', geometry, '-unsharp', '0x1',
+               tmppath]
+    try:
+        subprocess.check_call(traced(command))
+    except BaseException:
+        os.remove(tmppath)
+        raise
+    os.replace(tmppath, dest)
+
+
+def dimensions(path):
+    """Returns the [width, height] of the image at path, or None if it
+    can't be determined."""
+    try:
+        output = subprocess.check_output(traced(['identify', '-format',
+                                                  '%w %h', path + '[0]']),
+                                         stderr=subprocess.DEVNULL)
+        return [int(v) for v in output.split()[:2]]
+    except (OSError, ValueError, subprocess.CalledProcessError):
+        return None
+
+
+def render(src, key, geometry, cached):
+    """Makes the rendition of the image at src with the given geometry at
+    the cached path.  Returns (key, dimensions)."""
+    write('convert %s -resize %s -unsharp 0x1 %s\n' % (src, geometry, cached))
+    with slot():
+        convert(src, cached, geometry)
+        return key, dimensions(cached)
+
+
+def sourcehash(src, manifest):
+    """Returns the content digest for the image at src.  The digest stored
+    in the manifest is used if the file's mtime and size are unchanged."""
+    st = os.stat(src)
+    stamp = [st.st_mtime_ns, st.st_size]
+    stored = manifest['sources'].get(src)
+    if stored and stored[0] == stamp:
+        return stored[1]
+    with open(src, 'rb') as f:
+        h = digest(f.read())
+    manifest['sources'][src] = [stamp, h]
+    return h
+
+
+def stat(path):
+    """Returns the [mtime, size] of the file at path, or None."""
+    try:
+        st = os.stat(path)
+        return [st.st_mtime_ns, st.st_size]
+    except FileNotFoundError:
+        return None
+
+
+def renditionspath():
+    """Returns the path to the renditions file."""
+    return cachepath('renditions.json')
+
+
+def makeimages(jobs, force=False):
+    """Makes the renditions of all of the images that are out of date using
+    a pool of jobs convert processes.  Returns the number of outputs
+    written."""
+
+    geometry, widths, formats = settings()
+
+    manifestpath = cachepath('images.json')
+    manifest = readjson(manifestpath, {})
+    manifest = {'sources': manifest.get('sources', {}),
+                'outputs': {} if force else manifest.get('outputs', {}),
+                'dimensions': manifest.get('dimensions', {})}
+
+    # Work out what needs doing.  Each output is keyed by its source digest
+    # and conversion.  Renditions that aren't in the cache are rendered.
+    outputs = []  # (dest, key, cached) for each output
+    pending = {}  # Rendering arguments keyed by cache key
+    byimage = {}  # (path, format, key) renditions keyed by image
+    for src in sorted(glob.glob('images/**/*', recursive=True)):
+        if not os.path.isfile(src):
+            continue
+        h = sourcehash(src, manifest)
+        byimage[src[7:]] = []
+        for path, geom, fmt in renditions(src, geometry, widths, formats):
+            dest = outdir() + '/' + path
+            if geom is None:
+                outputs.append((dest, h, src))
+                continue
+            ext = '.' + fmt if fmt else os.path.splitext(src)[1]
+            key = digest(h, geom, fmt or '')
+            cached = cachepath('images', key[:2], key + ext)
+            outputs.append((dest, key, cached))
+            if key not in manifest['dimensions'] or \
+              not os.path.exists(cached):
+                pending[key] = (src, key, geom, cached)
+            byimage[src[7:]].append((path, fmt, key))
+
+    # Render in parallel
+    try:
+        with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+            futures = [executor.submit(render, *args)
+                       for args in pending.values()]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    key, dims = future.result()
+                    manifest['dimensions'][key] = dims
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    except subprocess.CalledProcessError as e:
+        writejson(manifest, manifestpath)
+        error('Command failed: %s' % ' '.join(e.cmd), e.returncode)
+
+    # Copy the outputs into place, skipping those that are already there
+    n = 0
+    for dest, key, cached in outputs:
+        if manifest['outputs'].get(dest) == [key, stat(dest)]:
+            continue
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        write('cp %s %s\n' % (cached, dest))
+        shutil.copyfile(cached, dest)
+        manifest['outputs'][dest] = [key, stat(dest)]
+        n += 1
+
+    # Forget about images that are gone
+    manifest['sources'] = {src: v for src, v in manifest['sources'].items()
+                           if src[7:] in byimage}
+    manifest['dimensions'] = {key: manifest['dimensions'][key]
+                              for _, key, _ in outputs
+                              if key in manifest['dimensions']}
+
+    writejson(manifest, manifestpath)
+
+    # Record the [path, format, [width, height]] renditions of each image,
+    # keyed by its path in images/.  The html pages are made from these,
+    # and so the file is only rewritten (and its mtime changed) when they
+    # change.
+    images = {rel: [[path, fmt, manifest['dimensions'][key]]
+                    for path, fmt, key in value]
+              for rel, value in byimage.items()}
+    if readjson(renditionspath(), None) != images:
+        writejson(images, renditionspath())
+
+    return n
+
+
+def images(args):
+    """Resizes and copies the images.  All of the cores are used unless
+    told otherwise."""
+
+    if not os.path.exists('config.ini'):
+        error('config.ini not found.')
+
+    with locked():
+        n = makeimages(getjobs(args.jobs, os.cpu_count()), args.force)
+        evict()
+    if not n:
+        write('Images are up to date.\n')
@@ -0,0 +1,116 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""jobserver.py - shares GNU make's job slots.
+
+'bcms make --jobs N' runs make with N job slots.  A bcms command that make
+runs holds one of them.  When it runs pandoc or convert processes in
+parallel, it takes a further slot from make's jobserver for each process
+beyond the first, and gives it back when the process is done.  So no more
+than N processes run at once across the whole build, and a command that
+runs alone may use all of them.
+
+The jobserver is found from MAKEFLAGS.  GNU make only passes the jobserver's
+pipe to recipe lines marked with '+' (see the .module.mk files); make 4.4
+may use a named pipe instead, which is opened by its path.  Without a
+jobserver, slot() does nothing.
+"""
+
+import contextlib
+import os
+import re
+import select
+import stat
+import threading
+
+
+# MAKEFLAGS patterns
+AUTH = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+JOBS = re.compile(r'(?:^|\s)-j(\d+)')
+
+# The jobserver's (read, write) file descriptors; () if there is none
+FDS = None
+
+# Flags that the slot held by this process is free
+FREE = True
+LOCK = threading.Lock()
+
+
+def getfds():
+    """Returns the (read, write) file descriptors of make's jobserver, or
+    () if there is none available to this process."""
+    global FDS  # pylint: disable=global-statement
+    if FDS is not None:
+        return FDS
+    FDS = ()
+    m = AUTH.search(os.environ.get('MAKEFLAGS', ''))
+    if not m:
+        return FDS
+    try:
+        if m.group(1).startswith('fifo:'):
+            fd = os.open(m.group(1)[5:], os.O_RDWR)
+            FDS = (fd, fd)
+        else:
+            fds = tuple(int(fd) for fd in m.group(1).split(','))
+            # Make closes the pipe for most recipes, and so the descriptors
+            # may be unused or used for something else
+            if all(stat.S_ISFIFO(os.fstat(fd).st_mode) for fd in fds):
+                FDS = fds
+    except (OSError, ValueError):
+        pass
+    return FDS
+
+
+def getjobs():
+    """Returns the number of make's job slots, or None if there is no
+    jobserver."""
+    m = JOBS.search(os.environ.get('MAKEFLAGS', ''))
+    return int(m.group(1)) if m and getfds() else None
+
+
+def acquire(fd):
+    """Reads a token from the jobserver, waiting until there is one."""
+    while True:
+        select.select([fd], [], [])
+        try:
+            return os.read(fd, 1)
+        except BlockingIOError:  # Another process got it first
+            pass
+
+
+@contextlib.contextmanager
+def slot():
+    """Holds a job slot while the enclosed block runs.  The slot held by
+    this process is used first; otherwise one is taken from the jobserver.
+    """
+    global FREE  # pylint: disable=global-statement
+    fds = getfds()
+    if not fds:
+        yield
+        return
+    with LOCK:
+        own, FREE = FREE, False
+    token = None if own else acquire(fds[0])
+    try:
+        yield
+    finally:
+        if own:
+            with LOCK:
+                FREE = True
+        else:
+            os.write(fds[1], token)
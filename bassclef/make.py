@@ -18,11 +18,13 @@
 
 """make.py - GNU make wrapper"""
 
+import os
 import os.path
 import subprocess
 import sys
 
 from bassclef.util import error
+from bassclef.trace import ENV, spanspath, report
 
 
 def make(args, other_args):
@@ -34,10 +36,31 @@ def make(args, other_args):
 
     # Assemble the call
     command = ['make', '-f', '.Makefile']
+    if args.jobs:
+        command.append('-j%d' % args.jobs)
     if other_args:
         command += other_args
     if args.target:
         command += args.target
 
+    # When make runs jobs in parallel, the bcms commands that it calls
+    # (compose, images) share its job slots for the pandoc and convert
+    # processes that they run.  See jobserver.py.
+    env = dict(os.environ)
+
+    # When tracing, every process that make runs records a span in a fresh
+    # trace file.  The recipes' shell is wrapped to record itself; see
+    # trace.py.
+    if args.trace:
+        path = os.path.abspath(spanspath())
+        if os.path.exists(path):
+            os.remove(path)
+        env[ENV] = path
+        wrapper = '%s -m bassclef.trace' % sys.executable
+        command += ['SHELL=%s /bin/bash -o pipefail' % wrapper]
+
     # Make the call
-    sys.exit(subprocess.call(command))
+    code = subprocess.call(command, env=env)
+    if args.trace and os.path.exists(path):
+        report()
+    sys.exit(code)
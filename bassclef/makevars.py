@@ -0,0 +1,265 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""makevars.py - computes the make variables for a site in one pass.
+
+The .Makefile used to shell out to python several times for every page
+just to read config.ini and the YAML metadata.  Instead, the .Makefile
+now calls 'bcms makevars' once and includes the file that it writes.
+"""
+
+import glob
+import io
+import itertools
+import os.path
+import re
+import urllib.parse
+
+from bassclef.util import getconfig, getmeta, itercontent, permalink, write, \
+     cachedir, cachepath
+from bassclef.cache import writefile
+from bassclef.bundle import bundlelinks, BUNDLES, BUNDLED
+
+import pandoc_tpp
+
+
+# Processed template paths, keyed by the source template path
+TEMPLATES = {}
+
+# The number of entries in a feed, unless feed-size is set
+FEEDSIZE = 10
+
+# Feed file extensions keyed by format.  Every .md.in file gets an RSS
+# feed; the others are made if they are listed in feed-formats.
+FEEDEXTS = {'rss': '.xml', 'atom': '.atom', 'json': '.json'}
+
+
+def sources():
+    """Returns the (.md, .md.in) source paths matched by the markdown
+    module's wildcards."""
+    mds = glob.glob('markdown/*.md') + glob.glob('markdown/*/*.md')
+    mdins = glob.glob('markdown/*.md.in') + glob.glob('markdown/*/*.md.in')
+    return sorted(mds), sorted(mdins)
+
+
+def outdir():
+    """Returns the output directory, including the web root."""
+    webroot = getconfig('web-root')
+    return 'www/' + webroot if webroot else 'www'
+
+
+def htmlpath(path):
+    """Returns the output html path for the .md or .md.in file at path."""
+    assert path.startswith('markdown/')
+    if path.endswith('.md.in'):
+        path = path[:-6] + '.md'
+    return outdir() + '/' + path[9:-3] + '.html'
+
+
+def feedpath(path):
+    """Returns the output feed path for the .md.in file at path."""
+    assert path.startswith('markdown/') and path.endswith('.md.in')
+    return outdir() + '/' + path[9:-6] + '.xml'
+
+
+def listing(path):
+    """Returns the .md paths listed in the .md.in file at path."""
+    return list(iterlisting(path))
+
+
+def iterlisting(path):
+    """Generates the .md paths listed in the .md.in file at path, one at a
+    time."""
+    for line in itercontent(path):
+        line = line.strip()
+        if line.endswith('.md') and os.path.isfile(line):
+            yield line
+
+
+def pagesize(path):
+    """Returns the number of entries on each page for the .md.in file at
+    path, or 0 if it isn't paginated."""
+    return int(getmeta(path).get('page-size') or 0)
+
+
+def pagecount(path):
+    """Returns the number of pages for the .md.in file at path."""
+    size = pagesize(path)
+    if not size:
+        return 1
+    return max(1, -(-len(listing(path)) // size))
+
+
+def pagename(path, page):
+    """Returns the name of the given page of the .md.in file at path,
+    relative to the markdown directory and without an extension.  The first
+    page is named for the file itself; e.g., markdown/blog.md.in gives
+    blog, blog-2, blog-3, ..."""
+    name = path[9:-6]
+    return name if page == 1 else '%s-%d' % (name, page)
+
+
+def pagepath(path, page):
+    """Returns the output html path for the given page of the .md.in file at
+    path."""
+    return outdir() + '/' + pagename(path, page) + '.html'
+
+
+def feedsize(path):
+    """Returns the number of entries in the feed for the .md.in file at
+    path."""
+    return int(getmeta(path).get('feed-size') or FEEDSIZE)
+
+
+def feedformats(path):
+    """Returns the formats of the feeds for the .md.in file at path.  RSS
+    comes first."""
+    formats = re.findall(r'\w+', str(getmeta(path).get('feed-formats', '')))
+    return ['rss'] + [fmt for fmt in FEEDEXTS
+                      if fmt != 'rss' and fmt in formats]
+
+
+def feedpaths(path):
+    """Returns the output feed paths for the .md.in file at path, keyed by
+    format."""
+    return {fmt: feedpath(path)[:-4] + FEEDEXTS[fmt]
+            for fmt in feedformats(path)}
+
+
+def feedflags(path):
+    """Returns the 'bcms feed' flags that write the feeds besides RSS for
+    the .md.in file at path."""
+    flags = []
+    for fmt, dest in feedpaths(path).items():
+        if fmt != 'rss':
+            flags += ['--' + fmt, dest]
+    return flags
+
+
+def iterfeedentries(path):
+    """Generates the .md paths for the entries in the feed for the .md.in
+    file at path.  The listing is only read as far as needed."""
+    return itertools.islice(iterlisting(path), feedsize(path))
+
+
+def feedentries(path):
+    """Returns the .md paths for the entries in the feed for the .md.in file
+    at path."""
+    return list(iterfeedentries(path))
+
+
+def maketemplate(path, tmp):
+    """Writes the pandoc-tpp processed template at path into the tmp
+    directory and returns the new path.  The stylesheets and scripts that
+    the template links are bundled.  Each template is only processed
+    once."""
+    if not path:
+        return ''
+    if path not in TEMPLATES:
+        dest = os.path.join(tmp, path)
+        if os.path.dirname(dest):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        with open(dest, 'w') as f:
+            f.writelines(bundlelinks(pandoc_tpp.preprocess(path)))
+        TEMPLATES[path] = dest
+    return TEMPLATES[path]
+
+
+def pagevars(path, tmp, page=1):
+    """Returns a dict of the pandoc flag variables for the .md or .md.in
+    file at path.
+
+    page - the page number for paginated .md.in files
+    """
+    html = pagepath(path, page) if path.endswith('.md.in') else htmlpath(path)
+    plink = permalink(html[3:])  # Strip 'www' as the Makefile does
+    return {'TEMPLATE': maketemplate(getmeta(path, 'template'), tmp),
+            'PERMALINK': plink,
+            'QUOTED_PERMALINK': urllib.parse.quote(plink).replace('/', '%2F')}
+
+
+def escape(value):
+    """Escapes a value for use on the right-hand side of a make
+    assignment."""
+    return value.replace('$', '$$').replace('#', r'\#')
+
+
+def makevars(args):  # pylint: disable=unused-argument
+    """Writes make variable assignments for the site to a file in the build
+    cache directory, and its path to stdout."""
+
+    tmp = cachepath('tpp', '')
+    f = io.StringIO()
+
+    # The build cache directory holds the composed markdown, processed
+    # templates and bundles
+    write('CACHE := %s\n' % escape(cachedir()), f)
+
+    # The web root
+    write('WEBROOT := %s\n' % escape(getconfig('web-root')), f)
+
+    # Per-page variables, keyed by the output html path
+    mds, mdins = sources()
+    for path in mds + mdins:
+        html = htmlpath(path)
+        for name, value in pagevars(path, tmp).items():
+            write('%s_%s := %s\n' % (name, html, escape(value)), f)
+
+    # The extra pages of paginated .md.in files.  PAGED lists the names of
+    # the paginated files, and PAGES_<name> their page numbers after 1.
+    paged = []
+    for path in mdins:
+        pages = range(2, pagecount(path) + 1)
+        if not pages:
+            continue
+        paged.append(pagename(path, 1))
+        write('PAGES_%s := %s\n' %
+              (pagename(path, 1), ' '.join(str(page) for page in pages)), f)
+        for page in pages:
+            html = pagepath(path, page)
+            for name, value in pagevars(path, tmp, page).items():
+                write('%s_%s := %s\n' % (name, html, escape(value)), f)
+    write('PAGED := %s\n' % ' '.join(paged), f)
+
+    # The bundles made while processing the templates, and the stylesheets
+    # and scripts in them.  See bundle.py.
+    write('BUNDLES := %s\n' % ' '.join(sorted(BUNDLES)), f)
+    write('BUNDLED := %s\n' % ' '.join(sorted(BUNDLED)), f)
+
+    # Feeds only depend on the html for the entries they include.  The
+    # feeds besides RSS are written alongside it; FEEDFLAGS_<path> gives
+    # the flags for 'bcms feed', and FEEDS lists the extra feeds.
+    feeds = []
+    for path in mdins:
+        htmls = [htmlpath(p) for p in feedentries(path)]
+        write('%s: %s\n' % (feedpath(path), ' '.join(htmls)), f)
+        flags = feedflags(path)
+        if flags:
+            write('FEEDFLAGS_%s := %s\n' %
+                  (feedpath(path), escape(' '.join(flags))), f)
+            feeds += flags[1::2]
+    write('FEEDS := %s\n' % ' '.join(feeds), f)
+
+    # Flags that the variables were successfully written
+    write('BCMS_MAKEVARS := 1\n', f)
+
+    # Every make run rewrites the same file, and so it is replaced
+    # atomically
+    path = cachepath('vars.mk')
+    writefile(path, f.getvalue())
+    write(path + '\n')
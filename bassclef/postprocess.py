@@ -16,160 +16,243 @@
 #  You should have received a copy of the GNU General Public License
 #  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
 
-"""postprocess.py - pandoc html postprocessing"""
+"""postprocess.py - pandoc html postprocessing
 
+The processing is done in a single streaming pass.  Each stage is a
+generator that takes an iterable of lines and yields the processed lines,
+and the stages are chained together.  Only link_images() and
+make_aesthetic_fixes() need to look ahead, and then only by one line.
+"""
+
+import io
 import re
 
-from bassclef.util import getconfig, writelines
-from bassclef.util import STDIN
+from bassclef.util import getconfig, cachepath, readjson
+from bassclef.util import STDIN, STDOUT
+from bassclef.cache import putbody
+
+
+# Pandoc bug workaround patterns
+TITLE = re.compile(r'<title>(\d+)// (.*?)</title>')
+META = re.compile(r'<meta (.*?) content="(\d+)// (.*?)" />')
+HEADER = re.compile(r'(\s+)<h1 (.*?)>(\d+)// (.*?)</h1>')
+COMMENT = re.compile(r'(^\s*)<p>(<!-- .* -->)</p>$')
+
+# Url, image and social link patterns
+URL = re.compile(r'(src|href)="/(.*?)"')
+IMAGE = re.compile(r'(<img src="(/[^"]*?)?/images/([^"]*)"[^>]*/>)')
+SOCIAL = re.compile(r'(<a href="([^"]*?)"><span class="fa (.*?)">)')
+TOOLTIP = re.compile(r'(<a href="([^"]*?)" (.*?)><span class="fa (.*?)">)')
+
+# The comment that marks postprocessed html
+MARKER = '<!-- postprocessed by bcms -->\n'
+
+# The image renditions made by 'bcms images'; see images.py
+IMAGES = None
+
+# Tooltip titles for social links, keyed by a fragment of the url
+TOOLTIPS = [('twitter', 'Tweet this'),
+            ('facebook', 'Share this on Facebook'),
+            ('google', 'Share this on Google+'),
+            ('linkedin', 'Share this on LinkedIn'),
+            ('mailto', 'Share this by Email')]
 
 
 def fix_bugs(lines):
     """Fixes bugs in pandoc's html output."""
 
-    # Pandoc should not be treating numbers in headers as list items.  Here
-    # we undo the temporary obfuscation made by preprocess.py's call to
-    # bassclef.util.getmeta().
-    p = re.compile(r'<title>(\d+)// (.*?)</title>')
-    for i, line in enumerate(lines):
-        if p.search(line):
-            num, title = p.search(line).groups()
-            lines[i] = '<title>%s. %s</title>' % (num, title)
-    p = re.compile(r'<meta (.*?) content="(\d+)// (.*?)" />')
-    for i, line in enumerate(lines):
-        if p.search(line):
-            attrs, num, title = p.search(line).groups()
-            lines[i] = '<meta %s content="%s. %s" />' % (attrs, num, title)
-    p = re.compile(r'(\s+)<h1 (.*?)>(\d+)// (.*?)</h1>')
-    for i, line in enumerate(lines):
-        if p.search(line):
-            spaces, attrs, num, title = p.search(line).groups()
-            lines[i] = '%s<h1 %s>%s. %s</h1>' % (spaces, attrs, num, title)
-
-    # Change <p><br /></p> to just <br />
-    for i, line in enumerate(lines):
-        lines[i] = line.replace('<p><br /></p>', '<br />\n')
-
-    # Remove paragraph markers in head
-    flag = False
-    for i, line in enumerate(lines):
-        if flag or line.strip().startswith('<head>'):
-            flag = True
-            lines[i] = line.replace('<p>', '').replace('</p>', '')
-        if line.strip().startswith('</head>'):
-            break
-
-    # Remove paragraph tags from around comments
-    p = re.compile(r'(^\s*)<p>(<!-- .* -->)</p>$')
-    for i, line in enumerate(lines):
-        if p.match(line):
-            space, comment = p.match(line).groups()
-            lines[i] = space + comment + '\n'
-
-    return lines
+    inhead = None  # Flags we are in the head; None until it is found and
+                   # False once it is finished
+
+    for line in lines:
+
+        # Pandoc should not be treating numbers in headers as list items.
+        # Here we undo the temporary obfuscation made by preprocess.py's call
+        # to bassclef.util.writemeta().
+        m = TITLE.search(line)
+        if m:
+            line = '<title>%s. %s</title>' % m.groups()
+        m = META.search(line)
+        if m:
+            line = '<meta %s content="%s. %s" />' % m.groups()
+        m = HEADER.search(line)
+        if m:
+            line = '%s<h1 %s>%s. %s</h1>' % m.groups()
+
+        # Change <p><br /></p> to just <br />
+        line = line.replace('<p><br /></p>', '<br />\n')
+
+        # Remove paragraph markers in head
+        if inhead is not False:
+            stripped = line.strip()
+            if inhead or stripped.startswith('<head>'):
+                inhead = True
+                line = line.replace('<p>', '').replace('</p>', '')
+            if stripped.startswith('</head>'):
+                inhead = False
+
+        # Remove paragraph tags from around comments
+        m = COMMENT.match(line)
+        if m:
+            line = m.group(1) + m.group(2) + '\n'
+
+        yield line
 
 
 def adjust_urls(lines):
     """Put web root into urls where appropriate."""
     webroot = getconfig('web-root')
-    if webroot:
-        p = re.compile('((src|href)="/(.*?)")')
-        for i, line in enumerate(lines):
-            replace = False
-            for group in p.findall(line):
-                replace = True
-                old, tag, path = group
-                new = '%s="/%s/%s"' % (tag, webroot, path)
-                line = line.replace(old, new)
-            if replace:
-                lines[i] = line
-    return lines
+    if not webroot:
+        yield from lines
+        return
+    repl = r'\1="/%s/\2"' % webroot.replace('\\', r'\\')
+    for line in lines:
+        yield URL.sub(repl, line) if '="/' in line else line
 
 
 def link_images(lines):
     """Link images to their full-size originals."""
-    p = re.compile('(<img src="(/.*?)?/images/(.*?)".*?/>)')
-    for i, line in enumerate(lines):
-        if p.search(line):
-            # If this is already linked, don't do it again
-            if line.strip().lower().endswith('</a>') or \
-              lines[i+1].strip().lower().startswith('</a>'):
-                continue
-            imgtag, root, subpath = p.search(line).groups()
-            # Don't link in originals
-            if subpath.startswith('originals/'):
-                continue
+    lines = iter(lines)
+    line = next(lines, None)
+    while line is not None:
+        nextline = next(lines, None)
+        m = IMAGE.search(line) if '<img' in line else None
+        # If this is already linked, don't do it again.  Don't link in
+        # originals.
+        if m and not line.strip().lower().endswith('</a>') and \
+          not (nextline or '').strip().lower().startswith('</a>') and \
+          not m.group(3).startswith('originals/') and \
+          '/images/originals/%s"' % m.group(3) not in line:
+            imgtag, root, subpath = m.groups()
             linked_imgtag = '<a href="%s/images/originals/%s">%s</a>' % \
               (root or '', subpath, imgtag)
-            lines[i] = line.replace(imgtag, linked_imgtag)
-    return lines
+            line = line.replace(imgtag, linked_imgtag)
+        yield line
+        line = nextline
+
+
+def imagemanifest():
+    """Returns the image renditions dict written by 'bcms images'."""
+    global IMAGES  # pylint: disable=global-statement
+    if IMAGES is None:
+        IMAGES = readjson(cachepath('renditions.json'), {})
+    return IMAGES
+
+
+def srcset(candidates):
+    """Returns the srcset for the candidates dict keyed by width."""
+    return ', '.join(candidates[w] for w in sorted(candidates))
+
+
+def responsive_image(m):
+    """Returns the responsive version of the image tag matched by IMAGE.
+
+    The image is given loading="lazy" and decoding="async".  The width,
+    height, srcset and sizes are added from the renditions recorded by
+    'bcms images'.  Renditions in other formats are offered using a <picture>.
+    Attributes that are already present, and images that are already in a
+    <picture>, are left alone.
+    """
+
+    imgtag, root, subpath = m.groups()
+    if subpath.startswith('originals/'):
+        return imgtag
+    if m.string.rfind('<picture>', 0, m.start()) > \
+      m.string.rfind('</picture>', 0, m.start()):
+        return imgtag
+    root = root or ''
+
+    # Sort the renditions with known dimensions by format, keeping one
+    # per width (images are never enlarged, so widths may repeat)
+    main = None
+    srcsets = {}
+    for path, fmt, dims in imagemanifest().get(subpath, []):
+        if path == 'images/' + subpath:
+            main = dims
+        if dims:
+            srcsets.setdefault(fmt, {}).setdefault(
+                dims[0], '%s/%s %dw' % (root, path, dims[0]))
+
+    attrs = [('loading', 'lazy'), ('decoding', 'async')]
+    sizes = None
+    if main:
+        sizes = '(max-width: %dpx) 100vw, %dpx' % (main[0], main[0])
+        attrs += [('width', str(main[0])), ('height', str(main[1]))]
+        if len(srcsets.get(None, [])) > 1:
+            attrs += [('srcset', srcset(srcsets[None])), ('sizes', sizes)]
+    attrs = ''.join(' %s="%s"' % (k, v) for k, v in attrs
+                    if ' %s=' % k not in imgtag)
+    html = imgtag[:-2].rstrip() + attrs + ' />'
+
+    # Offer the other formats
+    sources = ['<source type="image/%s" srcset="%s" sizes="%s" />' %
+               (fmt, srcset(candidates), sizes)
+               for fmt, candidates in srcsets.items() if fmt and sizes]
+    if sources:
+        html = '<picture>%s%s</picture>' % (''.join(sources), html)
+
+    return html
+
+
+def make_images_responsive(lines):
+    """Makes images responsive and loads them lazily."""
+    for line in lines:
+        if '<img' in line:
+            line = IMAGE.sub(responsive_image, line)
+        yield line
 
 
 def open_tabs_when_clicked(lines):
     """Makes clicking links open tabs (for select cases)."""
 
     # Make social badge links open a new tab when clicked
-    p = re.compile(r'(<a href="([^"]*?)"><span class="fa (.*?)">)')
-    for i, line in enumerate(lines):
-        if p.search(line):
-            old, url, classes = p.search(line).groups()
+    for line in lines:
+        m = SOCIAL.search(line) if '<span class="fa ' in line else None
+        if m:
+            old, url, classes = m.groups()
             new = '<a href="%s" target="_blank"><span class="fa %s">' \
                   % (url, classes)
-            lines[i] = line.replace(old, new)
-
-    return lines
+            line = line.replace(old, new)
+        yield line
 
 
 def generate_tooltips(lines):
     """Generates tooltips (for select cases)."""
 
-    # Give social links a tooltip
-    p = re.compile(r'(<a href="([^"]*?)" (.*?)><span class="fa (.*?)">)')
-    for i, line in enumerate(lines):
-        if p.search(line):
-            old, url, attrs, classes = p.search(line).groups()
-
-            if 'twitter' in url:
-                title = 'Tweet this'
-            elif 'facebook' in url:
-                title = 'Share this on Facebook'
-            elif 'google' in url:
-                title = 'Share this on Google+'
-            elif 'linkedin' in url:
-                title = 'Share this on LinkedIn'
-            elif 'mailto' in url:
-                title = 'Share this by Email'
-            else:
-                continue
-            new = '<a href="%s" %s title="%s"><span class="fa %s">' \
-                  % (url, attrs, title, classes)
-
-            lines[i] = line.replace(old, new)
-
-    return lines
+    # Give social links a tooltip, unless they already have one
+    for line in lines:
+        m = TOOLTIP.search(line) if '<span class="fa ' in line else None
+        if m and ' title=' not in ' ' + m.group(3):
+            old, url, attrs, classes = m.groups()
+            for name, title in TOOLTIPS:
+                if name in url:
+                    new = '<a href="%s" %s title="%s"><span class="fa %s">' \
+                          % (url, attrs, title, classes)
+                    line = line.replace(old, new)
+                    break
+        yield line
 
 
 def make_aesthetic_fixes(lines):
     """Html should look nice."""
 
     # Comments immediately after </div> tags should be on same line
-    for i in range(len(lines)-1):
-        if lines[i] is None:
-            continue
-        if lines[i].strip() == '</div>' and \
-          lines[i+1].strip().startswith('<!--'):
-            lines[i] = lines[i][:-1] + ' ' + lines[i+1].strip() + '\n'
-            lines[i+1] = None
-    lines = [line for line in lines if not line is None]
-
-    return lines
-
-
-def postprocess():
-    """Postprocesses html output piped to stdin from pandoc."""
-
-    # Get the lines
-    lines = [line for line in STDIN]
+    last = None
+    for line in lines:
+        if last is None:
+            last = line
+        elif last.strip() == '</div>' and line.strip().startswith('<!--'):
+            yield last[:-1] + ' ' + line.strip() + '\n'
+            last = None
+        else:
+            yield last
+            last = line
+    if last is not None:
+        yield last
+
+
+def process(lines):
+    """Returns an iterator over the postprocessed lines."""
 
     # Essential fixes
     lines = fix_bugs(lines)
@@ -177,11 +260,104 @@ def postprocess():
 
     # Functionality enhancements
     lines = link_images(lines)
+    lines = make_images_responsive(lines)
     lines = open_tabs_when_clicked(lines)
     lines = generate_tooltips(lines)
 
     # Niceties
     lines = make_aesthetic_fixes(lines)
 
-    # Write to stdout
-    writelines(lines)
+    return mark(lines)
+
+
+def mark(lines):
+    """Appends the marker for postprocessed html to the lines."""
+    yield from lines
+    yield MARKER
+
+
+def ispostprocessed(html):
+    """Returns True if the html string was already postprocessed."""
+    return html.endswith(MARKER)
+
+
+def content_body(lines):
+    """Returns the content-body from the lines of an html page, or None if
+    there isn't one.
+
+    This function searches for the following markers and returns everything
+    in between except for the social widgets:
+
+      <div class="content-body">
+      </div> <!-- class="content-body" -->
+    """
+
+    body = []
+    inbody = False    # Flags when we are in the content-body
+    insocial = False  # Flags when we are in the social widget html
+    for line in lines:
+        if '<div class="content-body">' in line:
+            inbody = True
+        if inbody:
+            if '<div class="social">' in line:
+                insocial = True
+            if not insocial:
+                body.append(line)
+            if '</div> <!-- class="social" -->' in line:
+                insocial = False
+        if '</div> <!-- class="content-body" -->' in line:
+            return '\n'.join(body)
+
+    return None
+
+
+def storebody(path):
+    """Stores the content-body of the postprocessed page at path for use by
+    the feeds."""
+    with open(path, encoding='utf-8') as f:
+        putbody(path, content_body(f))
+
+
+def transform(html):
+    """Returns the postprocessed html string.  Html that was already
+    postprocessed is returned as it is."""
+    if ispostprocessed(html):
+        return html
+    return ''.join(process(io.StringIO(html)))
+
+
+def transformfile(path):
+    """Postprocesses the html file at path in place.  Files that were
+    already postprocessed are left alone, but their content-body is still
+    stored."""
+    with open(path, encoding='utf-8') as f:
+        html = f.read()
+    if not ispostprocessed(html):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(transform(html))
+    storebody(path)
+
+
+def transformfiles(paths):
+    """Postprocesses each of the html files at paths in place."""
+    for path in paths:
+        transformfile(path)
+
+
+def postprocess(args):
+    """Postprocesses html output piped to stdin from pandoc, or the files
+    given with --batch.  Postprocessed html ends with a marker comment, and
+    so files that were already postprocessed are left as they are.
+
+    When an --output path is given, the content-body is also stored.
+    """
+    if args.batch:
+        transformfiles(args.batch)
+    elif args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.writelines(process(STDIN))
+        storebody(args.output)
+    else:
+        for line in process(STDIN):
+            STDOUT.write(line)
+        STDOUT.flush()
@@ -19,7 +19,7 @@
 """preprocess.py - pandoc markdown preprocessing"""
 
 
-from bassclef.util import getmeta, writemeta, getcontent, writelines
+from bassclef.util import getmeta, writemeta, getcontent, writelines, STDOUT
 
 
 def insert_figure(lines, image, caption):
@@ -50,18 +50,9 @@ def insert_figure(lines, image, caption):
     return lines
 
 
-def preprocess(args):
-    """Preprocesses path."""
-
-    path = args.path
-
-    # Load and write the metadata.  Obfuscate the title field as a workaround
-    # to a pandoc bug.  This gets undone by postprocess.py.
-    meta = getmeta(path)
-    writemeta(meta, obfuscate=True)
-
-    # Read in the lines
-    lines = getcontent(path)
+def applyflags(meta, lines):
+    """Returns the list of markdown lines with the processing flags applied.
+    The metadata gives the image to insert, if any."""
 
     # Insert the image into the lines
     if 'image' in meta:
@@ -80,5 +71,29 @@ def preprocess(args):
         if line.strip() == '<!-- vspace -->':
             lines[i] = '<div style="clear: both; height: 3rem;"></div>\n'
 
+    return lines
+
+
+def prepare(path):
+    """Returns the (meta, lines) for the file at path with the processing
+    flags applied."""
+    meta = getmeta(path)
+    return meta, applyflags(meta, getcontent(path))
+
+
+def preprocessfile(path, f=STDOUT):
+    """Preprocesses the file at path, writing the result to f."""
+
+    meta, lines = prepare(path)
+
+    # Write the metadata.  Obfuscate the title field as a workaround to a
+    # pandoc bug.  This gets undone by postprocess.py.
+    writemeta(meta, f=f, obfuscate=True)
+
     # Write out the new lines
-    writelines(lines)
+    writelines(lines, f=f)
+
+
+def preprocess(args):
+    """Preprocesses path."""
+    preprocessfile(args.path)
@@ -0,0 +1,400 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""render.py - renders markdown to html with pandoc or in process.
+
+There are two renderers:
+
+  pandoc - runs pandoc, which supports all of Pandoc's Markdown; and
+
+  python - renders in this process using Python-Markdown, if it is
+           installed.  This supports the plain subset that most posts use:
+           paragraphs, headers, emphasis, links, images, lists, block
+           quotes, code, footnotes, pipe tables and raw html.  Unlike
+           pandoc, it passes html blocks through without looking for
+           markdown inside them.  The template is filled in by
+           template.py.
+
+The renderer is chosen by the renderer setting in config.ini, which may be
+overridden in a page's metadata.  It is one of 'pandoc' (the default),
+'python' or 'auto'.  The auto setting uses the python renderer unless the
+markdown uses features that only pandoc supports (see PANDOCONLY), has
+markdown inside html blocks, or the template uses template features that
+template.py doesn't.  The detection errs on the side of pandoc.
+Everything is rendered by pandoc when Python-Markdown isn't installed.
+
+The python renderer makes its output look like pandoc's where the
+postprocessing and stylesheets depend on it: lone images with captions
+become figures with the caption rendered as markdown, repeated header
+identifiers are numbered as pandoc numbers them, and footnotes use
+pandoc's identifiers and markup and go in a <section class="footnotes">.
+"""
+
+import html as htmllib
+import io
+import re
+import subprocess
+import threading
+
+from bassclef.util import writemeta, writelines, write, error
+from bassclef.preprocess import prepare
+from bassclef.template import parse as template_parse, \
+     render as template_render
+from bassclef.cache import pandocversion
+from bassclef.trace import traced
+
+
+# The pandoc input and output formats
+PANDOCFORMAT = ['-f', 'markdown+smart+markdown_attribute',
+                '-t', 'html5',
+                '--email-obfuscation', 'none']
+
+# Pandoc's Markdown features that the python renderer doesn't support, by
+# name
+PANDOCONLY = [
+    ('math', re.compile(r'(?<![\\$])\$(?=\S)[^$\n]*(?<=\S)\$(?!\d)|\$\$')),
+    ('citations', re.compile(r'(?<![\w.@])@[\w{]|\[@|\[-@')),
+    ('inline notes', re.compile(r'\^\[')),
+    ('superscript', re.compile(r'(?<!\[)\^(?=\S)[^\s^]+\^')),
+    ('subscript', re.compile(r'(?<!~)~(?=\S)[^\s~]+~(?!~)')),
+    ('strikeout', re.compile(r'~~')),
+    ('fenced divs', re.compile(r'(?m)^:::')),
+    ('attributes', re.compile(r'[\])`]\{')),
+    ('line blocks', re.compile(r'(?m)^\| (?!.*\|)')),
+    ('grid tables', re.compile(r'(?m)^\+[-=:]+\+')),
+    ('simple tables', re.compile(r'(?m)^ *-{3,}( +-{3,})+ *$')),
+    ('fancy lists', re.compile(r'(?m)^ *(\(@|#\.|\(?\d+\)|\(?[a-zA-Z]\)|'
+                               r'[a-zA-Z]\. |[ivxIVX]+\. )')),
+    ('nested lists', re.compile(r'(?m)^ {1,3}([-*+]|\d+\.) ')),
+    ('line breaks', re.compile(r'\\\n')),
+    ('title blocks', re.compile(r'\A%')),
+    ('tex', re.compile(r'\\[a-zA-Z]+\{|\\begin'))]
+
+# Markdown syntax, looked for in the text of html blocks.  Pandoc renders
+# markdown inside html blocks, but Python-Markdown passes them through.
+MARKUP = re.compile(r'(?m)[*_`]|\]\(|\]\[|^ *([#>]|[-+] |\d+\. )')
+TAG = re.compile(r'<!--.*?-->|<[^>]*>', re.DOTALL)
+
+# Html blocks whose content is left alone by both renderers, and html
+# elements without content
+VERBATIM = ['pre', 'script', 'style', 'textarea', 'math']
+VOID = ['hr']
+
+# Smart punctuation, as unicode characters like pandoc's
+SMARTY = {'left-single-quote': '\u2018', 'right-single-quote': '\u2019',
+          'left-double-quote': '\u201c', 'right-double-quote': '\u201d',
+          'ndash': '\u2013', 'mdash': '\u2014', 'ellipsis': '\u2026'}
+
+# Fixes for the python renderer's input and output.  Python-Markdown moves
+# comments that follow a closing tag (as at the end of each composed entry)
+# out of place unless they are on a line of their own.
+TRAILINGCOMMENT = re.compile(r'(?m)^(</\w+>) (<!--.*-->)$')
+SPLITCOMMENT = re.compile(r'(?m)^(</\w+>)\n(<!--.*-->)$')
+FIGURE = re.compile(r'(?m)^<p>(<img [^>]*?)alt="([^"]+)"([^>]*/>)</p>$')
+IMAGEATTRS = re.compile(r'<img alt="([^"]*)" src="([^"]*)"')
+FOOTNOTES = '<div class="footnote">'
+SECTION = '<section class="footnotes" role="doc-endnotes">'
+
+# Python-Markdown's footnote markup, which is rewritten as pandoc's.
+# Python-Markdown identifies notes by their labels (with a number for
+# repeated references), and pandoc by their numbers.
+NOTEREF = re.compile(r'<sup id="fnref(\d*):([^"]+)">'
+                     r'<a class="footnote-ref" href="#fn:\2">(\d+)</a></sup>')
+NOTE = re.compile(r'<li id="fn:([^"]+)">')
+BACKREF = re.compile(r'(?:&#160;)?<a class="footnote-backref" '
+                     r'href="#fnref(\d*):([^"]+)" title="[^"]*">&#8617;</a>')
+
+# Metadata values that would be taken for blocks other than paragraphs
+BLOCKSTART = re.compile(r'^(\d+)\. |^([-*+] |[>#])')
+PARAGRAPH = re.compile(r'^<p>(.*)</p>$', re.DOTALL)
+
+# The revision of the python renderer's output.  It is part of the
+# renderer's version string, and so changing it invalidates cached html.
+REVISION = 2
+
+# Python-Markdown, once imported, or False if it isn't available
+MARKDOWN = None
+
+# Python-Markdown converters, one for each thread
+LOCAL = threading.local()
+
+# Rendered metadata values, keyed by value
+INLINE = {}
+
+
+def markdownmodule():
+    """Returns the Python-Markdown module, or None if it isn't installed.
+    It is slow to import, and so is only imported when needed."""
+    global MARKDOWN  # pylint: disable=global-statement
+    if MARKDOWN is None:
+        try:
+            import markdown  # pylint: disable=import-outside-toplevel
+            MARKDOWN = markdown
+        except ImportError:
+            MARKDOWN = False
+    return MARKDOWN or None
+
+
+def slugify(value, separator):
+    """Returns a header identifier made the way pandoc makes them.  Like
+    pandoc, repeated identifiers in a document are numbered."""
+    value = re.sub(r'<[^>]*>', '', htmllib.unescape(value)).lower()
+    value = re.sub(r'[^\w\s.-]', '', value)
+    value = re.sub(r'\s+', separator, value.strip())
+    value = re.sub(r'^[^a-z]+', '', value) or 'section'
+    slug, n = value, 0
+    while slug in LOCAL.ids:
+        n += 1
+        slug = '%s-%d' % (value, n)
+    LOCAL.ids.add(slug)
+    return slug
+
+
+def converter():
+    """Returns the Python-Markdown converter for this thread."""
+    if not hasattr(LOCAL, 'converter'):
+        markdown = markdownmodule()
+        LOCAL.converter = markdown.Markdown(
+            extensions=['extra', 'smarty', 'toc', 'sane_lists'],
+            extension_configs={'smarty': {'substitutions': SMARTY},
+                               'toc': {'slugify': slugify}},
+            output_format='xhtml')
+    LOCAL.ids = set()
+    return LOCAL.converter.reset()
+
+
+def htmlblocks(text):
+    """Yields the (tag, content) of the html blocks in the markdown text.
+    Python-Markdown must be installed."""
+    tags = '|'.join(converter().block_level_elements)
+    start = re.compile(r'(?m)^ {0,3}<(%s)\b' % tags)
+    i = 0
+    while True:
+        m = start.search(text, i)
+        if not m:
+            return
+        tag = m.group(1)
+
+        # The block ends with its closing tag, or else at a blank line
+        end = text.find('\n\n', m.end())
+        end = len(text) if end == -1 else end
+        if tag not in VOID:
+            depth = 0
+            for t in re.compile(r'<(/?)%s\b[^>]*?(/?)>' % tag) \
+                       .finditer(text, m.start()):
+                depth += -1 if t.group(1) else 0 if t.group(2) else 1
+                if depth == 0:
+                    end = t.end()
+                    break
+
+        yield tag, text[m.end():end]
+        i = end
+
+
+def needspandoc(text):
+    """Returns the name of the first pandoc-only feature used in the
+    markdown text, or None."""
+    for name, pattern in PANDOCONLY:
+        if pattern.search(text):
+            return name
+    if '<' in text:
+        for tag, content in htmlblocks(text):
+            if tag not in VERBATIM and \
+              MARKUP.search(TAG.sub('', content.split('>', 1)[-1])):
+                return 'markdown in html'
+    return None
+
+
+def choose(meta, text, template):
+    """Returns the renderer ('pandoc' or 'python') for the markdown text.
+
+    meta - the page's metadata, which gives the renderer setting
+    template - the parsed template, or None if it can't be parsed
+    """
+    setting = meta.get('renderer') or 'pandoc'
+    if setting not in ['python', 'auto'] or template is None or \
+      not markdownmodule():
+        return 'pandoc'
+    if setting == 'auto' and needspandoc(text):
+        return 'pandoc'
+    return 'python'
+
+
+def markdownversion():
+    """Returns the python renderer's version string, or '' if
+    Python-Markdown isn't installed."""
+    markdown = markdownmodule()
+    return 'Python-Markdown %s (revision %d)' % \
+      (markdown.__version__, REVISION) if markdown else ''
+
+
+def version(renderer):
+    """Returns the version string for the renderer, for cache keys."""
+    return markdownversion() if renderer == 'python' else pandocversion()
+
+
+def tohtml(text):
+    """Returns the html for the markdown text, using Python-Markdown."""
+    html = converter().convert(TRAILINGCOMMENT.sub(r'\1\n\2', text))
+    html = SPLITCOMMENT.sub(r'\1 \2', html)
+
+    # Images alone in a paragraph with a caption are figures
+    html = IMAGEATTRS.sub(r'<img src="\2" alt="\1"', html)
+    html = FIGURE.sub(figure, html)
+
+    # The footnotes are at the end
+    i = html.find(FOOTNOTES)
+    if i != -1:
+        j = html.rfind('</div>')
+        html = html[:i] + SECTION + html[i+len(FOOTNOTES):j] + '</section>' + \
+          html[j+6:]
+        html = footnotes(html)
+
+    return html + '\n'
+
+
+def figure(m):
+    """Returns the figure for a FIGURE match.  The caption is markdown,
+    and the alt text is the caption's text."""
+    caption = inline(htmllib.unescape(m.group(2)))
+    alt = TAG.sub('', caption).replace('"', '&quot;')
+    return '<figure>\n%salt="%s"%s<figcaption>%s</figcaption>\n</figure>' % \
+      (m.group(1), alt, m.group(3), caption)
+
+
+def footnotes(html):
+    """Returns the html with the footnote markup made like pandoc's."""
+    numbers = {m.group(2): m.group(3) for m in NOTEREF.finditer(html)}
+
+    def ident(prefix, m):
+        """Returns the pandoc identifier for a label in match m."""
+        n = numbers.get(m.group(2), m.group(2))
+        return prefix + n + ('-' + m.group(1) if m.group(1) else '')
+
+    html = NOTEREF.sub(lambda m: '<a href="#fn%s" class="footnote-ref" '
+                       'id="%s" role="doc-noteref"><sup>%s</sup></a>' %
+                       (m.group(3), ident('fnref', m), m.group(3)), html)
+    html = NOTE.sub(lambda m: '<li id="fn%s" role="doc-endnote">' %
+                    numbers.get(m.group(1), m.group(1)), html)
+    return BACKREF.sub(lambda m: '<a href="#%s" class="footnote-back" '
+                       'role="doc-backlink">\u21a9\ufe0e</a>' %
+                       ident('fnref', m), html)
+
+
+def inline(value):
+    """Returns the html for a metadata value.  Like pandoc, values are
+    taken as markdown, and a single paragraph is unwrapped."""
+    if value not in INLINE:
+        if re.fullmatch(r'[\w ]*', value):
+            html = value
+        else:
+            text = BLOCKSTART.sub(lambda m: m.group(1) + '\\. '
+                                  if m.group(1) else '\\' + m.group(2),
+                                  value)
+            html = converter().convert(text)
+            html = PARAGRAPH.sub(r'\1', html)
+        INLINE[value] = html
+    return INLINE[value]
+
+
+def fill(template, meta, extra, body):
+    """Returns the template filled in with the metadata and body html.
+
+    extra - strings to add to the metadata, as with pandoc's -M option
+    """
+    variables = {k: inline(v) for k, v in meta.items()
+                 if v and isinstance(v, str)}
+    variables.update({k: htmllib.escape(v, quote=False)
+                      for k, v in extra.items()})
+    variables['body'] = body
+    return template_render(template, variables)
+
+
+def renderpython(meta, text, template, extra):
+    """Renders the markdown text with Python-Markdown and fills in the
+    parsed template.  Returns the html."""
+    return fill(template, meta, extra, tohtml(text))
+
+
+def renderpandoc(meta, lines, template_path, extra, obfuscate=True,
+                 check=True):
+    """Renders the metadata and markdown lines with pandoc.  Returns the
+    html.
+
+    template_path - the path to the template, or '' for pandoc's own
+    extra - strings to add to the metadata with pandoc's -M option
+    obfuscate - obfuscate numbered titles; see util.writemeta()
+    check - raise CalledProcessError if pandoc fails
+    """
+    f = io.StringIO()
+    writemeta(meta, f=f, obfuscate=obfuscate)
+    writelines(lines, f=f)
+    flags = ['-s'] + PANDOCFORMAT
+    if template_path:
+        flags += ['--template', template_path]
+    for k, v in extra.items():
+        flags += ['-M', '%s=%s' % (k, v)]
+    return subprocess.run(traced(['pandoc'] + flags),
+                          input=f.getvalue().encode('utf-8'),
+                          stdout=subprocess.PIPE, check=check) \
+                    .stdout.decode('utf-8')
+
+
+def loadtemplate(path):
+    """Returns the parsed template at path, or None if there is no template
+    or it uses features that template.py doesn't support."""
+    if not path:
+        return None
+    with open(path, encoding='utf-8') as f:
+        try:
+            return template_parse(f.readlines())
+        except ValueError:
+            return None
+
+
+def renderflags(pvars):
+    """Returns the 'bcms render' flags for a page given its make
+    variables."""
+    flags = ['--template', pvars['TEMPLATE']] if pvars['TEMPLATE'] else []
+    flags += ['-M', 'permalink=' + pvars['PERMALINK']]
+    flags += ['-M', 'quoted-permalink=' + pvars['QUOTED_PERMALINK']]
+    return flags
+
+
+def render(args):
+    """Renders the page at path to html on stdout, using the renderer
+    chosen for it."""
+
+    extra = {}
+    for item in args.metadata or []:
+        if '=' not in item:
+            error('Bad metadata: %s' % item)
+        k, v = item.split('=', 1)
+        extra[k] = v
+
+    meta, lines = prepare(args.path)
+    text = ''.join(lines)
+    template = loadtemplate(args.template)
+
+    if choose(meta, text, template) == 'python':
+        write(renderpython(meta, text, template, extra))
+    else:
+        try:
+            write(renderpandoc(meta, lines, args.template or '', extra))
+        except subprocess.CalledProcessError as e:
+            error('pandoc failed.', e.returncode)
@@ -16,30 +16,300 @@
 #  You should have received a copy of the GNU General Public License
 #  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
 
-"""serve.py - test Web server"""
+"""serve.py - test Web server
 
-import os
+Each request is handled in its own thread, so that a slow client doesn't
+hold up the others.  Files are sent with sendfile().  If a file has an
+up-to-date .br or .gz sibling (see compress.py) then that is sent instead
+to clients that accept it.  Every response has an ETag and Last-Modified
+date, and conditional requests are answered with 304 Not Modified.
+
+When the site has a web root (e.g., a site-url of
+https://example.com/blog/), the site is served under it just as it will
+be when deployed, and / redirects there.
+
+With --watch, the site is rebuilt whenever its sources change (see
+watch.py).  Each html page that is served gets a script that listens for
+server-sent events, and the browser reloads the page after each build.
+"""
+
+import datetime
+import email.utils
+import functools
 import http.server
-import socketserver
+import io
+import os
+import os.path
 import signal
 import sys
+import threading
+import urllib.parse
+
+from http import HTTPStatus
+
+from bassclef.util import getconfig, getjobs, cachepath, readjson, write, \
+     error
+
+
+# Precompressed sibling extensions, in order of preference, keyed by
+# content encoding
+ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+# The (mtime, data) of the 'bcms compress' manifest; see compress.py
+MANIFEST = None, {}
+
+# Live reload.  The script is added to html pages in watch mode; it reloads
+# the page when a reload event arrives.
+RELOAD_PATH = '/.bcms/reload'
+RELOAD_SCRIPT = b'<script>new EventSource("%s").onmessage = ' \
+                b'function() { location.reload(); };</script>\n' % \
+                RELOAD_PATH.encode()
+
+# The number of builds so far; handlers wait on BUILDS for it to change
+BUILDS = threading.Condition()
+GENERATION = 0
+
+# Seconds between keepalive comments on the event stream.  A failed write
+# tells us that the browser has gone away.
+KEEPALIVE = 15
+
+
+class Handler(http.server.SimpleHTTPRequestHandler):
+    """Serves the files in the directory, adding compression and caching
+    support to SimpleHTTPRequestHandler."""
+
+    # Keep connections alive; every response has a Content-Length
+    protocol_version = 'HTTP/1.1'
+
+    # The web root to redirect / to, or ''
+    webroot = ''
+
+    # Flags that pages should reload themselves after each build
+    livereload = False
+
+    def do_GET(self):
+        """Serves a GET request."""
+        if self.livereload and self.path == RELOAD_PATH:
+            self.send_events()
+        else:
+            super().do_GET()
+
+    def send_events(self):
+        """Sends a reload event after each build until the client goes
+        away."""
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        with BUILDS:
+            generation = GENERATION
+        try:
+            while True:
+                with BUILDS:
+                    BUILDS.wait_for(lambda: GENERATION != generation,
+                                    KEEPALIVE)
+                    latest = GENERATION
+                if latest != generation:
+                    generation = latest
+                    self.wfile.write(b'data: reload\n\n')
+                else:
+                    self.wfile.write(b': keepalive\n\n')
+                self.wfile.flush()
+        except OSError:  # The connection was closed
+            pass
 
-from bassclef.util import write
+    def send_head(self):
+        """Sends the response headers for a GET or HEAD request.  Returns the
+        open file to send, or None."""
 
-socketserver.TCPServer.allow_reuse_address = True
+        parts = urllib.parse.urlsplit(self.path)
+        if self.webroot and parts.path == '/':
+            self.send_response(HTTPStatus.FOUND)
+            self.send_header('Location', '/%s/' % self.webroot)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
 
-PORT = 8000
+        # Leave redirects and directory listings to the superclass
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            index = os.path.join(path, 'index.html')
+            if not parts.path.endswith('/') or not os.path.isfile(index):
+                return super().send_head()
+            path = index
+        if path.endswith('/'):
+            self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
+            return None
 
-def serve():
+        # Html pages get the live reload script, and so can't be sent
+        # precompressed
+        ctype = self.guess_type(path)
+        inject = self.livereload and ctype == 'text/html'
+        encoding, path = (None, path) if inject else self.negotiate(path)
+        try:
+            f = open(path, 'rb')  # pylint: disable=consider-using-with
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, 'File not found')
+            return None
+
+        try:
+            fs = os.fstat(f.fileno())
+            etag = '"%x-%x%s%s"' % (fs.st_mtime_ns, fs.st_size,
+                                    '-' + encoding if encoding else '',
+                                    '-live' if inject else '')
+            if self.isfresh(etag, fs.st_mtime):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_cache_headers(etag)
+                self.end_headers()
+                f.close()
+                return None
+            size = fs.st_size
+            if inject:
+                html = addscript(f.read())
+                f.close()
+                f, size = io.BytesIO(html), len(html)
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-type', ctype)
+            self.send_header('Content-Length', str(size))
+            if encoding:
+                self.send_header('Content-Encoding', encoding)
+            self.send_header('Last-Modified',
+                             self.date_time_string(fs.st_mtime))
+            self.send_cache_headers(etag)
+            self.end_headers()
+            return f
+        except BaseException:
+            f.close()
+            raise
+
+    def send_cache_headers(self, etag):
+        """Sends the caching headers.  Browsers must revalidate every time,
+        because this is a preview of a site that is being edited."""
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+
+    def negotiate(self, path):
+        """Returns the (encoding, path) of the precompressed sibling of the
+        file at path that the client accepts, or (None, path)."""
+        accepted = set()
+        for item in self.headers.get('Accept-Encoding', '').split(','):
+            coding, *params = [s.strip() for s in item.split(';')]
+            params = dict(p.split('=', 1) for p in params if '=' in p)
+            try:
+                if float(params.get('q', 1)) > 0:
+                    accepted.add(coding.lower())
+            except ValueError:
+                pass
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, path
+
+        # The 'bcms compress' manifest says which siblings were made from
+        # the file as it is now.  Otherwise, any newer sibling will do.
+        entry = compressed().get(path)
+        if entry and entry[0] != [st.st_mtime_ns, st.st_size]:
+            entry = None
+        for encoding, ext in ENCODINGS.items():
+            if encoding in accepted or '*' in accepted:
+                if entry and encoding not in entry[2]:
+                    continue
+                try:
+                    if os.stat(path + ext).st_mtime_ns >= st.st_mtime_ns:
+                        return encoding, path + ext
+                except OSError:
+                    pass
+        return None, path
+
+    def isfresh(self, etag, mtime):
+        """Returns True if the client's cached copy is up to date."""
+
+        # If-None-Match takes precedence over If-Modified-Since
+        if 'If-None-Match' in self.headers:
+            tags = [tag.strip() for tag in
+                    self.headers['If-None-Match'].split(',')]
+            return '*' in tags or etag in tags or 'W/' + etag in tags
+
+        if 'If-Modified-Since' in self.headers:
+            try:
+                ims = email.utils.parsedate_to_datetime(
+                    self.headers['If-Modified-Since'])
+            except (TypeError, IndexError, OverflowError, ValueError):
+                return False
+            if ims.tzinfo is None:
+                ims = ims.replace(tzinfo=datetime.timezone.utc)
+            modified = datetime.datetime.fromtimestamp(
+                mtime, datetime.timezone.utc).replace(microsecond=0)
+            return modified <= ims
+
+        return False
+
+    def copyfile(self, source, outputfile):
+        """Copies the source file to the client using sendfile().  In-memory
+        files are sent normally."""
+        outputfile.flush()
+        self.connection.sendfile(source)
+
+
+def compressed():
+    """Returns the 'bcms compress' manifest.  It is reread when it
+    changes."""
+    global MANIFEST  # pylint: disable=global-statement
+    path = cachepath('compress.json')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return {}
+    if MANIFEST[0] != mtime:
+        MANIFEST = mtime, readjson(path, {})
+    return MANIFEST[1]
+
+
+def addscript(html):
+    """Returns the html bytes with the live reload script added."""
+    i = html.rfind(b'</body>')
+    if i == -1:
+        return html + RELOAD_SCRIPT
+    return html[:i] + RELOAD_SCRIPT + html[i:]
+
+
+def reload():
+    """Tells the browsers to reload their pages."""
+    global GENERATION  # pylint: disable=global-statement
+    with BUILDS:
+        GENERATION += 1
+        BUILDS.notify_all()
+
+
+def serve(args):
     """Runs a test server."""
 
-    os.chdir('www')
+    if args.watch and not os.path.exists('config.ini'):
+        error('config.ini not found.')
+    if not args.watch and not os.path.isdir('www'):
+        error('www/ not found.')
+    os.makedirs('www', exist_ok=True)
+
+    # The web root is only known if there is a config
+    if os.path.exists('config.ini'):
+        Handler.webroot = getconfig('web-root')
 
     # Set up the server
-    http_request_handler = http.server.SimpleHTTPRequestHandler
-    httpd = socketserver.TCPServer(('', PORT), http_request_handler)
+    handler = functools.partial(Handler, directory='www')
+    try:
+        httpd = http.server.ThreadingHTTPServer((args.host, args.port),
+                                                handler)
+    except OSError as e:
+        error('Could not serve at %s:%d: %s' % (args.host, args.port,
+                                                 e.strerror))
 
-    write('Serving at http://127.0.0.1:%d/ (^C to exit)...\n'%PORT)
+    url = 'http://%s:%d/' % (args.host or '127.0.0.1', args.port)
+    if Handler.webroot:
+        url += Handler.webroot + '/'
+    write('Serving at %s (^C to exit)...\n' % url)
 
     # Catch ^C and exit gracefully
     def signal_handler(sig, frame):  # pylint: disable=unused-argument
@@ -48,5 +318,14 @@ def serve():
         sys.exit(0)
     signal.signal(signal.SIGINT, signal_handler)
 
-    httpd.serve_forever()
-
+    if args.watch:
+        # Serve from a thread, and watch from this one so that ^C works.
+        # The watch module imports the build engine, and so is only
+        # imported when needed.
+        # pylint: disable=import-outside-toplevel
+        from bassclef.watch import watch
+        Handler.livereload = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        watch(getjobs(args.jobs, os.cpu_count()), callback=reload)
+    else:
+        httpd.serve_forever()
@@ -0,0 +1,212 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""synth.py - generates synthetic sites for benchmarking.
+
+A synthetic site is initialized with 'bcms init --extras', and then given:
+
+  * posts with YAML metadata and link-dense, footnote-heavy bodies, some
+    with an image and all with a cut point;
+  * composed (.md.in) indexes that list the posts, newest first, each
+    post being listed in several of them (the fan-out); and
+  * PNG images for the posts.
+
+The content is generated from a seeded random number generator, and so
+the same parameters always give the same site.  The parameters are
+recorded in synthetic.json.
+"""
+
+import datetime
+import json
+import os
+import os.path
+import random
+import re
+import shutil
+import struct
+import subprocess
+import zlib
+
+from bassclef.util import readjson
+
+
+# Words for the generated prose
+WORDS = ('the of and to in is that for it as was with be by on not he this '
+         'are or his from at which but have an they you were her she there '
+         'one all we their been has more when will would who so no climate '
+         'science policy data ocean atmosphere measurement report budget '
+         'research funding laboratory satellite carbon emissions lidar '
+         'government minister scientist canada water').split()
+
+# Image dimensions
+IMAGESIZE = 640, 480
+
+# The name of the file recording the parameters
+MARKER = 'synthetic.json'
+
+
+def sentence(rng, refs):
+    """Returns a sentence with some reference links, inline links and
+    footnotes.  refs is a list of the reference names used so far."""
+    words = rng.choices(WORDS, k=rng.randint(8, 20))
+    words[0] = words[0].capitalize()
+    # Link distinct words, so that links aren't nested
+    for i in rng.sample(range(len(words)), rng.randint(1, 3)):
+        if rng.random() < 0.7:
+            refs.append('r%d' % len(refs))
+            words[i] = '[%s][%s]' % (words[i], refs[-1])
+        else:
+            words[i] = '[%s](https://example.org/%s)' % (words[i], words[i])
+    return ' '.join(words) + '.'
+
+
+def post(rng, n, date, image):
+    """Returns the markdown for post n with the given date and image
+    path."""
+    refs, notes = [], []
+    title = 'Post %d about %s' % (n, ' '.join(rng.sample(WORDS, 3)))
+    subtitle = ' '.join(rng.choices(WORDS, k=8)).capitalize()
+    lines = ['---\n',
+             'title: %s\n' % title,
+             'subtitle: %s\n' % subtitle,
+             'author: A. Writer\n',
+             'date: %s\n' % date.strftime('%d %B %Y')]
+    if image:
+        lines.append('image: /%s\n' % image)
+    lines += ['...\n', '\n']
+    if image:
+        lines += ['<!-- image -->\n', '\n']
+
+    for p in range(rng.randint(4, 10)):
+        text = ' '.join(sentence(rng, refs) for _ in range(rng.randint(2, 6)))
+        if rng.random() < 0.5:
+            notes.append(len(notes) + 1)
+            text += '[^%d]' % notes[-1]
+        lines += [text + '\n', '\n']
+        if p == 1:
+            lines += ['<!-- cut -->\n', '\n']
+
+    lines += ['[%s]: https://example.com/%s\n' % (ref, ref) for ref in refs]
+    lines.append('\n')
+    lines += ['[^%d]: %s\n' % (note, sentence(rng, [])) for note in notes]
+    return ''.join(lines)
+
+
+def png(width, height, shade):
+    """Returns the bytes of a grayscale PNG image with a gradient."""
+    def chunk(kind, data):
+        """Returns a PNG chunk."""
+        return struct.pack('>I', len(data)) + kind + data + \
+          struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+    rows = b''.join(b'\x00' + bytes((x + y + shade) % 256
+                                    for x in range(width))
+                    for y in range(height))
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + \
+      chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+
+def setconfig(name, value):
+    """Sets the value of an item in config.ini.  Missing items are added
+    to the end."""
+    with open('config.ini', encoding='utf-8') as f:
+        config = f.read()
+    config, n = re.subn(r'(?m)^%s *=.*$' % re.escape(name),
+                        '%s = %s' % (name, value), config)
+    if not n:
+        config = config.rstrip('\n') + '\n%s = %s\n' % (name, value)
+    with open('config.ini', 'w', encoding='utf-8') as f:
+        f.write(config)
+
+
+def generate(path, params):
+    """Generates a synthetic site in the directory at path, which must not
+    exist.
+
+    params - a dict giving the number of 'posts', 'indexes' and 'images',
+             the 'fanout' and the random 'seed'
+    """
+
+    os.makedirs(path)
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        subprocess.run(['bcms', 'init', '--extras'],
+                       stdout=subprocess.DEVNULL, check=True)
+
+        # Replace the example markdown, but keep the make module
+        for name in os.listdir('markdown'):
+            if not name.startswith('.'):
+                name = os.path.join('markdown', name)
+                if os.path.isdir(name):
+                    shutil.rmtree(name)
+                else:
+                    os.remove(name)
+        os.makedirs('markdown/posts')
+        os.makedirs('images', exist_ok=True)
+
+        rng = random.Random(params['seed'])
+        start = datetime.date(2015, 1, 1)
+
+        # Images
+        images = []
+        for n in range(params['images']):
+            images.append('images/synthetic-%03d.png' % n)
+            with open(images[-1], 'wb') as f:
+                f.write(png(*IMAGESIZE, shade=n*37))
+
+        # Posts.  The images are spread evenly over them.
+        posts = []
+        step = max(1, params['posts'] // max(1, len(images)))
+        for n in range(params['posts']):
+            date = start + datetime.timedelta(days=n)
+            image = images[n // step] \
+              if n % step == 0 and n // step < len(images) else None
+            posts.append('markdown/posts/%s_post-%04d.md' %
+                         (date.isoformat(), n))
+            with open(posts[-1], 'w', encoding='utf-8') as f:
+                f.write(post(rng, n, date, image))
+
+        # Indexes.  Post n is listed in indexes n, n+1, ..., n+fanout-1
+        # (modulo the number of indexes).
+        indexes = ['markdown/index-%d.md.in' % i
+                   for i in range(params['indexes'])]
+        fanout = min(params['fanout'], len(indexes))
+        for i, index in enumerate(indexes):
+            listed = [p for n, p in enumerate(posts)
+                      if (i - n) % len(indexes) < fanout]
+            with open(index, 'w', encoding='utf-8') as f:
+                f.write('---\ntitle: Index %d\nrsstitle: Index %d\n'
+                        'page-size: 20\n...\n\nThe latest posts.\n\n' %
+                        (i, i))
+                f.writelines(p + '\n' for p in reversed(listed))
+
+        setconfig('site-url', 'https://example.com')
+        setconfig('posted-in', ', '.join(indexes))
+
+        with open(MARKER, 'w', encoding='utf-8') as f:
+            json.dump(params, f, sort_keys=True)
+
+    finally:
+        os.chdir(cwd)
+
+
+def readparams(path):
+    """Returns the parameters of the synthetic site at path, or None if it
+    isn't one."""
+    return readjson(os.path.join(path, MARKER), None)
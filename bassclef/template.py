@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""template.py - fills pandoc templates without calling pandoc.
+
+Only the common subset of the pandoc template language is supported:
+$var$, $if(var)$...$else$...$endif$ and $$.  As with pandoc, a line that
+holds nothing but directives is dropped along with its newline.  The
+$include()$ statements should be expanded beforehand using pandoc-tpp.
+"""
+
+import re
+
+
+# Template directives
+DIRECTIVE = re.compile(r'\$(?:(\$)|if\(([\w-]+)\)\$|(else)\$|(endif)\$|'
+                       r'([\w-]+)\$)')
+DIRECTIVES = re.compile(r'^\s*(\$(if\([\w-]+\)|else|endif)\$\s*)+$')
+
+# Keywords used by the pandoc template features that aren't supported
+UNSUPPORTED = ['endfor', 'sep']
+
+
+def parse(lines):
+    """Parses the template lines into a tree of text, variable and
+    conditional nodes.
+
+    A ValueError is raised for templates that use unsupported features.
+    """
+
+    # A conditional node is ('if', name, [true nodes], [false nodes]).  The
+    # stack holds (nodes, conditional) pairs for the node list being added
+    # to and the conditional it belongs to.
+    tree = []
+    stack = [(tree, None)]
+
+    for line in lines:
+
+        # Drop the whitespace and newline for lines with only directives
+        if DIRECTIVES.match(line):
+            line = line.strip()
+
+        pos = 0
+        for match in DIRECTIVE.finditer(line):
+            text = line[pos:match.start()]
+            if '$' in text:
+                raise ValueError('Unsupported template feature: %s' % text)
+            nodes, node = stack[-1]
+            nodes.append(text)
+            pos = match.end()
+            dollar, condition, else_, endif, name = match.groups()
+            if dollar:
+                nodes.append('$')
+            elif condition:
+                node = ('if', condition, [], [])
+                nodes.append(node)
+                stack.append((node[2], node))
+            elif else_ or endif:
+                if node is None:
+                    raise ValueError('$%s$ without $if()$' % (else_ or endif))
+                stack.pop()
+                if else_:
+                    stack.append((node[3], node))
+            elif name in UNSUPPORTED:
+                raise ValueError('Unsupported template feature: $%s$' % name)
+            else:
+                nodes.append(('var', name))
+        text = line[pos:]
+        if '$' in text:
+            raise ValueError('Unsupported template feature: %s' % text)
+        stack[-1][0].append(text)
+
+    if len(stack) != 1:
+        raise ValueError('$if()$ without $endif$')
+
+    return tree
+
+
+def render(tree, variables):
+    """Renders the parsed template tree using the variables dict.
+
+    Values are used verbatim and so should already be html.  Variables that
+    are missing or empty are false in conditionals.
+    """
+    out = []
+    for node in tree:
+        if isinstance(node, str):
+            out.append(node)
+        elif node[0] == 'var':
+            out.append(variables.get(node[1], ''))
+        elif variables.get(node[1]):
+            out.append(render(node[2], variables))
+        else:
+            out.append(render(node[3], variables))
+    return ''.join(out)
@@ -0,0 +1,259 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""trace.py - records where the build time goes.
+
+A build runs many processes: make recipes, bcms commands, pandoc, convert,
+and so on.  When BCMS_TRACE gives the path to a trace file, each of these
+appends a span to it recording its wall time, CPU time and peak resident
+memory (RSS):
+
+  * bcms commands record themselves (see bcms.py);
+  * other programs are run through this module, e.g.,
+
+      python3 -m bassclef.trace pandoc ...
+
+    which records the program's resource usage when it exits.  The
+    Makefile's SHELL is wrapped like this by 'bcms make --trace', and so
+    every recipe is recorded too.  The bcms commands wrap the programs
+    they run (pandoc, convert, ...) using traced().
+
+Spans are written as JSON lines in the Chrome trace event format.  After
+the build, they are collected into a trace that can be loaded into
+chrome://tracing or https://ui.perfetto.dev, and summarized by stage and
+by file.  The wrappers add some startup time to each program they run,
+but this is not counted in the programs' spans.
+"""
+
+import contextlib
+import json
+import os
+import os.path
+import resource
+import sys
+import time
+
+# This module is run as a wrapper for every recipe and program in a traced
+# build, and so it starts as quickly as possible.  The bassclef utilities
+# are only imported for the reports, and programs are spawned without the
+# subprocess module.
+
+
+# The environment variable giving the path to the trace file
+ENV = 'BCMS_TRACE'
+
+# The number of files listed in the summary
+TOP = 10
+
+
+def tracepath():
+    """Returns the path to the trace file, or None if not tracing."""
+    return os.environ.get(ENV) or None
+
+
+def traced(command):
+    """Returns the command with a wrapper that records it in the trace, or
+    the command itself if not tracing."""
+    if not tracepath():
+        return command
+    return [sys.executable, '-m', 'bassclef.trace'] + command
+
+
+def record(name, start, end, cpu, rss, **args):
+    """Appends a span to the trace file.
+
+    name - the name of the stage (e.g., the program)
+    start, end - the wall clock times in seconds
+    cpu - the CPU time (user + system) in seconds
+    rss - the peak resident memory in kB
+    args - other details, e.g., the file processed
+    """
+    args.update({'cpu_ms': round(cpu*1000, 3), 'rss_kb': rss})
+    event = {'name': name, 'cat': 'build', 'ph': 'X',
+             'ts': round(start*1e6), 'dur': round((end-start)*1e6),
+             'pid': 0, 'tid': os.getpid(), 'args': args}
+    line = (json.dumps(event) + '\n').encode('utf-8')
+
+    # Appends of a single write() don't interleave with those made by other
+    # processes
+    fd = os.open(tracepath(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def span(name, start=None, **args):
+    """Records the enclosed block as a span of this process, if tracing.
+    The CPU time and peak RSS are those of the process so far.
+
+    start - the start time, if the span began before the block
+    """
+    if not tracepath():
+        yield
+        return
+    start = start or time.time()
+    try:
+        yield
+    finally:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        record(name, start, time.time(), usage.ru_utime + usage.ru_stime,
+               usage.ru_maxrss, **args)
+
+
+def target(command):
+    """Returns the file written by a shell command line, if it can be
+    found, or ''."""
+    words = command.split()
+    paths = [words[i+1] for i, word in enumerate(words[:-1])
+             if word in ['>', '-o', '--output']]
+    return paths[-1].rstrip(';') if paths else ''
+
+
+def run(command):
+    """Runs the command, and records its span.  Returns the exit code."""
+
+    # A shell run by make records the recipe and the file it makes
+    if len(command) > 2 and command[-2] == '-c':
+        name, args = 'recipe', {'command': command[-1],
+                                'file': target(command[-1])}
+    else:
+        name, args = os.path.basename(command[0]), \
+                     {'command': ' '.join(command)}
+
+    start = time.time()
+    try:
+        pid = os.posix_spawnp(command[0], command, os.environ)
+    except OSError as e:
+        sys.stderr.write('%s: %s\n' % (command[0], e.strerror))
+        return 127
+    while True:
+        try:
+            _, status, usage = os.wait4(pid, 0)
+            break
+        except KeyboardInterrupt:  # Wait for the program to exit too
+            continue
+    record(name, start, time.time(), usage.ru_utime + usage.ru_stime,
+           usage.ru_maxrss, **args)
+    return os.waitstatus_to_exitcode(status)
+
+
+def readspans(path):
+    """Returns the spans from the trace file at path."""
+    spans = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                spans.append(json.loads(line))
+            except ValueError:  # A process was killed mid-write
+                pass
+    return spans
+
+
+def export(spans, path):
+    """Writes the spans as a Chrome trace to path.  Times are made relative
+    to the start of the build."""
+    t0 = min((s['ts'] for s in spans), default=0)
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': 0,
+               'args': {'name': 'bcms build'}}]
+    events += [dict(s, ts=s['ts']-t0) for s in spans]
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def summarize(spans, top=TOP):
+    """Writes a summary table of the stages, and of the slowest files."""
+    # pylint: disable=import-outside-toplevel
+    from bassclef.util import write
+
+    # Recipes contain the other stages
+    recipes = [s for s in spans if s['name'] == 'recipe']
+    stages = {}
+    for s in spans:
+        if s['name'] != 'recipe':
+            stages.setdefault(s['name'], []).append(s)
+
+    wall = (max(s['ts'] + s['dur'] for s in spans) -
+            min(s['ts'] for s in spans))/1000 if spans else 0
+    write('Traced %d spans over %.2f s.\n\n' % (len(spans), wall/1000))
+
+    write('%-16s %6s %11s %11s %11s %9s\n' %
+          ('stage', 'count', 'wall ms', 'cpu ms', 'max ms', 'rss MB'))
+    rows = sorted(stages.items(), key=lambda item:
+                  -sum(s['dur'] for s in item[1]))
+    for name, group in rows:
+        write('%-16s %6d %11.1f %11.1f %11.1f %9.1f\n' %
+              (name[:16], len(group),
+               sum(s['dur'] for s in group)/1000,
+               sum(s['args']['cpu_ms'] for s in group),
+               max(s['dur'] for s in group)/1000,
+               max(s['args']['rss_kb'] for s in group)/1024))
+
+    if recipes:
+        write('\n%-40s %11s %11s %9s\n' %
+              ('slowest files', 'wall ms', 'cpu ms', 'rss MB'))
+        for s in sorted(recipes, key=lambda s: -s['dur'])[:top]:
+            name = s['args']['file'] or s['args']['command']
+            if len(name) > 40:
+                name = '...' + name[-37:]
+            write('%-40s %11.1f %11.1f %9.1f\n' %
+                  (name, s['dur']/1000, s['args']['cpu_ms'],
+                   s['args']['rss_kb']/1024))
+
+
+def spanspath():
+    """Returns the path to the trace file kept in the build cache."""
+    # pylint: disable=import-outside-toplevel
+    from bassclef.util import cachepath
+    return cachepath('trace.jsonl')
+
+
+def chromepath():
+    """Returns the path to the Chrome trace kept in the build cache."""
+    # pylint: disable=import-outside-toplevel
+    from bassclef.util import cachepath
+    return cachepath('trace.json')
+
+
+def report():
+    """Exports the trace in the build cache as a Chrome trace, and
+    summarizes it."""
+    # pylint: disable=import-outside-toplevel
+    from bassclef.util import write
+    spans = readspans(spanspath())
+    export(spans, chromepath())
+    write('\n')
+    summarize(spans)
+    write('\nChrome trace written to %s.\n' % chromepath())
+
+
+def trace(args):
+    """Summarizes the last trace recorded by 'bcms make --trace'."""
+    # pylint: disable=import-outside-toplevel
+    from bassclef.util import error
+    if not os.path.exists(spanspath()):
+        error('No trace found.  Run \'bcms make --trace\' first.')
+    spans = readspans(spanspath())
+    if args.chrome:
+        export(spans, args.chrome)
+    summarize(spans, args.top)
+
+
+if __name__ == '__main__':
+    sys.exit(run(sys.argv[1:]))
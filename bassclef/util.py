@@ -19,6 +19,7 @@
 """util.py - utility functions for bassclef."""
 
 import configparser
+import glob
 import re
 import urllib.parse
 import sys
@@ -26,8 +27,11 @@ import os
 import io
 import subprocess
 import copy
+import hashlib
+import json
+import tempfile
 
-import yaml
+from bassclef import jobserver
 
 
 # Py3 strings are unicode: https://docs.python.org/3.5/howto/unicode.html.
@@ -41,6 +45,13 @@ STDERR = io.TextIOWrapper(sys.stderr.buffer, 'utf-8', 'strict')
 # Global data stores.  These data should not change in a single execution.
 CONFIG = None
 META = {}
+POSTEDIN = None  # Reverse index from .md paths to the .md.in files
+METADB = None  # Connection to the persistent metadata cache
+
+# Project-local directory for build state that persists between builds.
+# It may be set using cache-dir in config.ini.
+CACHEDIR = '.bcms'
+CACHE = None  # The directory in use
 
 
 def getconfig(key=None):
@@ -77,6 +88,20 @@ def getconfig(key=None):
     return config[key] if key else copy.deepcopy(config)
 
 
+def getjobs(jobs=None, default=1):
+    """Returns the number of parallel jobs to use.
+
+    jobs - the number requested on the command line, if any
+
+    Otherwise the BCMS_JOBS environment variable is used, or the number of
+    job slots shared by make's jobserver (see jobserver.py), with the given
+    default.
+    """
+    if jobs is None:
+        jobs = os.environ.get('BCMS_JOBS') or jobserver.getjobs() or default
+    return max(int(jobs), 1)
+
+
 def getmeta(path, key=None):
     """Returns the metadata dict for the file at path.
 
@@ -94,25 +119,10 @@ def getmeta(path, key=None):
     meta = getconfig()
 
     # Read metadata from the file
-    with open(path) as f:
-
-        # Check for a YAML block at the top of the file
-        if f.readline() != '---\n':
-            return meta[key] if key else meta
-
-        # Read in the metadata block
-        lines = ['---']
-        for line in f:
-            lines.append(line)
-            if line == '...\n':  # Signifies end of the metadata block
-                break
-
-    # Confirm the end of the metadata block was found
-    if lines[-1] != '...\n':
-        raise RuntimeError('End of YAML metadata block not found.')
-
-    # Parse the metadata
-    meta.update(yaml.load('\n'.join(lines), Loader=yaml.BaseLoader))
+    data = readyaml(path)
+    if data is None:
+        return meta[key] if key else meta
+    meta.update(data)
 
     # Add a quoted title
     if 'title' in meta:
@@ -126,9 +136,11 @@ def getmeta(path, key=None):
         tokens = meta['posted-in'].replace(' ', '').split(',')
         if tokens == ['']:
             tokens = []
-        posted_in = [p for p in tokens if path in open(p).read()]
-        for p in posted_in:
-            assert os.path.exists(p)
+        for p in tokens:
+            if not os.path.isfile(p):
+                error('posted-in lists %s, which does not exist.' % p)
+        listed_in = postedin(path)
+        posted_in = [p for p in tokens if p in listed_in]
         titles = [getmeta(p)['title'] for p in posted_in]
         urls = [p[8:].replace('.md.in', '.html') for p in posted_in]
         meta['posted-in'] = posted_in
@@ -146,6 +158,156 @@ def getmeta(path, key=None):
     return meta[key] if key else meta
 
 
+def readyaml(path):
+    """Returns the dict parsed from the YAML metadata block at the top of the
+    file at path, or None if there is no block.
+
+    The parsed blocks of the sources in markdown/ are kept in a cache that
+    is shared by all bcms processes, keyed by the file's path, mtime and
+    size.  Other files (e.g., composed markdown in the build cache) are
+    always parsed.
+    """
+
+    cached = path.startswith('markdown/')
+    if cached:
+        st = os.stat(path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        data = getcachedyaml(path, stamp)
+        if data is not None:
+            return data
+
+    with open(path) as f:
+
+        # Check for a YAML block at the top of the file
+        if f.readline() != '---\n':
+            return None
+
+        # Read in the metadata block
+        lines = ['---']
+        for line in f:
+            lines.append(line)
+            if line == '...\n':  # Signifies end of the metadata block
+                break
+
+    # Confirm the end of the metadata block was found
+    if lines[-1] != '...\n':
+        raise RuntimeError('End of YAML metadata block not found.')
+
+    # Parse the metadata.  yaml (like sqlite3) is slow to import and most
+    # commands never need it, so it is imported here.  Use libyaml if it is
+    # available.
+    import yaml  # pylint: disable=import-outside-toplevel
+    loader = getattr(yaml, 'CBaseLoader', yaml.BaseLoader)
+    data = yaml.load('\n'.join(lines), Loader=loader)
+
+    if cached:
+        putcachedyaml(path, stamp, data)
+    return data
+
+
+def metadb():
+    """Returns a connection to the persistent metadata cache database."""
+    global METADB  # pylint: disable=global-statement
+    if METADB is None:
+        import sqlite3  # pylint: disable=import-outside-toplevel
+        # Many bcms processes may use the database at once under 'make -j'.
+        # SQLite locks it for us; the write-ahead log lets readers proceed
+        # while another process writes.
+        db = sqlite3.connect(cachepath('meta.db'), timeout=30,
+                             check_same_thread=False)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS meta '
+                       '(path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, '
+                       'data TEXT)')
+        METADB = db
+    return METADB
+
+
+def getcachedyaml(path, stamp):
+    """Returns the cached YAML data for the file at path with the given
+    [mtime, size] stamp, or None.  The cache is only an optimization, and so
+    database errors are treated as misses."""
+    import sqlite3  # pylint: disable=import-outside-toplevel
+    try:
+        row = metadb().execute('SELECT mtime, size, data FROM meta '
+                               'WHERE path=?', (path,)).fetchone()
+    except sqlite3.Error:
+        return None
+    if row is None or list(row[:2]) != stamp:
+        return None
+    return json.loads(row[2])
+
+
+def putcachedyaml(path, stamp, data):
+    """Stores the YAML data for the file at path with the given [mtime,
+    size] stamp.  Database errors are ignored."""
+    import sqlite3  # pylint: disable=import-outside-toplevel
+    try:
+        with metadb() as db:
+            db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?, ?, ?)',
+                       (path, stamp[0], stamp[1], json.dumps(data)))
+    except sqlite3.Error:
+        pass
+
+
+def prunemeta():
+    """Removes the metadata cache entries for files that no longer exist,
+    and for any that aren't sources in markdown/.  Returns the number of
+    entries removed.  Database errors are ignored."""
+    import sqlite3  # pylint: disable=import-outside-toplevel
+    if not os.path.exists(cachepath('meta.db')):
+        return 0
+    try:
+        paths = [row[0] for row in
+                 metadb().execute('SELECT path FROM meta').fetchall()]
+        stale = [(p,) for p in paths
+                 if not p.startswith('markdown/') or not os.path.isfile(p)]
+        if stale:
+            with metadb() as db:
+                db.executemany('DELETE FROM meta WHERE path=?', stale)
+    except sqlite3.Error:
+        return 0
+    return len(stale)
+
+
+def postedin(path):
+    """Returns the .md.in files that list the .md file at path.
+
+    The reverse index is built from the .md.in listings and kept in the
+    build cache directory.  It is rebuilt whenever a .md.in file is added,
+    removed or changed.
+    """
+
+    global POSTEDIN  # pylint: disable=global-statement
+    if POSTEDIN is not None:
+        return POSTEDIN.get(path, [])
+
+    # Check the stored index against the current .md.in files
+    paths = glob.glob('markdown/*.md.in') + glob.glob('markdown/*/*.md.in')
+    stamps = {}
+    for p in sorted(paths):
+        st = os.stat(p)
+        stamps[p] = [st.st_mtime_ns, st.st_size]
+    indexpath = cachepath('postedin.json')
+    stored = readjson(indexpath, {})
+    if stored.get('stamps') == stamps:
+        POSTEDIN = stored['index']
+        return POSTEDIN.get(path, [])
+
+    # Rebuild the index
+    index = {}
+    for p in stamps:
+        for line in getcontent(p):
+            line = line.strip()
+            if line.endswith('.md') and p not in index.get(line, []):
+                index.setdefault(line, []).append(p)
+    writejson({'stamps': stamps, 'index': index}, indexpath)
+    POSTEDIN = index
+    return POSTEDIN.get(path, [])
+
+
 def sanitycheck(data):
     """Checks to see if the config/meta data are sane.  Make minor tweaks
     where necessary."""
@@ -208,6 +370,11 @@ def permalink(path):
 
 def getcontent(path):
     """Returns the content of a .md file as a list of lines."""
+    return list(itercontent(path))
+
+
+def itercontent(path):
+    """Generates the content lines of a .md file, one at a time."""
 
     with open(path) as f:
 
@@ -218,8 +385,8 @@ def getcontent(path):
         else:
             f.seek(0)
 
-        # Return the content
-        return [line for line in f]
+        # Generate the content
+        yield from f
 
 
 def write(line, f=STDOUT):
@@ -251,3 +418,50 @@ def which(name):
         return output.decode(encoding='UTF-8').strip()
     except subprocess.CalledProcessError:
         return None
+
+
+def cachedir():
+    """Returns the build cache directory."""
+    global CACHE  # pylint: disable=global-statement
+    if CACHE is None:
+        CACHE = CACHEDIR
+        if os.path.exists('config.ini'):
+            CACHE = getconfig().get('cache-dir') or CACHEDIR
+    return CACHE
+
+
+def cachepath(*names):
+    """Returns a path in the build cache directory.  Parent directories are
+    created as needed."""
+    path = os.path.join(cachedir(), *names)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def digest(*parts):
+    """Returns a hex digest for the given str/bytes parts."""
+    h = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(part)
+        h.update(b'\0')  # Separator; ('ab', 'c') and ('a', 'bc') differ
+    return h.hexdigest()
+
+
+def readjson(path, default=None):
+    """Returns the json data stored at path, or default if there is none."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def writejson(data, path):
+    """Writes data as json to path.  The file is replaced atomically so that
+    readers never see a partial write."""
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmppath, path)
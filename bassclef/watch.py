@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""watch.py - rebuilds the site whenever its sources change.
+
+The sources are polled a few times a second; polling a site's worth of
+files is cheap, and works everywhere.  When something changes, the site
+is rebuilt by build.py in this process.  The config, metadata, processed
+templates and content digests stay in memory between builds.  Only what
+the changes invalidate is forgotten, and so only the affected outputs are
+rebuilt, and the rebuild starts without any startup cost.
+"""
+
+import glob
+import os
+import stat
+import subprocess
+import time
+
+from bassclef import util, makevars, build, postprocess, bundle
+from bassclef.cache import locked, evict
+from bassclef.util import write, STDERR
+
+
+# The watched directories and files
+WATCHED = ['markdown', 'templates', 'images', 'css', 'fonts', 'javascript',
+           'config.ini']
+
+# Seconds between polls
+INTERVAL = 0.25
+
+
+def snapshot():
+    """Returns the [mtime, size] stamps of the watched files, keyed by
+    path."""
+    stamps = {}
+    for name in WATCHED:
+        if os.path.isdir(name):
+            paths = glob.glob(name + '/**/*', recursive=True)
+        else:
+            paths = [name]
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                stamps[path] = [st.st_mtime_ns, st.st_size]
+    return stamps
+
+
+def forget(paths):
+    """Forgets whatever is stored in memory that depends on the changed
+    paths."""
+
+    for path in paths:
+        build.HASHES.pop(path, None)
+
+    config = 'config.ini' in paths
+    if config:
+        util.CONFIG = None
+        util.CACHE = None
+
+    # The metadata for a page depends on the config and on the titles of the
+    # composed pages that list it.  Rereading it is cheap because parsed
+    # YAML is cached on disk by file stamp.
+    if config or any(p.startswith('markdown/') for p in paths):
+        util.META.clear()
+        util.POSTEDIN = None
+
+    # The processed templates link bundles of the stylesheets and scripts.
+    # These may also depend on the icons used in the templates and markdown.
+    if config or any(p.startswith(('templates/', 'markdown/', 'css/',
+                                   'javascript/')) for p in paths):
+        makevars.TEMPLATES.clear()
+        bundle.BUNDLES.clear()
+        bundle.BUNDLED.clear()
+        bundle.ICONS = None
+
+    if config or any(p.startswith('images/') for p in paths):
+        postprocess.IMAGES = None
+
+
+def rebuild(jobs, batch, callback):
+    """Rebuilds the site, calling callback() if anything was built.  Errors
+    are reported, and the previous outputs are left in place."""
+    start = time.time()
+    try:
+        with locked():
+            n = build.buildsite(jobs, batch=batch)
+            evict()
+    except subprocess.CalledProcessError as e:
+        write('Command failed: %s\n' % ' '.join(e.cmd), STDERR)
+        return
+    except SystemExit as e:
+        # util.error() has already written its message
+        write('Build failed (exit status %s).\n' % e.code, STDERR)
+        return
+    except Exception as e:  # pylint: disable=broad-except
+        # Keep watching after mistakes in the sources
+        write('Build failed: %s: %s\n' % (type(e).__name__, e), STDERR)
+        return
+    if n:
+        write('Built %d output%s in %.2f s.\n' %
+              (n, '' if n == 1 else 's', time.time() - start))
+        if callback:
+            callback()
+
+
+def watch(jobs, batch=False, callback=None):
+    """Builds the site, and then rebuilds it whenever the watched files
+    change.  Never returns.
+
+    jobs - the number of parallel build jobs
+    batch - render composed pages with 'bcms compose --batch'
+    callback - a function to call after each build that changed outputs
+    """
+
+    stamps = snapshot()
+    rebuild(jobs, batch, callback)
+    write('Watching for changes...\n')
+
+    while True:
+        time.sleep(INTERVAL)
+        latest = snapshot()
+        if latest == stamps:
+            continue
+        changed = {path for path in set(stamps) | set(latest)
+                   if stamps.get(path) != latest.get(path)}
+        stamps = latest
+        forget(changed)
+        rebuild(jobs, batch, callback)
@@ -41,7 +41,8 @@ setup(
     url='https://github.com/tomduck/bassclef',
     download_url='https://github.com/tomduck/bassclef/tarball/'+VERSION,
 
-    install_requires=['pyyaml', 'pandoc-tpp', 'PyRSS2Gen'],
+    install_requires=['pyyaml', 'pandoc-tpp'],
+    extras_require={'python-renderer': ['Markdown>=3']},
 
     packages=['bassclef'],
 
@@ -0,0 +1,129 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for bundle.py."""
+
+import unittest
+
+from bassclef.bundle import minifycss, rebase, pruneicons
+
+
+class TestMinifyCSS(unittest.TestCase):
+    """Tests minifycss()."""
+
+    def test_space(self):
+        """Tests collapsing space around punctuation."""
+        self.assertEqual(minifycss('body {\n  color: red ;\n'
+                                   '  margin: 0  auto;\n}\n'
+                                   'a:hover , p::before { top: 0 }\n'),
+                         'body{color:red;margin:0 auto}'
+                         'a:hover,p::before{top:0}')
+
+    def test_selectors(self):
+        """Tests that space before a colon, which may be a descendant
+        selector, is kept."""
+        self.assertEqual(minifycss('div :first-child { top: 0 }'),
+                         'div :first-child{top:0}')
+
+    def test_comments(self):
+        """Tests removing comments, except for licenses."""
+        self.assertEqual(minifycss('/*! License */\n'
+                                   '/* A comment */\n'
+                                   'a { /* Another */ top: 0; }\n'),
+                         '/*! License */\n a{top:0}')
+
+    def test_strings(self):
+        """Tests that strings are left alone."""
+        self.assertEqual(minifycss('a::before { content: "a  ;  /* b */"; }\n'
+                                   "b::after { content: '} ,' }\n"),
+                         'a::before{content:"a  ;  /* b */"}'
+                         "b::after{content:'} ,'}")
+
+    def test_media(self):
+        """Tests nested blocks."""
+        self.assertEqual(minifycss('@media (max-width: 600px) {\n'
+                                   '  .x { display: none; }\n'
+                                   '}\n'),
+                         '@media (max-width:600px){.x{display:none}}')
+
+
+class TestRebase(unittest.TestCase):
+    """Tests rebase()."""
+
+    SRC = 'css/font-awesome/css/font-awesome.css'
+    DEST = 'css/bundle-0123456789.css'
+
+    def test_relative(self):
+        """Tests rewriting relative urls."""
+        self.assertEqual(rebase('a{src:url(../fonts/a.woff)}',
+                                self.SRC, self.DEST),
+                         'a{src:url(font-awesome/fonts/a.woff)}')
+        self.assertEqual(rebase('a{src:url( "img/b.png" )}',
+                                self.SRC, self.DEST),
+                         'a{src:url("font-awesome/css/img/b.png")}')
+
+    def test_query(self):
+        """Tests that queries and fragments are kept."""
+        self.assertEqual(rebase("a{src:url('../fonts/a.eot?v=4.7#iefix')}",
+                                self.SRC, self.DEST),
+                         "a{src:url('font-awesome/fonts/a.eot?v=4.7#iefix')}")
+
+    def test_absolute(self):
+        """Tests that absolute urls are left alone."""
+        for css in ['a{src:url(/fonts/a.woff)}',
+                    'a{src:url(https://example.com/a.woff)}',
+                    'a{src:url(data:font/woff;base64,AAAA)}',
+                    'a{filter:url(#svgfilter)}']:
+            self.assertEqual(rebase(css, self.SRC, self.DEST), css)
+
+
+class TestPruneIcons(unittest.TestCase):
+    """Tests pruneicons()."""
+
+    def test_prune(self):
+        """Tests dropping the rules for unused icons."""
+        css = '.fa{display:inline-block}' \
+              '.fa-twitter:before{content:"a"}' \
+              '.fa-github:before{content:"b"}' \
+              '.fa-rss::before{content:"c"}'
+        self.assertEqual(pruneicons(css, {'twitter', 'rss'}),
+                         '.fa{display:inline-block}'
+                         '.fa-twitter:before{content:"a"}'
+                         '.fa-rss::before{content:"c"}')
+
+    def test_aliases(self):
+        """Tests rules for several icons, which are kept if any is used."""
+        css = '.fa-git:before,.fa-github:before{content:"b"}'
+        self.assertEqual(pruneicons(css, {'git'}), css)
+        self.assertEqual(pruneicons(css, set()), '')
+
+    def test_other_rules(self):
+        """Tests that rules selecting anything else are kept."""
+        for css in ['.fa-rss:before,.other{content:"c"}',
+                    '.fa-rss{color:red}',
+                    '.fa-spin{animation:fa-spin 2s infinite linear}']:
+            self.assertEqual(pruneicons(css, set()), css)
+
+    def test_media(self):
+        """Tests icon rules inside nested blocks."""
+        self.assertEqual(pruneicons('@media print{.fa-x:before{a:b}}', set()),
+                         '@media print{}')
+
+
+if __name__ == '__main__':
+    unittest.main()
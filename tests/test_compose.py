@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for compose.py."""
+
+import unittest
+
+from bassclef.compose import process
+from bassclef.bench import process_reference
+
+
+META = {'permalink': 'https://example.com/posts/a.html'}
+
+
+def processed(text, n=2):
+    """Returns the text processed for the n-th entry."""
+    return ''.join(process(text.splitlines(True), META, n))
+
+
+class TestProcess(unittest.TestCase):
+    """Tests process()."""
+
+    def test_references(self):
+        """Tests namespacing link references."""
+        self.assertEqual(processed('A [link][a] and [another][b].\n'),
+                         'A [link][2:a] and [another][2:b].\n')
+
+    def test_nested_labels(self):
+        """Tests references with brackets in their labels."""
+        self.assertEqual(processed('A [[nested] link][a].\n'),
+                         'A [[nested] link][2:a].\n')
+        self.assertEqual(processed('[a [b] c][d] [e][f]\n'),
+                         '[a [b] c][2:d] [e][2:f]\n')
+
+    def test_namespaced(self):
+        """Tests that namespaced references are left alone."""
+        self.assertEqual(processed('A [link][2:a].\n'), 'A [link][2:a].\n')
+        self.assertEqual(processed('A [link][1:a].\n', 1),
+                         'A [link][1:a].\n')
+
+    def test_definitions(self):
+        """Tests namespacing link definitions."""
+        self.assertEqual(processed('[a]: http://example.com/\n'),
+                         '[2:a]: http://example.com/\n')
+
+    def test_footnotes(self):
+        """Tests removing footnote references and definitions."""
+        text = 'Text[^1] and more[^note].\n' \
+               '\n' \
+               '[^1]: A note.\n' \
+               '[^note]: Another.\n' \
+               '\n' \
+               '    More of the note.\n' \
+               '\n' \
+               'After.\n'
+        self.assertEqual(processed(text), 'Text and more.\n\nAfter.\n')
+
+    def test_cut(self):
+        """Tests truncating at a cut point."""
+        text = 'Before [a][b].\n' \
+               '\n' \
+               '<!-- cut -->\n' \
+               '\n' \
+               'After.\n' \
+               '\n' \
+               '[b]: http://example.com/\n'
+        self.assertEqual(processed(text),
+                         'Before [a][2:b].\n'
+                         '\n'
+                         '[2:b]: http://example.com/\n'
+                         '\n'
+                         '[Read more...](%s)\n' % META['permalink'])
+
+    def test_reference(self):
+        """Compares process() with the original implementation."""
+        lines = ['A [link][a], [[nested] link][b] and [x][1:c].\n',
+                 '[a]: http://example.com/a\n',
+                 '[b]: http://example.com/b "Title"\n',
+                 'Text[^1] with [brackets] and ][ in it.\n',
+                 '\n',
+                 '[^1]: A note with a [link][a].\n',
+                 '    More of the note.\n',
+                 '\n',
+                 'Back in the text [a][].\n',
+                 '<!-- cut -->\n',
+                 'After the cut [a][b].\n',
+                 '[c]: http://example.com/c\n']
+        for n in range(3):
+            self.assertEqual(list(process(lines, META, n)),
+                             process_reference(lines, META, n))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for compress.py."""
+
+import gzip
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from bassclef.compress import process
+from bassclef.util import digest
+
+
+# The compressors, keyed by content encoding
+FUNCS = {'gzip': lambda data: gzip.compress(data, mtime=0)}
+
+# Compressible content
+DATA = b'<p>Some text that is repeated.</p>\n' * 20
+
+
+class TestProcess(unittest.TestCase):
+    """Tests process()."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'index.html')
+        self.write(DATA)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data, mtime=None):
+        """Writes data to the file, and sets its mtime in ns."""
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(self.path, ns=(mtime, mtime))
+
+    def sibling(self):
+        """Returns the decompressed .gz sibling, or None if it is missing."""
+        if not os.path.exists(self.path + '.gz'):
+            return None
+        with gzip.open(self.path + '.gz') as f:
+            return f.read()
+
+    def test_new(self):
+        """Tests compressing a file that isn't in the manifest."""
+        path, entry, written = process(self.path, None, FUNCS, False)
+        self.assertEqual(path, self.path)
+        self.assertTrue(written)
+        self.assertEqual(entry[1:], [digest(DATA), ['gzip']])
+        self.assertEqual(entry[0][1], len(DATA))
+        self.assertEqual(self.sibling(), DATA)
+
+    def test_unchanged(self):
+        """Tests that unchanged files aren't compressed again."""
+        _, entry, _ = process(self.path, None, FUNCS, False)
+        self.assertEqual(process(self.path, entry, FUNCS, False),
+                         (self.path, entry, False))
+
+    def test_touched(self):
+        """Tests a file with a new mtime but the same content."""
+        _, entry, _ = process(self.path, None, FUNCS, False)
+        mtime = entry[0][0] - 10**9
+        self.write(DATA, mtime)
+        os.utime(self.path + '.gz', ns=(mtime - 10**9, mtime - 10**9))
+        _, new, written = process(self.path, entry, FUNCS, False)
+        self.assertFalse(written)
+        self.assertEqual(new[0][0], mtime)
+        self.assertEqual(new[1:], entry[1:])
+        self.assertGreaterEqual(os.stat(self.path + '.gz').st_mtime_ns,
+                                mtime)
+
+    def test_changed(self):
+        """Tests a file with new content."""
+        _, entry, _ = process(self.path, None, FUNCS, False)
+        data = DATA + b'<p>More.</p>\n'
+        self.write(data, entry[0][0] + 10**9)
+        _, new, written = process(self.path, entry, FUNCS, False)
+        self.assertTrue(written)
+        self.assertEqual(new[1], digest(data))
+        self.assertEqual(self.sibling(), data)
+
+    def test_missing_sibling(self):
+        """Tests that a missing sibling is made again."""
+        _, entry, _ = process(self.path, None, FUNCS, False)
+        os.remove(self.path + '.gz')
+        _, _, written = process(self.path, entry, FUNCS, False)
+        self.assertTrue(written)
+        self.assertEqual(self.sibling(), DATA)
+
+    def test_force(self):
+        """Tests forcing compression."""
+        _, entry, _ = process(self.path, None, FUNCS, False)
+        _, new, written = process(self.path, entry, FUNCS, True)
+        self.assertTrue(written)
+        self.assertEqual(new, entry)
+
+    def test_incompressible(self):
+        """Tests that siblings that aren't smaller aren't kept."""
+        process(self.path, None, FUNCS, False)
+        data = bytes(range(256)) + os.urandom(256)
+        self.write(data)
+        _, entry, written = process(self.path, None, FUNCS, False)
+        self.assertTrue(written)
+        self.assertEqual(entry[2], [])
+        self.assertIsNone(self.sibling())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for feed.py."""
+
+import datetime
+import io
+import unittest
+
+from bassclef.feed import rsswriter, encode
+
+try:
+    import PyRSS2Gen as rss2
+except ImportError:
+    rss2 = None
+
+
+UPDATED = datetime.datetime(2020, 5, 4, 3, 2, 1, tzinfo=datetime.timezone.utc)
+
+ITEMS = [
+    {'title': 'A post', 'link': 'https://example.com/posts/a.html',
+     'pubdate': '2020-05-01', 'author': None, 'publisher': None,
+     'source': None,
+     'body': '<p>Some <em>text</em> &amp; a café.</p>\n'
+             '<figure><img src="/images/a.png" alt="An image" />'
+             '<figcaption style="font-size: 80%;">An image</figcaption>'
+             '</figure>\n'},
+    {'title': 'Quotes "and" <tags> — café',
+     'link': 'https://example.com/posts/b.html',
+     'pubdate': None, 'author': 'tom@example.com',
+     'publisher': 'Elsewhere', 'source': 'https://example.com/"src"',
+     'body': '<p>“Smart” quotes…</p>\n'}]
+
+
+def rss(channel, items):
+    """Returns the RSS feed written by rsswriter()."""
+    f = io.StringIO()
+    writer = rsswriter(f, channel)
+    next(writer)
+    for item in items:
+        writer.send(item)
+    writer.close()
+    return f.getvalue()
+
+
+def pyrss2gen(channel, items):
+    """Returns the RSS feed the way bassclef made it with PyRSS2Gen."""
+    rssitems = []
+    for item in items:
+        source = rss2.Source(item['publisher'], item['source']) \
+          if item['publisher'] and item['source'] else None
+        rssitems.append(rss2.RSSItem(
+            title=item['title'], link=item['link'],
+            pubDate=item['pubdate'], author=item['author'], source=source,
+            description=encode(item['body']), guid=rss2.Guid(item['link'])))
+    feed = rss2.RSS2(generator=None, docs=None, title=channel['title'],
+                     link=channel['link'], description=channel['subtitle'],
+                     lastBuildDate=channel['updated'].replace(tzinfo=None),
+                     items=rssitems)
+    return feed.to_xml()
+
+
+@unittest.skipIf(rss2 is None, 'PyRSS2Gen is not installed')
+class TestRSS(unittest.TestCase):
+    """Checks the RSS feed against PyRSS2Gen's."""
+
+    def test_feed(self):
+        """Tests a feed with a title and subtitle."""
+        channel = {'title': 'My Blog', 'subtitle': 'About things',
+                   'link': 'https://example.com/blog.html',
+                   'updated': UPDATED}
+        self.assertEqual(rss(channel, ITEMS), pyrss2gen(channel, ITEMS))
+
+    def test_untitled(self):
+        """Tests a feed without rsstitle or subtitle metadata."""
+        channel = {'title': None, 'subtitle': '',
+                   'link': 'https://example.com/blog.html',
+                   'updated': UPDATED}
+        self.assertEqual(rss(channel, ITEMS), pyrss2gen(channel, ITEMS))
+
+    def test_empty(self):
+        """Tests a feed without items."""
+        channel = {'title': 'My Blog', 'subtitle': '',
+                   'link': 'https://example.com/blog.html',
+                   'updated': UPDATED}
+        self.assertEqual(rss(channel, []), pyrss2gen(channel, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
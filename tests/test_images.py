@@ -0,0 +1,117 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for images.py.
+
+ImageMagick isn't needed: the conversions are replaced by copies.
+"""
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from bassclef import util, images
+from bassclef.images import makeimages, renditionspath
+from bassclef.util import readjson
+
+
+def convert(src, dest, geometry):  # pylint: disable=unused-argument
+    """Copies the image at src to dest."""
+    shutil.copyfile(src, dest)
+
+
+def dimensions(path):  # pylint: disable=unused-argument
+    """Returns made-up image dimensions."""
+    return [250, 100]
+
+
+class TestMakeImages(unittest.TestCase):
+    """Tests makeimages()."""
+
+    def setUp(self):
+        self.saved = (os.getcwd(), util.CONFIG, util.CACHE,
+                      images.convert, images.dimensions)
+        self.tmpdir = tempfile.mkdtemp()
+        os.chdir(self.tmpdir)
+        os.makedirs('images')
+        for name in ['a.png', 'b.jpg']:
+            self.writeimage(name, name.encode('ascii'))
+        util.CONFIG = {'web-root': '', 'image-geometry': '250x500',
+                       'image-widths': '', 'image-formats': 'webp'}
+        util.CACHE = '.bcms'
+        images.convert, images.dimensions = convert, dimensions
+
+    def tearDown(self):
+        os.chdir(self.saved[0])
+        util.CONFIG, util.CACHE, images.convert, images.dimensions = \
+          self.saved[1:]
+        shutil.rmtree(self.tmpdir)
+
+    @staticmethod
+    def writeimage(name, data):
+        """Writes an image to images/."""
+        with open(os.path.join('images', name), 'wb') as f:
+            f.write(data)
+
+    def test_outputs(self):
+        """Tests the outputs and the renditions file."""
+        self.assertEqual(makeimages(1), 6)
+        for path in ['originals/a.png', 'a.png', 'a.png.webp']:
+            self.assertTrue(os.path.isfile('www/images/' + path), path)
+        self.assertEqual(readjson(renditionspath())['a.png'],
+                         [['images/a.png', None, [250, 100]],
+                          ['images/a.png.webp', 'webp', [250, 100]]])
+
+    def test_uptodate(self):
+        """Tests that nothing is done a second time."""
+        makeimages(1)
+        mtime = os.stat(renditionspath()).st_mtime_ns
+        self.assertEqual(makeimages(1), 0)
+        self.assertEqual(os.stat(renditionspath()).st_mtime_ns, mtime)
+
+    def test_touched(self):
+        """Tests that touching an image doesn't change the renditions."""
+        makeimages(1)
+        mtime = os.stat(renditionspath()).st_mtime_ns
+        os.utime('images/a.png', ns=(1, 1))
+        self.writeimage('b.jpg', b'b.jpg')
+        self.assertEqual(makeimages(1), 0)
+        self.assertEqual(makeimages(1), 0)
+        self.assertEqual(os.stat(renditionspath()).st_mtime_ns, mtime)
+
+    def test_new(self):
+        """Tests adding an image."""
+        makeimages(1)
+        self.writeimage('c.gif', b'c.gif')
+        self.assertEqual(makeimages(1), 3)
+        self.assertEqual(makeimages(1), 0)
+        self.assertIn('c.gif', readjson(renditionspath()))
+
+    def test_changed(self):
+        """Tests changing an image."""
+        makeimages(1)
+        self.writeimage('a.png', b'new')
+        self.assertEqual(makeimages(1), 3)
+        with open('www/images/a.png', 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for jobserver.py."""
+
+import os
+import unittest
+from unittest import mock
+
+from bassclef import jobserver
+
+
+class TestJobserver(unittest.TestCase):
+    """Tests getjobs() and slot()."""
+
+    def setUp(self):
+        self.r, self.w = os.pipe()
+        os.write(self.w, b'++')  # Two slots beyond the one held by make's job
+        flags = ' -j3 --jobserver-auth=%d,%d' % (self.r, self.w)
+        patches = [mock.patch.dict(os.environ, {'MAKEFLAGS': flags}),
+                   mock.patch.object(jobserver, 'FDS', None),
+                   mock.patch.object(jobserver, 'FREE', True)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        os.close(self.r)
+        os.close(self.w)
+
+    def test_getjobs(self):
+        """Tests finding the jobserver."""
+        self.assertEqual(jobserver.getfds(), (self.r, self.w))
+        self.assertEqual(jobserver.getjobs(), 3)
+
+    def test_closed(self):
+        """Tests a jobserver that make didn't pass on."""
+        os.environ['MAKEFLAGS'] = ' -j3 --jobserver-auth=-2,-2'
+        self.assertEqual(jobserver.getfds(), ())
+        self.assertIsNone(jobserver.getjobs())
+
+    def test_slot(self):
+        """Tests that the process's own slot is used first, and that tokens
+        are given back."""
+        with jobserver.slot():
+            self.assertFalse(jobserver.FREE)
+            with jobserver.slot(), jobserver.slot():
+                os.set_blocking(self.r, False)
+                with self.assertRaises(BlockingIOError):
+                    os.read(self.r, 1)
+        self.assertTrue(jobserver.FREE)
+        self.assertEqual(os.read(self.r, 2), b'++')
+
+
+if __name__ == '__main__':
+    unittest.main()
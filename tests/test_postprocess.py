@@ -0,0 +1,174 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for postprocess.py."""
+
+import os
+import os.path
+import tempfile
+import unittest
+from unittest import mock
+
+from bassclef import util, postprocess
+from bassclef.postprocess import MARKER, transform, transformfile, \
+     content_body
+
+
+# The image renditions, as given in the 'bcms images' manifest
+IMAGES = {'a.png': [['images/a.png', None, [250, 100]],
+                    ['images/a-500.png', None, [500, 200]],
+                    ['images/a.webp', 'webp', [250, 100]]]}
+
+PAGE = '''\
+<html>
+<head>
+<title>1// Title</title>
+<p><meta name="description" content="A page" /></p>
+</head>
+<body>
+<div class="content-body">
+<p>Text.</p>
+<p><!-- cut --></p>
+<p><a href="/posts/a.html">A</a> <a href="/blog/b.html">B</a></p>
+<figure>
+<img src="/images/a.png" alt="A" /><figcaption>A</figcaption>
+</figure>
+<p><img src="/images/b.png" alt="B" /></p>
+<div class="social">
+<a href="https://twitter.com/share"><span class="fa fa-twitter"></span></a>
+</div>
+<!-- class="social" -->
+</div>
+<!-- class="content-body" -->
+</body>
+</html>
+'''
+
+
+class TestTransform(unittest.TestCase):
+    """Tests transform()."""
+
+    def setUp(self):
+        self.config, self.images = util.CONFIG, postprocess.IMAGES
+        util.CONFIG = {'web-root': 'blog'}
+        postprocess.IMAGES = IMAGES
+
+    def tearDown(self):
+        util.CONFIG, postprocess.IMAGES = self.config, self.images
+
+    def test_fixes(self):
+        """Tests the fixes for pandoc's output."""
+        html = transform(PAGE)
+        self.assertIn('<title>1. Title</title>', html)
+        self.assertIn('<meta name="description" content="A page" />\n',
+                      html)
+        self.assertNotIn('<p><meta', html)
+        self.assertIn('\n<!-- cut -->\n', html)
+
+    def test_urls(self):
+        """Tests putting the web root into urls, including urls for content
+        whose path starts with the web root's name."""
+        html = transform(PAGE)
+        self.assertIn('<a href="/blog/posts/a.html">A</a>', html)
+        self.assertIn('<a href="/blog/blog/b.html">B</a>', html)
+
+    def test_no_webroot(self):
+        """Tests urls for a site at the top of its domain."""
+        util.CONFIG = {'web-root': ''}
+        html = transform(PAGE)
+        self.assertIn('<a href="/posts/a.html">A</a>', html)
+        self.assertIn('<a href="/images/originals/b.png">', html)
+
+    def test_images(self):
+        """Tests linking images and making them responsive."""
+        html = transform(PAGE)
+        self.assertIn(
+            '<a href="/blog/images/originals/a.png"><picture>'
+            '<source type="image/webp" srcset="/blog/images/a.webp 250w" '
+            'sizes="(max-width: 250px) 100vw, 250px" />'
+            '<img src="/blog/images/a.png" alt="A" loading="lazy" '
+            'decoding="async" width="250" height="100" '
+            'srcset="/blog/images/a.png 250w, /blog/images/a-500.png 500w" '
+            'sizes="(max-width: 250px) 100vw, 250px" /></picture></a>'
+            '<figcaption>A</figcaption>', html)
+        self.assertIn(
+            '<p><a href="/blog/images/originals/b.png">'
+            '<img src="/blog/images/b.png" alt="B" loading="lazy" '
+            'decoding="async" /></a></p>', html)
+
+    def test_social(self):
+        """Tests the social links."""
+        html = transform(PAGE)
+        self.assertIn('<a href="https://twitter.com/share" target="_blank" '
+                      'title="Tweet this"><span class="fa fa-twitter">',
+                      html)
+
+    def test_comments(self):
+        """Tests moving comments after </div> onto the same line."""
+        html = transform(PAGE)
+        self.assertIn('</div> <!-- class="social" -->\n', html)
+        self.assertIn('</div> <!-- class="content-body" -->\n', html)
+
+    def test_idempotent(self):
+        """Tests that postprocessing postprocessed html changes nothing."""
+        html = transform(PAGE)
+        self.assertTrue(html.endswith(MARKER))
+        self.assertEqual(transform(html), html)
+
+    def test_transformfile(self):
+        """Tests that postprocessed files aren't rewritten."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'a.html')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(PAGE)
+            with mock.patch.object(postprocess, 'storebody') as storebody:
+                transformfile(path)
+                with open(path, encoding='utf-8') as f:
+                    html = f.read()
+                self.assertEqual(html, transform(PAGE))
+                os.utime(path, ns=(0, 0))
+                transformfile(path)
+                self.assertEqual(os.stat(path).st_mtime_ns, 0)
+                self.assertEqual(storebody.call_count, 2)
+
+    def test_images_on_one_line(self):
+        """Tests several images on a line."""
+        util.CONFIG = {'web-root': ''}
+        html = transform('<p><img src="/images/a.png" alt="A" /> '
+                         '<img src="/images/b.png" alt="B" /></p>\n')
+        self.assertIn('<a href="/images/originals/a.png"><picture>', html)
+        self.assertIn('<img src="/images/b.png" alt="B" loading="lazy" '
+                      'decoding="async" />', html)
+        self.assertEqual(transform(html), html)
+
+    def test_idempotent_no_webroot(self):
+        """Tests idempotency for a site at the top of its domain."""
+        util.CONFIG = {'web-root': ''}
+        html = transform(PAGE)
+        self.assertEqual(transform(html), html)
+
+    def test_content_body(self):
+        """Tests finding the content-body without the social widgets."""
+        body = content_body(transform(PAGE).splitlines(True))
+        self.assertTrue(body.startswith('<div class="content-body">'))
+        self.assertIn('<p>Text.</p>', body)
+        self.assertNotIn('twitter', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for render.py.
+
+The python renderer's html is checked against pandoc's html for the same
+markdown.  Whitespace between tags, where the two differ, is ignored.
+"""
+
+import re
+import unittest
+
+from bassclef.render import markdownmodule, tohtml, needspandoc, choose
+
+
+def normalize(html):
+    """Returns the html without whitespace between tags."""
+    return re.sub(r'>\s+<', '><', html).strip()
+
+
+@unittest.skipIf(markdownmodule() is None, 'Python-Markdown is not installed')
+class TestToHtml(unittest.TestCase):
+    """Checks tohtml() against pandoc's output."""
+
+    def check(self, text, pandoc):
+        """Checks that the markdown text renders as pandoc renders it."""
+        self.assertEqual(normalize(tohtml(text)), normalize(pandoc))
+
+    def test_paragraphs(self):
+        """Tests paragraphs with emphasis, links and smart punctuation."""
+        self.check('A *b* [c](http://d.com/) "e" -- f...\n',
+                   '<p>A <em>b</em> <a href="http://d.com/">c</a> '
+                   '“e” – f…</p>\n')
+
+    def test_figure(self):
+        """Tests an image alone in a paragraph, with a caption."""
+        self.check('![A *caption*](images/a.png)\n',
+                   '<figure>\n<img src="images/a.png" alt="A caption" />'
+                   '<figcaption>A <em>caption</em></figcaption>\n'
+                   '</figure>\n')
+
+    def test_inline_image(self):
+        """Tests an image in a paragraph with text, which isn't a figure."""
+        self.check('An ![icon](a.png) image.\n',
+                   '<p>An <img src="a.png" alt="icon" /> image.</p>\n')
+
+    def test_footnotes(self):
+        """Tests footnotes."""
+        self.check('Text[^a] and more[^b].\n\n'
+                   '[^a]: A note.\n'
+                   '[^b]: Another.\n',
+                   '<p>Text<a href="#fn1" class="footnote-ref" id="fnref1" '
+                   'role="doc-noteref"><sup>1</sup></a> and more'
+                   '<a href="#fn2" class="footnote-ref" id="fnref2" '
+                   'role="doc-noteref"><sup>2</sup></a>.</p>\n'
+                   '<section class="footnotes" role="doc-endnotes">\n'
+                   '<hr />\n'
+                   '<ol>\n'
+                   '<li id="fn1" role="doc-endnote"><p>A note.'
+                   '<a href="#fnref1" class="footnote-back" '
+                   'role="doc-backlink">↩︎</a></p></li>\n'
+                   '<li id="fn2" role="doc-endnote"><p>Another.'
+                   '<a href="#fnref2" class="footnote-back" '
+                   'role="doc-backlink">↩︎</a></p></li>\n'
+                   '</ol>\n'
+                   '</section>\n')
+
+    def test_headers(self):
+        """Tests header identifiers, including repeated ones."""
+        self.check('# Intro\n\n## The *first* part\n\n# Intro\n\n# Intro\n',
+                   '<h1 id="intro">Intro</h1>\n'
+                   '<h2 id="the-first-part">The <em>first</em> part</h2>\n'
+                   '<h1 id="intro-1">Intro</h1>\n'
+                   '<h1 id="intro-2">Intro</h1>\n')
+
+    def test_comments(self):
+        """Tests comments, as used to mark cuts."""
+        self.check('Para.\n\n<!-- cut -->\n\nMore.\n',
+                   '<p>Para.</p>\n<!-- cut -->\n<p>More.</p>\n')
+
+    def test_trailing_comments(self):
+        """Tests comments after closing tags, as in composed pages."""
+        text = '<div id="entry-0">\n<p>Text.</p>\n' \
+               '</div> <!-- id="entry-0" -->\n\n<hr />\n'
+        self.check(text, text)
+
+
+@unittest.skipIf(markdownmodule() is None, 'Python-Markdown is not installed')
+class TestChoose(unittest.TestCase):
+    """Checks which pages the auto setting renders with pandoc."""
+
+    def test_plain(self):
+        """Tests markdown that the python renderer supports."""
+        for text in ['A *b*.\n',
+                     '<div class="a_b">\n<p>Html only.</p>\n</div>\n\n*c*\n',
+                     '<hr />\n\nA *b*.\n',
+                     '<pre>\na *b*\n</pre>\n']:
+            self.assertIsNone(needspandoc(text), text)
+
+    def test_pandoc(self):
+        """Tests markdown that needs pandoc."""
+        for text, name in [('$x^2$\n', 'math'),
+                           ('H~2~O\n', 'subscript'),
+                           ('::: note\nA\n:::\n', 'fenced divs'),
+                           ('<div>\nA *b*\n</div>\n', 'markdown in html'),
+                           ('<figure>\n<img src="a.png" />\n'
+                            '<figcaption>A *caption*</figcaption>\n'
+                            '</figure>\n', 'markdown in html')]:
+            self.assertEqual(needspandoc(text), name, text)
+
+    def test_choose(self):
+        """Tests the renderer setting."""
+        template = []
+        self.assertEqual(choose({}, 'A *b*.\n', template), 'pandoc')
+        self.assertEqual(choose({'renderer': 'python'}, '$x$\n', template),
+                         'python')
+        self.assertEqual(choose({'renderer': 'auto'}, '$x$\n', template),
+                         'pandoc')
+        self.assertEqual(choose({'renderer': 'auto'}, 'A *b*.\n', template),
+                         'python')
+        self.assertEqual(choose({'renderer': 'python'}, 'A *b*.\n', None),
+                         'pandoc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for template.py."""
+
+import unittest
+
+from bassclef.template import parse, render
+
+
+def fill(template, **variables):
+    """Returns the template text filled in with the variables."""
+    return render(parse(template.splitlines(True)), variables)
+
+
+class TestTemplate(unittest.TestCase):
+    """Tests parse() and render()."""
+
+    def test_variables(self):
+        """Tests variables, which are used verbatim."""
+        self.assertEqual(fill('<h1>$title$</h1>\n', title='A <em>B</em>'),
+                         '<h1>A <em>B</em></h1>\n')
+        self.assertEqual(fill('$rel-url$ $missing$.\n', **{'rel-url': '/a'}),
+                         '/a .\n')
+
+    def test_dollars(self):
+        """Tests literal dollar signs."""
+        self.assertEqual(fill('$$5 and $$$x$\n', x='1'), '$5 and $1\n')
+
+    def test_conditionals(self):
+        """Tests conditionals on a line."""
+        template = '<p>$if(a)$A$else$not A$endif$</p>\n'
+        self.assertEqual(fill(template, a='1'), '<p>A</p>\n')
+        self.assertEqual(fill(template, a=''), '<p>not A</p>\n')
+        self.assertEqual(fill(template), '<p>not A</p>\n')
+
+    def test_nested(self):
+        """Tests nested conditionals."""
+        template = '$if(a)$$if(b)$AB$else$A$endif$$else$-$endif$\n'
+        self.assertEqual(fill(template, a='1', b='1'), 'AB\n')
+        self.assertEqual(fill(template, a='1'), 'A\n')
+        self.assertEqual(fill(template, b='1'), '-\n')
+
+    def test_directive_lines(self):
+        """Tests that lines with only directives are dropped."""
+        template = '<div>\n' \
+                   '  $if(a)$\n' \
+                   '  <p>$a$</p>\n' \
+                   '  $else$\n' \
+                   '  <p>None</p>\n' \
+                   '  $endif$\n' \
+                   '</div>\n'
+        self.assertEqual(fill(template, a='A'), '<div>\n  <p>A</p>\n</div>\n')
+        self.assertEqual(fill(template), '<div>\n  <p>None</p>\n</div>\n')
+
+    def test_unsupported(self):
+        """Tests that unsupported features are rejected."""
+        for template in ['$for(a)$$a$$endfor$\n',
+                         '$for(a)$$a$$sep$, $endfor$\n',
+                         '$a.b$\n',
+                         '$if(a)$A\n',
+                         '$endif$\n',
+                         '$else$\n',
+                         'A $ B\n']:
+            with self.assertRaises(ValueError, msg=template):
+                parse([template])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+
+# Copyright 2020 Thomas J. Duck <tomduck@tomduck.ca>
+
+# This file is part of bassclef.
+#
+#  Bassclef is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License verson 3 as
+#  published by the Free Software Foundation.
+#
+#  Bassclef is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with bassclef.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tests for watch.py."""
+
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+from bassclef import watch
+
+
+def fail(jobs, batch):
+    """Fails the way util.error() does."""
+    raise SystemExit(2)
+
+
+class TestRebuild(unittest.TestCase):
+    """Tests rebuild()."""
+
+    def rebuild(self, buildsite):
+        """Rebuilds with buildsite, and returns what was written to stderr
+        and whether the callback was called."""
+        called = []
+        with mock.patch.object(watch, 'locked', contextlib.nullcontext), \
+          mock.patch.object(watch, 'evict'), \
+          mock.patch.object(watch.build, 'buildsite', buildsite), \
+          mock.patch.object(watch, 'STDERR', io.StringIO()) as stderr:
+            watch.rebuild(1, False, lambda: called.append(True))
+        return stderr.getvalue(), bool(called)
+
+    def test_built(self):
+        """Tests calling back after a build."""
+        self.assertEqual(self.rebuild(lambda jobs, batch: 1), ('', True))
+
+    def test_error(self):
+        """Tests that errors reported with util.error() don't stop the
+        watcher."""
+        msg, called = self.rebuild(fail)
+        self.assertEqual(msg, 'Build failed (exit status 2).\n')
+        self.assertFalse(called)
+
+
+if __name__ == '__main__':
+    unittest.main()